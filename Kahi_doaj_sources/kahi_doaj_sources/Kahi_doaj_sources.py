@@ -1,5 +1,7 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne
+from joblib import Parallel, delayed
+from bson import ObjectId
 from time import time
 
 
@@ -32,8 +34,14 @@ class Kahi_doaj_sources(KahiBase):
                                             ["collection_name"]]
 
         self.verbose = self.config["doaj_sources"]["verbose"]
+        self.streaming = self.config["doaj_sources"]["streaming"] if "streaming" in self.config["doaj_sources"].keys(
+        ) else True
+        self.bulk_size = self.config["doaj_sources"]["bulk_size"] if "bulk_size" in self.config["doaj_sources"].keys(
+        ) else 1000
+        self.n_jobs = self.config["doaj_sources"]["num_jobs"] if "num_jobs" in self.config["doaj_sources"].keys(
+        ) else 1
 
-        self.already_in_db = []
+        self.already_in_db = set()
 
     def update_doaj(self, reg, entry):
         for upd in entry["updated"]:
@@ -98,6 +106,64 @@ class Kahi_doaj_sources(KahiBase):
 
         return entry
 
+    def doaj_entry(self, reg):
+        """
+        Returns a new source from a doaj record (bibjson).
+        """
+        entry = self.empty_source()
+        entry["updated"] = [{"source": "doaj", "time": int(time())}]
+        entry["names"] = [
+            {"lang": "en", "name": reg["title"], "source": "doaj"}]
+        entry["keywords"] = reg["keywords"]
+        entry["languages"] = reg["language"]
+        entry["publisher"] = {"country_code": reg["publisher"]
+                              ["country"], "name": reg["publisher"]["name"], "id": ""}
+        entry["open_access_start_year"] = reg["oa_start"] if "oa_start" in reg.keys(
+        ) else None
+        entry["external_urls"] = [
+            {"source": ref, "url": url} for ref, url in reg["ref"].items()]
+        entry["review_process"] = reg["editorial"]["review_process"]
+        entry["plagiarism_detection"] = reg["plagiarism"]["detection"]
+        entry["publication_time_weeks"] = reg["publication_time_weeks"]
+        entry["copyright"] = reg["copyright"]
+        entry["licenses"] = reg["license"]
+
+        if "apc" in reg.keys():
+            if reg["apc"]["has_apc"]:
+                entry["apc"] = {"charges": reg["apc"]["max"][-1]["price"],
+                                "currency": reg["apc"]["max"][-1]["currency"]}
+
+        subjects_source = {}
+        if "subject" in reg.keys():
+            if reg["subject"]:
+                for sub in reg["subject"]:
+                    sub_entry = {
+                        "id": "",
+                        "name": sub["term"],
+                        "external_ids": [{"source": sub["scheme"], "id": sub["code"]}]
+                    }
+                    if sub["scheme"] in subjects_source.keys():
+                        subjects_source[sub["scheme"]].append(
+                            sub_entry)
+                    else:
+                        subjects_source[sub["scheme"]] = [sub_entry]
+        for source, subs in subjects_source.items():
+            entry["subjects"].append({
+                "source": source,
+                "subjects": subs
+            })
+
+        if "eissn" in reg.keys():
+            entry["external_ids"].append(
+                {"source": "eissn", "id": reg["eissn"]})
+        if "pissn" in reg.keys():
+            entry["external_ids"].append(
+                {"source": "pissn", "id": reg["pissn"]})
+
+        entry["waiver"] = reg["waiver"]
+
+        return entry
+
     def process_doaj(self, verbose=0):
         reg_list = list(self.doaj_collection.find())
         for i, oldreg in enumerate(reg_list):
@@ -107,7 +173,7 @@ class Kahi_doaj_sources(KahiBase):
                     {"external_ids.id": reg["eissn"]})
                 if reg_db:
                     _id = reg_db["_id"]
-                    self.already_in_db.append(reg["eissn"])
+                    self.already_in_db.add(reg["eissn"])
                     entry = self.update_doaj(reg, reg_db)
                     if entry:
                         self.collection.update_one(
@@ -118,64 +184,14 @@ class Kahi_doaj_sources(KahiBase):
                     {"external_ids.id": reg["pissn"]})
                 if reg_db:
                     _id = reg_db["_id"]
-                    self.already_in_db.append(reg["pissn"])
+                    self.already_in_db.add(reg["pissn"])
                     entry = self.update_doaj(reg, reg_db)
                     if entry:
                         self.collection.update_one(
                             {"_id": _id}, {"$set": entry})
                     continue
 
-            entry = self.empty_source()
-            entry["updated"] = [{"source": "doaj", "time": int(time())}]
-            entry["names"] = [
-                {"lang": "en", "name": reg["title"], "source": "doaj"}]
-            entry["keywords"] = reg["keywords"]
-            entry["languages"] = reg["language"]
-            entry["publisher"] = {"country_code": reg["publisher"]
-                                  ["country"], "name": reg["publisher"]["name"], "id": ""}
-            entry["open_access_start_year"] = reg["oa_start"] if "oa_start" in reg.keys(
-            ) else None
-            entry["external_urls"] = [
-                {"source": ref, "url": url} for ref, url in reg["ref"].items()]
-            entry["review_process"] = reg["editorial"]["review_process"]
-            entry["plagiarism_detection"] = reg["plagiarism"]["detection"]
-            entry["publication_time_weeks"] = reg["publication_time_weeks"]
-            entry["copyright"] = reg["copyright"]
-            entry["licenses"] = reg["license"]
-
-            if "apc" in reg.keys():
-                if reg["apc"]["has_apc"]:
-                    entry["apc"] = {"charges": reg["apc"]["max"][-1]["price"],
-                                    "currency": reg["apc"]["max"][-1]["currency"]}
-
-            subjects_source = {}
-            if "subject" in reg.keys():
-                if reg["subject"]:
-                    for sub in reg["subject"]:
-                        sub_entry = {
-                            "id": "",
-                            "name": sub["term"],
-                            "external_ids": [{"source": sub["scheme"], "id": sub["code"]}]
-                        }
-                        if sub["scheme"] in subjects_source.keys():
-                            subjects_source[sub["scheme"]].append(
-                                sub_entry)
-                        else:
-                            subjects_source[sub["scheme"]] = [sub_entry]
-            for source, subs in subjects_source.items():
-                entry["subjects"].append({
-                    "source": source,
-                    "subjects": subs
-                })
-
-            if "eissn" in reg.keys():
-                entry["external_ids"].append(
-                    {"source": "eissn", "id": reg["eissn"]})
-            if "pissn" in reg.keys():
-                entry["external_ids"].append(
-                    {"source": "pissn", "id": reg["pissn"]})
-
-            entry["waiver"] = reg["waiver"]
+            entry = self.doaj_entry(reg)
 
             self.collection.insert_one(entry)
             if verbose > 4:
@@ -183,7 +199,7 @@ class Kahi_doaj_sources(KahiBase):
                     print(
                         f"""Processed  {i} of {len(reg_list)}""")
             for ext in entry["external_ids"]:
-                self.already_in_db.append(ext["id"])
+                self.already_in_db.add(ext["id"])
 
         if verbose >= 4:
             print(
@@ -191,9 +207,95 @@ class Kahi_doaj_sources(KahiBase):
 
         self.client.close()
 
+    def process_batch(self, tasks, verbose=0):
+        """
+        Updates and inserts the sources of a batch of doaj records with a single bulk_write.
+
+        Parameters:
+        ----------
+        tasks : list
+            List of (doaj record, source _id, True if the source is new).
+        """
+        ids = [_id for reg, _id, new in tasks if not new]
+        sources = {reg_db["_id"]: reg_db for reg_db in self.collection.find({"_id": {"$in": ids}})} if ids else {}
+        operations = []
+        for reg, _id, new in tasks:
+            if new:
+                entry = self.doaj_entry(reg)
+                entry["_id"] = _id
+                operations.append(InsertOne(entry))
+            elif _id in sources.keys():
+                entry = self.update_doaj(reg, sources[_id])
+                if entry:
+                    operations.append(UpdateOne({"_id": _id}, {"$set": entry}))
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    def doaj_batches(self, verbose=0):
+        """
+        Generator of batches of bulk_size doaj records with the _id of their source.
+        The source of every record is resolved here (in a single thread) with the map issn -> _id,
+        the new sources get an _id and their issns are added to the map, and only the first
+        record of every source is processed, as the next ones would find the source already updated by doaj.
+        """
+        issn_map = {}
+        for reg_db in self.collection.find({}, {"external_ids.id": 1}):
+            for ext in reg_db["external_ids"]:
+                issn_map.setdefault(ext["id"], reg_db["_id"])
+        claimed = set()
+        batch = []
+        count = 0
+        for oldreg in self.doaj_collection.find({}, {"bibjson": 1}, no_cursor_timeout=True):
+            reg = oldreg["bibjson"]
+            count += 1
+            _id = None
+            for issn in ["eissn", "pissn"]:
+                if issn in reg.keys() and reg[issn] in issn_map.keys():
+                    _id = issn_map[reg[issn]]
+                    self.already_in_db.add(reg[issn])
+                    break
+            new = _id is None
+            if new:
+                _id = ObjectId()
+                for issn in ["eissn", "pissn"]:
+                    if issn in reg.keys():
+                        issn_map.setdefault(reg[issn], _id)
+                        self.already_in_db.add(reg[issn])
+            if _id in claimed:
+                continue
+            claimed.add(_id)
+            batch.append((reg, _id, new))
+            if len(batch) >= self.bulk_size:
+                yield batch
+                batch = []
+            if verbose > 4 and count % 1000 == 0:
+                print(f"""Processed  {count} doaj records""")
+        if batch:
+            yield batch
+
+    def process_doaj_streaming(self, verbose=0):
+        out = Parallel(
+            n_jobs=self.n_jobs,
+            verbose=verbose,
+            backend="threading")(
+            delayed(self.process_batch)(
+                tasks,
+                verbose
+            ) for tasks in self.doaj_batches(verbose)
+        )
+        if verbose >= 4:
+            print(
+                f"""Written {sum(out)} sources, inserted {self.collection.count_documents({"updated.source":"doaj"})} sources""")
+
+        self.client.close()
+
     def run(self):
         start_time = time()
-        self.process_doaj(verbose=self.verbose)
+        if self.streaming:
+            self.process_doaj_streaming(verbose=self.verbose)
+        else:
+            self.process_doaj(verbose=self.verbose)
         print("Execution time: {} minutes".format(
             round((time() - start_time) / 60, 2)))
         return 0
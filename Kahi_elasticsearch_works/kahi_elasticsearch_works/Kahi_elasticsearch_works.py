@@ -1,8 +1,11 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient
-from math import isnan
+from time import time
+from joblib import Parallel, delayed
 
 from mohan.Similarity import Similarity
+from kahi_elasticsearch_works.indexer import (
+    work_projection, work_entry, id_ranges, disable_refresh, put_index_settings, index_range)
 
 
 class Kahi_elasticsearch_works(KahiBase):
@@ -47,69 +50,83 @@ class Kahi_elasticsearch_works(KahiBase):
         self.bulk_size = config["elasticsearch_works"]["bulk_size"] if "bulk_size" in config["elasticsearch_works"].keys(
         ) else 100
 
+        # with more than one job the works are indexed in parallel by ranges of _id
+        self.n_jobs = config["elasticsearch_works"]["num_jobs"] if "num_jobs" in config["elasticsearch_works"].keys(
+        ) else 1
+        self.backend = config["elasticsearch_works"]["backend"] if "backend" in config["elasticsearch_works"].keys(
+        ) else "loky"
+        self.max_retries = config["elasticsearch_works"]["max_retries"] if "max_retries" in config["elasticsearch_works"].keys(
+        ) else 5
+        self.disable_refresh = config["elasticsearch_works"]["disable_refresh"] if "disable_refresh" in config["elasticsearch_works"].keys(
+        ) else True
+
         self.inserted_ids = []
 
     def bulk_insert(self):
         es_entries = []
-        paper_list = self.collection.find(
-            {}, {"titles": 1, "source": 1, "year_published": 1, "bibliographic_info": 1, "authors.full_name": 1})
-        paper_list_count = self.collection.count_documents({})
+        paper_list = self.collection.find({}, work_projection)
         for i, reg in enumerate(paper_list):
-            work = {
-                "title": "",
-                "source": "",
-                "year": "",
-                "volume": "",
-                "issue": "",
-                "start_page": "",
-                "end_page": "",
-                "authors": [],
-                "provenance": "elasticsearch",
-
-            }
-            if "titles" not in reg.keys():
-                continue
-            if not reg["titles"]:
+            entry = work_entry(reg, self.index)
+            if entry is None:
                 continue
-            work["title"] = reg["titles"][0]["title"]
-            if "name" in reg["source"].keys():
-                work["source"] = reg["source"]["name"] if reg["source"]["name"] else ""
-            if "year_published" in reg.keys():
-                work["year"] = reg["year_published"] if reg["year_published"] else ""
-            if "volume" in reg["bibliographic_info"].keys():
-                work["volume"] = reg["bibliographic_info"]["volume"] if reg["bibliographic_info"]["volume"] else ""
-            if "issue" in reg["bibliographic_info"].keys():
-                work["issue"] = reg["bibliographic_info"]["issue"] if reg["bibliographic_info"]["issue"] else ""
-            if "start_page" in reg["bibliographic_info"].keys():
-                work["start_page"] = reg["bibliographic_info"]["start_page"] if reg["bibliographic_info"]["start_page"] else ""
-            if "end_page" in reg["bibliographic_info"].keys():
-                work["end_page"] = reg["bibliographic_info"]["end_page"] if reg["bibliographic_info"]["end_page"] else ""
-            authors = []
-            for author in reg["authors"]:
-                authors.append(author["full_name"])
-                if len(authors) == 5:
-                    break
-            work["authors"] = authors
-            # double checking for nan
-            for key, val in work.items():
-                if isinstance(val, float) and isnan(val):
-                    work[key] = ""
-            entry = {
-                "_index": self.index,
-                "_id": str(reg["_id"]),
-                "_source": work
-            }
             es_entries.append(entry)
-            if len(es_entries) == self.bulk_size or paper_list_count <= self.bulk_size or i + 1 == paper_list_count:
-                try:
-                    self.es_client.insert_bulk(es_entries)
-                except Exception as e:
-                    print(e)
-                    print(es_entries)
-                    raise
+            if len(es_entries) == self.bulk_size:
+                self.insert_entries(es_entries)
                 es_entries = []
                 if self.verbose > 4:
                     print(f"""{i + 1} entries inserted""")
+        if es_entries:
+            self.insert_entries(es_entries)
+            if self.verbose > 4:
+                print(f"""{i + 1} entries inserted""")
+
+    def insert_entries(self, es_entries):
+        try:
+            self.es_client.insert_bulk(es_entries)
+        except Exception as e:
+            print(e)
+            print(es_entries)
+            raise
+
+    def parallel_bulk_insert(self):
+        """
+        Index the works with num_jobs workers, every worker indexes a range of _id
+        with its own cursor and connections (see indexer.index_range).
+        The refresh and the replicas of the index are disabled during the load and restored at the end.
+        """
+        ranges = id_ranges(self.collection, self.n_jobs)
+        previous = None
+        if self.disable_refresh:
+            previous = disable_refresh(self.es_client.es, self.index)
+            if self.verbose > 0:
+                print(f"""Refresh and replicas of {self.index} disabled, previous settings {previous}""")
+        start = time()
+        try:
+            results = Parallel(
+                n_jobs=self.n_jobs,
+                backend=self.backend,
+                verbose=10
+            )(delayed(index_range)(
+                self.config,
+                id_filter,
+                worker,
+                self.bulk_size,
+                self.max_retries,
+                self.verbose
+            ) for worker, id_filter in enumerate(ranges))
+        finally:
+            if previous is not None:
+                put_index_settings(self.es_client.es, self.index, previous)
+                self.es_client.es.indices.refresh(index=self.index)
+                if self.verbose > 0:
+                    print(f"""Settings of {self.index} restored""")
+        indexed = sum(result["indexed"] for result in results)
+        errors = sum(result["errors"] for result in results)
+        if self.verbose > 0:
+            print(f"""{indexed} entries inserted, {errors} errors, {indexed / (time() - start):.1f} docs/s""")
+        if errors:
+            raise Exception(
+                f"[Kahi_elasticsearch_works] ERROR: {errors} entries could not be inserted in {self.index}")
 
     def delete(self):
         self.es_client.delete_index(self.index)
@@ -118,7 +135,10 @@ class Kahi_elasticsearch_works(KahiBase):
         if self.task == "bulk_insert":
             if self.verbose > 0:
                 print(f"""Bulk inserting index {self.index}""")
-            self.bulk_insert()
+            if self.n_jobs > 1:
+                self.parallel_bulk_insert()
+            else:
+                self.bulk_insert()
         elif self.task == "delete":
             if self.verbose > 0:
                 print(f"""Deleting index {self.index}""")
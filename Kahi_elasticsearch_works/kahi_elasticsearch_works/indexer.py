@@ -0,0 +1,229 @@
+from elasticsearch import __version__ as es_version
+from elasticsearch.helpers import streaming_bulk
+from mohan.Similarity import Similarity
+from pymongo import MongoClient
+from math import isnan
+from time import time
+
+# fields of the works used to build the documents of the index
+work_projection = {"titles": 1, "source": 1, "year_published": 1,
+                   "bibliographic_info": 1, "authors.full_name": 1}
+
+
+def work_entry(reg, index):
+    """
+    Build the bulk action of the elasticsearch index for a work.
+
+    Parameters:
+    -----------
+    reg : dict
+        The work with the fields of work_projection.
+    index : str
+        Name of the elasticsearch index.
+
+    Returns:
+    --------
+    dict or None
+        The action (_index, _id and _source) or None if the work has no titles.
+    """
+    work = {
+        "title": "",
+        "source": "",
+        "year": "",
+        "volume": "",
+        "issue": "",
+        "start_page": "",
+        "end_page": "",
+        "authors": [],
+        "provenance": "elasticsearch",
+
+    }
+    if "titles" not in reg.keys():
+        return None
+    if not reg["titles"]:
+        return None
+    work["title"] = reg["titles"][0]["title"]
+    if "name" in reg["source"].keys():
+        work["source"] = reg["source"]["name"] if reg["source"]["name"] else ""
+    if "year_published" in reg.keys():
+        work["year"] = reg["year_published"] if reg["year_published"] else ""
+    if "volume" in reg["bibliographic_info"].keys():
+        work["volume"] = reg["bibliographic_info"]["volume"] if reg["bibliographic_info"]["volume"] else ""
+    if "issue" in reg["bibliographic_info"].keys():
+        work["issue"] = reg["bibliographic_info"]["issue"] if reg["bibliographic_info"]["issue"] else ""
+    if "start_page" in reg["bibliographic_info"].keys():
+        work["start_page"] = reg["bibliographic_info"]["start_page"] if reg["bibliographic_info"]["start_page"] else ""
+    if "end_page" in reg["bibliographic_info"].keys():
+        work["end_page"] = reg["bibliographic_info"]["end_page"] if reg["bibliographic_info"]["end_page"] else ""
+    authors = []
+    for author in reg["authors"]:
+        authors.append(author["full_name"])
+        if len(authors) == 5:
+            break
+    work["authors"] = authors
+    # double checking for nan
+    for key, val in work.items():
+        if isinstance(val, float) and isnan(val):
+            work[key] = ""
+    return {
+        "_index": index,
+        "_id": str(reg["_id"]),
+        "_source": work
+    }
+
+
+def normalize_entry(es_handler, entry):
+    """
+    Normalize the title, source and authors of an action as Similarity.insert_bulk does
+    (lower case, without accents and dots), the searches of Similarity are normalized the same way.
+
+    Parameters:
+    -----------
+    es_handler : mohan.Similarity.Similarity
+        Elasticsearch handler of the works index.
+    entry : dict
+        The action built with work_entry.
+
+    Returns:
+    --------
+    dict
+        The same action, normalized in place.
+    """
+    work = entry["_source"]
+    work["authors"] = [es_handler.str_normilize(author) for author in work["authors"]]
+    for key in ["title", "source"]:
+        work[key] = es_handler.str_normilize(work[key])
+    return entry
+
+
+def get_es_handler(config):
+    """
+    Create the elasticsearch handler of the works index from the configuration.
+    """
+    return Similarity(
+        es_index=config["elasticsearch_works"]["es_index"],
+        es_uri=config["elasticsearch_works"]["es_url"] if "es_url" in config["elasticsearch_works"].keys(
+        ) else "http://localhost:9200",
+        es_auth=(
+            config["elasticsearch_works"]["es_user"],
+            config["elasticsearch_works"]["es_password"]
+        ),
+    )
+
+
+def id_ranges(collection, n_ranges):
+    """
+    Split the collection in ranges of _id with about the same number of documents.
+
+    Parameters:
+    -----------
+    collection : pymongo.collection.Collection
+        Collection to split.
+    n_ranges : int
+        Number of ranges.
+
+    Returns:
+    --------
+    list
+        Disjoint filters of the ranges ({"_id": {"$gte": min, "$lt": max}}, the last one with $lte).
+    """
+    buckets = list(collection.aggregate([
+        {"$project": {"_id": 1}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": n_ranges}}
+    ], allowDiskUse=True))
+    ranges = []
+    for i, bucket in enumerate(buckets):
+        # the max of a bucket is the min of the next one, only the last bucket includes its max
+        upper = "$lte" if i == len(buckets) - 1 else "$lt"
+        ranges.append(
+            {"_id": {"$gte": bucket["_id"]["min"], upper: bucket["_id"]["max"]}})
+    return ranges
+
+
+def put_index_settings(es, index, settings):
+    """
+    Update the settings of an index, a None value restores the default of the setting.
+    """
+    if es_version[0] < 8:
+        es.indices.put_settings(index=index, body={"index": settings})
+    else:
+        es.indices.put_settings(index=index, settings={"index": settings})
+
+
+def disable_refresh(es, index):
+    """
+    Disable the refresh and the replicas of an index for a bulk load.
+
+    Returns:
+    --------
+    dict
+        The previous refresh_interval and number_of_replicas, to be restored with put_index_settings.
+    """
+    res = es.indices.get_settings(index=index)
+    name = index if index in res else next(iter(res))
+    settings = res[name]["settings"]["index"]
+    previous = {
+        "refresh_interval": settings["refresh_interval"] if "refresh_interval" in settings.keys() else None,
+        "number_of_replicas": settings["number_of_replicas"] if "number_of_replicas" in settings.keys() else None
+    }
+    put_index_settings(es, index, {"refresh_interval": "-1", "number_of_replicas": 0})
+    return previous
+
+
+def index_range(config, id_filter, worker, bulk_size=100, max_retries=5, verbose=0):
+    """
+    Index the works of a range of _id, with its own cursor and connections.
+
+    The documents are sent with streaming_bulk, it reads the cursor only when a chunk
+    of bulk_size documents has to be sent, so the memory of the worker is bounded,
+    and the documents rejected with 429 (too many requests) are sent again with
+    exponential backoff up to max_retries times.
+
+    Parameters:
+    -----------
+    config : dict
+        The configuration dictionary.
+    id_filter : dict
+        Filter of the range of _id.
+    worker : int
+        Number of the worker, used in the messages.
+    bulk_size : int
+        Number of documents per bulk request.
+    max_retries : int
+        Maximum number of retries of a document rejected with 429.
+    verbose : int
+        Verbosity level.
+
+    Returns:
+    --------
+    dict
+        Counters of the worker (worker, indexed, errors and seconds).
+    """
+    client = MongoClient(config["database_url"])
+    collection = client[config["database_name"]]["works"]
+    es_handler = get_es_handler(config)
+    index = config["elasticsearch_works"]["es_index"]
+
+    cursor = collection.find(id_filter, work_projection, batch_size=bulk_size)
+    actions = (normalize_entry(es_handler, entry) for entry in (work_entry(reg, index) for reg in cursor) if entry is not None)
+    start = time()
+    counters = {"worker": worker, "indexed": 0, "errors": 0, "seconds": 0}
+    try:
+        for ok, item in streaming_bulk(es_handler.es, actions, chunk_size=bulk_size, max_retries=max_retries,
+                                       initial_backoff=2, max_backoff=600, raise_on_error=False):
+            if ok:
+                counters["indexed"] += 1
+            else:
+                counters["errors"] += 1
+                print(f"ERROR: worker {worker} could not index", item)
+            if verbose > 4 and (counters["indexed"] + counters["errors"]) % (bulk_size * 100) == 0:
+                print(f"INFO: worker {worker} {counters['indexed']} entries inserted, {counters['indexed'] / (time() - start):.1f} docs/s")
+    finally:
+        cursor.close()
+        client.close()
+        es_handler.es.close()
+    counters["seconds"] = time() - start
+    if verbose > 0:
+        rate = counters["indexed"] / counters["seconds"] if counters["seconds"] > 0 else 0
+        print(f"INFO: worker {worker} finished, {counters['indexed']} entries inserted, {counters['errors']} errors, {rate:.1f} docs/s")
+    return counters
@@ -82,6 +82,7 @@ def main():
         install_requires=[
             'kahi',
             'pymongo',
+            'joblib',
             'mohan'
         ],
     )
@@ -1,5 +1,5 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from joblib import Parallel, delayed
 
 
@@ -26,6 +26,8 @@ class Kahi_impactu_post_cites_count(KahiBase):
             impactu_post_cites_count:
                 num_jobs: 20
                 verbose: 5
+                bulk: True
+                bulk_size: 1000
         ```
         """
         self.config = config
@@ -34,6 +36,10 @@ class Kahi_impactu_post_cites_count(KahiBase):
 
         self.n_jobs = self.config["impactu_post_cites_count"]["num_jobs"]
         self.verbose = self.config["impactu_post_cites_count"]["verbose"]
+        self.bulk = self.config["impactu_post_cites_count"]["bulk"] if "bulk" in self.config["impactu_post_cites_count"].keys(
+        ) else True
+        self.bulk_size = self.config["impactu_post_cites_count"]["bulk_size"] if "bulk_size" in self.config["impactu_post_cites_count"].keys(
+        ) else 1000
 
         self.client = MongoClient(self.mongodb_url)
         self.db = self.client[self.database_name]
@@ -204,7 +210,149 @@ class Kahi_impactu_post_cites_count(KahiBase):
             )
             client.close()
 
+    def aggregate_cites_products(self, ids_field):
+        """
+        Method to calculate the citation and product count for every entity referenced
+        in the works with two collection wide aggregations.
+
+        Parameters
+        ----------
+        ids_field : dict or str
+            Aggregation expression that returns the list of entity ids in a work.
+
+        Returns
+        -------
+        dict
+            entity id -> {"citations_count": [...], "products_count": int}
+        """
+        counts = {}
+        # the ids are taken as a set to count every work only once per entity
+        pipeline = [
+            {"$project": {"ids": {"$setUnion": [ids_field, []]}, "citations_count": 1}},
+            {"$unwind": "$ids"},
+            {"$unwind": "$citations_count"},
+            {
+                "$group": {
+                    "_id": {"id": "$ids", "source": "$citations_count.source"},
+                    "count": {"$sum": "$citations_count.count"},
+                },
+            },
+        ]
+        for cites in self.works_collection.aggregate(pipeline, allowDiskUse=True):
+            rec = counts.setdefault(
+                cites["_id"]["id"], {"citations_count": [], "products_count": 0})
+            rec["citations_count"] += [{"source": cites["_id"]["source"],
+                                        "count": cites["count"]}]
+        pipeline = [
+            {"$project": {"ids": {"$setUnion": [ids_field, []]}}},
+            {"$unwind": "$ids"},
+            {"$group": {"_id": "$ids", "count": {"$sum": 1}}},
+        ]
+        for products in self.works_collection.aggregate(pipeline, allowDiskUse=True):
+            rec = counts.setdefault(
+                products["_id"], {"citations_count": [], "products_count": 0})
+            rec["products_count"] = products["count"]
+        return counts
+
+    def aggregate_cites_faculty_department_group(self, units_ids):
+        """
+        Method to calculate the citation count for faculties, departments and groups
+        with a precomputed map of person -> affiliations and a single pass over the works.
+
+        Parameters
+        ----------
+        units_ids : set
+            Ids of the faculties, departments and groups.
+
+        Returns
+        -------
+        dict
+            affiliation id -> {source: count}
+        """
+        person_units = {}
+        for person in self.person_collection.find(
+                {"affiliations.id": {"$in": list(units_ids)}}, {"affiliations.id": 1}):
+            person_units[person["_id"]] = set(
+                aff.get("id") for aff in person["affiliations"] if aff.get("id") in units_ids)
+
+        cites = {}
+        # citations_count.0 skips the works without the field as well as the empty ones
+        for work in self.works_collection.find(
+                {"citations_count.0": {"$exists": True}},
+                {"authors.id": 1, "citations_count": 1}):
+            work_units = set()
+            for author in work.get("authors", []):
+                if author.get("id") in person_units.keys():
+                    work_units.update(person_units[author["id"]])
+            for unit in work_units:
+                unit_cites = cites.setdefault(unit, {})
+                for count in work["citations_count"]:
+                    unit_cites[count["source"]] = unit_cites.get(
+                        count["source"], 0) + count["count"]
+        return cites
+
+    def bulk_update(self, collection, requests):
+        """
+        Method to apply a list of updates with bulk_write in batches of bulk_size.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            Collection to update.
+        requests : iterable
+            pymongo.UpdateOne operations.
+        """
+        batch = []
+        for request in requests:
+            batch.append(request)
+            if len(batch) >= self.bulk_size:
+                collection.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            collection.bulk_write(batch, ordered=False)
+
+    def run_cites_count_bulk(self):
+        """
+        Method to run the cites and products count calculation for each person, institution, faculty, department and group
+        with collection wide aggregations and bulk updates.
+        """
+        # Count cites for each author
+        if self.verbose > 0:
+            print("Calculating cites and products count for authors")
+        counts = self.aggregate_cites_products("$authors.id")
+        self.bulk_update(
+            self.person_collection,
+            (UpdateOne({"_id": reg["_id"]}, {"$set": counts.get(reg["_id"], {"citations_count": [], "products_count": 0})}, upsert=True)
+             for reg in self.person_collection.find({}, {"_id": 1})))
+        del counts
+
+        # Count cites for each institution, faculty, department and group
+        if self.verbose > 0:
+            print("Calculating cites and products count for affiliations")
+        counts = self.aggregate_cites_products(
+            {"$reduce": {"input": "$authors.affiliations.id", "initialValue": [], "in": {"$setUnion": ["$$value", "$$this"]}}})
+        units_ids = set(reg["_id"] for reg in self.affiliations_collection.find(
+            {"types.type": {"$in": ["department", "faculty", "group"]}}, {"_id": 1}))
+        # faculties, departments and groups cites come from the works of their authors
+        if self.verbose > 0:
+            print("Calculating cites count for {} faculties, departments and groups".format(
+                len(units_ids)))
+        units_cites = self.aggregate_cites_faculty_department_group(units_ids)
+
+        def affiliations_requests():
+            for reg in self.affiliations_collection.find({}, {"_id": 1}):
+                rec = counts.get(
+                    reg["_id"], {"citations_count": [], "products_count": 0})
+                if reg["_id"] in units_ids:
+                    rec["citations_count"] = [{"source": source, "count": count}
+                                              for source, count in units_cites.get(reg["_id"], {}).items()]
+                yield UpdateOne({"_id": reg["_id"]}, {"$set": rec}, upsert=True)
+        self.bulk_update(self.affiliations_collection, affiliations_requests())
+
     def run(self):
-        self.run_cites_count()
+        if self.bulk:
+            self.run_cites_count_bulk()
+        else:
+            self.run_cites_count()
         self.client.close()
         return 0
@@ -2,10 +2,13 @@ from joblib import Parallel, delayed
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient
 import subprocess
+from time import time
 from spacy import cli, load
 from kahi_impactu_postcalculations.process_one import network_creation_process_one, top_words_process_one, count_works_one, load_nlp_models
 from kahi_impactu_postcalculations.indexes import create_indexes
-from kahi_impactu_postcalculations.denormalization import denormalize
+from kahi_impactu_postcalculations.denormalization import denormalize, denormalize_parallel
+from kahi_impactu_postcalculations.network import network_creation_global
+from kahi_impactu_postcalculations.lemmas import lemmatize_works
 
 
 class Kahi_impactu_postcalculations(KahiBase):
@@ -34,6 +37,24 @@ class Kahi_impactu_postcalculations(KahiBase):
         self.n_jobs = self.config["impactu_postcalculations"]["n_jobs"]
         self.author_count = self.config["impactu_postcalculations"][
             "author_count"] if "author_count" in self.config["impactu_postcalculations"] else 6
+        self.network_engine = self.config["impactu_postcalculations"][
+            "network_engine"] if "network_engine" in self.config["impactu_postcalculations"] else "global"
+        self.bulk_size = self.config["impactu_postcalculations"][
+            "bulk_size"] if "bulk_size" in self.config["impactu_postcalculations"] else 1000
+        self.lemmas_cache = self.config["impactu_postcalculations"][
+            "lemmas_cache"] if "lemmas_cache" in self.config["impactu_postcalculations"] else True
+        self.nlp_batch_size = self.config["impactu_postcalculations"][
+            "nlp_batch_size"] if "nlp_batch_size" in self.config["impactu_postcalculations"] else 1000
+        self.nlp_n_process = self.config["impactu_postcalculations"][
+            "nlp_n_process"] if "nlp_n_process" in self.config["impactu_postcalculations"] else 1
+        self.task_batch_size = self.config["impactu_postcalculations"][
+            "task_batch_size"] if "task_batch_size" in self.config["impactu_postcalculations"] else "auto"
+        self.denormalization_ranges = self.config["impactu_postcalculations"][
+            "denormalization_ranges"] if "denormalization_ranges" in self.config["impactu_postcalculations"] else 0
+        self.denormalization_incremental = self.config["impactu_postcalculations"][
+            "denormalization_incremental"] if "denormalization_incremental" in self.config["impactu_postcalculations"] else False
+        self.watermark_collection = self.config["impactu_postcalculations"][
+            "watermark_collection"] if "watermark_collection" in self.config["impactu_postcalculations"] else "watermarks"
         self._check_and_install_spacy_models()
 
     def _check_and_install_spacy_models(self):
@@ -69,6 +90,26 @@ class Kahi_impactu_postcalculations(KahiBase):
         subprocess.run(["python3", "-m", "spacy",
                        "download", "es_core_news_sm"])
 
+    def get_watermark(self, client):
+        """
+        Get the time of the last denormalization, saved in the log database.
+
+        Returns:
+            int: time of the last denormalization or None.
+        """
+        reg = client[self.config["log_database"]][self.watermark_collection].find_one(
+            {"_id": "impactu_postcalculations/denormalization"})
+        return reg["time"] if reg else None
+
+    def set_watermark(self, client, start):
+        """
+        Save the time of the start of the denormalization in the log database.
+        """
+        client[self.config["log_database"]][self.watermark_collection].update_one(
+            {"_id": "impactu_postcalculations/denormalization"},
+            {"$set": {"time": start}},
+            upsert=True)
+
     def run(self):
         """
         Execute the plugin to create co-authorship networks and extract top words.
@@ -87,72 +128,112 @@ class Kahi_impactu_postcalculations(KahiBase):
         create_indexes(db)
 
         print(f"INFO: Denormalizing data in {self.database_name}.works")
-        denormalize(db.works)
-
-        # Getting the list of institutions ids with works
-        print("INFO: Getting authors and affiliations ids")
-        institutions_ids = []
-        for aff in db["affiliations"].find({"types.type": {"$nin": ["faculty", "department", "group"]}}, {"_id": 1}):
-            count = db["works"].count_documents(
-                {"authors.affiliations.id": aff["_id"]})
-            if count != 0:
-                institutions_ids.append(aff["_id"])
-
-        # Creating the networks of coauthorship for each affiliation
-        print("INFO: Creating affiliations networks")
-        if institutions_ids:
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=10,
-                backend=self.backend)(
-                    delayed(network_creation_process_one)(
-                        self.config,
-                        client if self.backend == "threading" else None,
-                        impactu_client if self.backend == "threading" else None,
-                        idx,
-                        self.author_count,
-                        "affiliations",
-                        self.backend
-                    ) for idx in institutions_ids)
-
-        # Getting the list of authors ids with works
-        print("INFO: Checking authors with works")
-        authors_ids = [x["_id"] for x in db["person"].find({}, {"_id": 1})]
-
-        # this could be threads, is a basic thing.
-        authors_ids = Parallel(n_jobs=self.n_jobs, backend="threading", verbose=1)(
-            delayed(count_works_one)(
+        if self.denormalization_ranges > 0 or self.denormalization_incremental:
+            # the changes done during the run are denormalized in the next one
+            start = int(time())
+            last = self.get_watermark(
+                client) if self.denormalization_incremental else None
+            denormalize_parallel(
                 db,
-                author
-            ) for author in authors_ids)
-
-        # remove Nones
-        authors_ids = [x for x in authors_ids if x is not None]
-
-        print(f"INFO: total authors {len(authors_ids)}")
-        # Creating the networks of coauthorship for each author
-        print("INFO: Creating authors networks")
-        if authors_ids:
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=10,
-                backend=self.backend)(
-                    delayed(network_creation_process_one)(
-                        self.config,
-                        client if self.backend == "threading" else None,
-                        impactu_client if self.backend == "threading" else None,
-                        idx,
-                        self.author_count,
-                        "person",
-                        self.backend
-                    ) for idx in authors_ids)
+                max(1, self.denormalization_ranges),
+                self.n_jobs,
+                last=last,
+                verbose=self.verbose)
+            if self.denormalization_incremental:
+                self.set_watermark(client, start)
+        else:
+            denormalize(db.works)
+
+        if self.network_engine == "global":
+            # Creating the networks of coauthorship for affiliations and authors from a single pass over works
+            print("INFO: Creating affiliations and authors networks")
+            network_creation_global(
+                db,
+                impactu_client[self.impactu_database_name],
+                self.author_count,
+                bulk_size=self.bulk_size,
+                verbose=self.verbose)
+        else:
+            # Getting the list of institutions ids with works
+            print("INFO: Getting authors and affiliations ids")
+            institutions_ids = []
+            for aff in db["affiliations"].find({"types.type": {"$nin": ["faculty", "department", "group"]}}, {"_id": 1}):
+                count = db["works"].count_documents(
+                    {"authors.affiliations.id": aff["_id"]})
+                if count != 0:
+                    institutions_ids.append(aff["_id"])
+
+            # Creating the networks of coauthorship for each affiliation
+            print("INFO: Creating affiliations networks")
+            if institutions_ids:
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=10,
+                    backend=self.backend,
+                    batch_size=self.task_batch_size)(
+                        delayed(network_creation_process_one)(
+                            self.config,
+                            client if self.backend == "threading" else None,
+                            impactu_client if self.backend == "threading" else None,
+                            idx,
+                            self.author_count,
+                            "affiliations",
+                            self.backend
+                        ) for idx in institutions_ids)
+
+            # Getting the list of authors ids with works
+            print("INFO: Checking authors with works")
+            authors_ids = [x["_id"] for x in db["person"].find({}, {"_id": 1})]
+
+            # this could be threads, is a basic thing.
+            authors_ids = Parallel(n_jobs=self.n_jobs, backend="threading", verbose=1)(
+                delayed(count_works_one)(
+                    db,
+                    author
+                ) for author in authors_ids)
+
+            # remove Nones
+            authors_ids = [x for x in authors_ids if x is not None]
+
+            print(f"INFO: total authors {len(authors_ids)}")
+            # Creating the networks of coauthorship for each author
+            print("INFO: Creating authors networks")
+            if authors_ids:
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=10,
+                    backend=self.backend,
+                    batch_size=self.task_batch_size)(
+                        delayed(network_creation_process_one)(
+                            self.config,
+                            client if self.backend == "threading" else None,
+                            impactu_client if self.backend == "threading" else None,
+                            idx,
+                            self.author_count,
+                            "person",
+                            self.backend
+                        ) for idx in authors_ids)
+        if self.lemmas_cache:
+            # Lemmatizing the titles of the works only once for all the top words
+            print("INFO: Lemmatizing works titles")
+            lemmatize_works(
+                db,
+                impactu_client[self.impactu_database_name],
+                self.es_model,
+                self.en_model,
+                self.stopwords,
+                batch_size=self.nlp_batch_size,
+                n_process=self.nlp_n_process,
+                verbose=self.verbose)
+
         # Getting the top words for each institution
         print("INFO: Creating top words for institutions")
         affiliations_cursor = list(db["affiliations"].find({}, {"_id": 1}))
         Parallel(
             n_jobs=self.n_jobs,
             verbose=10,
-            backend=self.backend)(
+            backend=self.backend,
+            batch_size=self.task_batch_size)(
                 delayed(top_words_process_one)(
                     self.config,
                     client if self.backend == "threading" else None,
@@ -160,7 +241,8 @@ class Kahi_impactu_postcalculations(KahiBase):
                     aff,
                     self.stopwords,
                     "affiliations",
-                    self.backend
+                    self.backend,
+                    self.lemmas_cache
                 ) for aff in affiliations_cursor)
 
         # Getting the top words for others organizations
@@ -170,7 +252,8 @@ class Kahi_impactu_postcalculations(KahiBase):
         Parallel(
             n_jobs=self.n_jobs,
             verbose=10,
-            backend=self.backend)(
+            backend=self.backend,
+            batch_size=self.task_batch_size)(
                 delayed(top_words_process_one)(
                     self.config,
                     client if self.backend == "threading" else None,
@@ -178,7 +261,8 @@ class Kahi_impactu_postcalculations(KahiBase):
                     aff,
                     self.stopwords,
                     "affiliations",
-                    self.backend
+                    self.backend,
+                    self.lemmas_cache
                 ) for aff in affiliations_cursor)
 
         # Getting the top words for each author
@@ -188,7 +272,8 @@ class Kahi_impactu_postcalculations(KahiBase):
         Parallel(
             n_jobs=self.n_jobs,
             verbose=10,
-            backend=self.backend)(
+            backend=self.backend,
+            batch_size=self.task_batch_size)(
                 delayed(top_words_process_one)(
                     self.config,
                     client if self.backend == "threading" else None,
@@ -196,5 +281,6 @@ class Kahi_impactu_postcalculations(KahiBase):
                     author,
                     self.stopwords,
                     "person",
-                    self.backend
+                    self.backend,
+                    self.lemmas_cache
                 ) for author in authors_cursor)
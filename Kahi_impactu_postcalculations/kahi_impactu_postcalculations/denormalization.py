@@ -1,4 +1,8 @@
-def set_works_authors_affiliations_country(collection):  # type: ignore
+from joblib import Parallel, delayed
+from time import time
+
+
+def set_works_authors_affiliations_country(collection, match=None):  # type: ignore
     """
     Method to set the country of the affiliations of the authors of the works
 
@@ -6,6 +10,8 @@ def set_works_authors_affiliations_country(collection):  # type: ignore
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    match : dict
+        Filter of the works to update, all the works if None
     """
     pipeline = [
         {
@@ -90,10 +96,12 @@ def set_works_authors_affiliations_country(collection):  # type: ignore
             }
         },
     ]
-    collection.aggregate(pipeline)  # works collections
+    if match:
+        pipeline.insert(0, {"$match": match})
+    collection.aggregate(pipeline, allowDiskUse=True)  # works collections
 
 
-def set_works_authors_affiliations_country_code(collection):  # type: ignore
+def set_works_authors_affiliations_country_code(collection, match=None):  # type: ignore
     """
     Method to set the country code of the affiliations of the authors of the works
 
@@ -101,6 +109,8 @@ def set_works_authors_affiliations_country_code(collection):  # type: ignore
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    match : dict
+        Filter of the works to update, all the works if None
     """
     pipeline = [
         {
@@ -185,10 +195,12 @@ def set_works_authors_affiliations_country_code(collection):  # type: ignore
             }
         },
     ]
-    collection.aggregate(pipeline)
+    if match:
+        pipeline.insert(0, {"$match": match})
+    collection.aggregate(pipeline, allowDiskUse=True)
 
 
-def set_works_groups_ranking(collection):  # type: ignore
+def set_works_groups_ranking(collection, match=None):  # type: ignore
     """
     Function to set the ranking of the groups of the works
 
@@ -196,6 +208,8 @@ def set_works_groups_ranking(collection):  # type: ignore
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    match : dict
+        Filter of the works to update, all the works if None
     """
     pipeline = [
         {
@@ -284,10 +298,12 @@ def set_works_groups_ranking(collection):  # type: ignore
             }
         },
     ]
-    collection.aggregate(pipeline)
+    if match:
+        pipeline.insert(0, {"$match": match})
+    collection.aggregate(pipeline, allowDiskUse=True)
 
 
-def set_works_authors_ranking(collection):  # type: ignore
+def set_works_authors_ranking(collection, match=None):  # type: ignore
     """
     Function to set the ranking of the authors
 
@@ -295,6 +311,8 @@ def set_works_authors_ranking(collection):  # type: ignore
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    match : dict
+        Filter of the works to update, all the works if None
     """
     pipeline = [
         {
@@ -383,7 +401,9 @@ def set_works_authors_ranking(collection):  # type: ignore
             }
         },
     ]
-    collection.aggregate(pipeline)
+    if match:
+        pipeline.insert(0, {"$match": match})
+    collection.aggregate(pipeline, allowDiskUse=True)
 
 
 def denormalize(colletion):
@@ -399,3 +419,135 @@ def denormalize(colletion):
     set_works_authors_affiliations_country_code(colletion)
     set_works_groups_ranking(colletion)
     set_works_authors_ranking(colletion)
+
+
+def id_ranges(collection, n_ranges):
+    """
+    Split the collection in ranges of _id with about the same number of documents
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection to split
+    n_ranges : int
+        Number of ranges
+
+    Returns
+    -------
+    list
+        Disjoint filters of the ranges ({"_id": {"$gte": min, "$lt": max}}, the last one with $lte)
+    """
+    buckets = list(collection.aggregate([
+        {"$project": {"_id": 1}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": n_ranges}}
+    ], allowDiskUse=True))
+    ranges = []
+    for i, bucket in enumerate(buckets):
+        # the max of a bucket is the min of the next one, only the last bucket includes its max
+        upper = "$lte" if i == len(buckets) - 1 else "$lt"
+        ranges.append(
+            {"_id": {"$gte": bucket["_id"]["min"], upper: bucket["_id"]["max"]}})
+    return ranges
+
+
+def changed_since(db, last):
+    """
+    Get the filters of the works to denormalize again in incremental mode,
+    the works with affiliations, groups or authors updated after the last run
+    and the works updated after the last run
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database with the works, affiliations and person collections
+    last : int
+        Time of the last run
+
+    Returns
+    -------
+    dict
+        Filters by denormalization function name
+    """
+    affiliations = db["affiliations"].distinct(
+        "_id", {"updated.time": {"$gt": last}})
+    authors = db["person"].distinct("_id", {"updated.time": {"$gt": last}})
+    works = {"updated.time": {"$gt": last}}
+    return {
+        "set_works_authors_affiliations_country": {"$or": [works, {"authors.affiliations.id": {"$in": affiliations}}]},
+        "set_works_authors_affiliations_country_code": {"$or": [works, {"authors.affiliations.id": {"$in": affiliations}}]},
+        "set_works_groups_ranking": {"$or": [works, {"groups.id": {"$in": affiliations}}]},
+        "set_works_authors_ranking": {"$or": [works, {"authors.id": {"$in": authors}}]},
+    }
+
+
+def denormalize_range(collection, id_range, matches=None, verbose=0):
+    """
+    Run the denormalization pipelines over a range of _id of the works,
+    the pipelines of a range are run one after the other because some of them update the same fields
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection to denormalize
+    id_range : dict
+        Filter of the range of _id
+    matches : dict
+        Filters of the incremental mode by denormalization function name, all the works of the range if None
+    verbose : int
+        Verbosity level
+
+    Returns
+    -------
+    float
+        Seconds used to denormalize the range
+    """
+    start = time()
+    for function in [set_works_authors_affiliations_country, set_works_authors_affiliations_country_code,
+                     set_works_groups_ranking, set_works_authors_ranking]:
+        match = id_range
+        if matches is not None:
+            match = {"$and": [id_range, matches[function.__name__]]}
+        function(collection, match)
+    elapsed = time() - start
+    if verbose > 0:
+        print(f"INFO: denormalization of works with {id_range} done in {elapsed:.1f} s")
+    return elapsed
+
+
+def denormalize_parallel(db, n_ranges, n_jobs, last=None, verbose=0):
+    """
+    Denormalize the works splitting the collection in ranges of _id, the ranges are processed in parallel
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database with the works, affiliations and person collections
+    n_ranges : int
+        Number of ranges of _id
+    n_jobs : int
+        Number of ranges processed at the same time
+    last : int
+        Time of the last run, if given only the works with affiliations, groups or authors
+        updated after it (or updated themselves) are denormalized again
+    verbose : int
+        Verbosity level
+    """
+    start = time()
+    ranges = id_ranges(db["works"], n_ranges)
+    matches = changed_since(db, last) if last else None
+    if matches is not None and verbose > 0:
+        print(f"INFO: incremental denormalization of the works changed after {last}")
+    times = Parallel(
+        n_jobs=n_jobs,
+        verbose=verbose,
+        backend="threading")(
+        delayed(denormalize_range)(
+            db["works"],
+            id_range,
+            matches,
+            verbose
+        ) for id_range in ranges
+    )
+    if verbose > 0 and times:
+        print(f"INFO: denormalization of {len(ranges)} ranges done in {time() - start:.1f} s "
+              f"(range min {min(times):.1f} s, max {max(times):.1f} s)")
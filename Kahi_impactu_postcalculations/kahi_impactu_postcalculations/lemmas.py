@@ -0,0 +1,188 @@
+from time import time
+from hashlib import md5
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+# pipeline components not needed to get the lemmas
+disabled_components = ["parser", "ner", "senter"]
+
+
+def filter_lemmas(doc, stopwords):
+    """
+    Function to get the lemmas of a processed title that are useful as top words.
+
+    Parameters:
+    ----------
+    doc : spacy.tokens.Doc
+        The processed title.
+    stopwords : set
+        The set of stopwords to ignore.
+
+    Returns:
+    -------
+    list
+        The lemmas of the title without numbers, stopwords and short words.
+    """
+    lemmas = []
+    for token in doc:
+        if token.lemma_.isnumeric():
+            continue
+        if token.lemma_ in stopwords:
+            continue
+        if len(token.lemma_) < 4:
+            continue
+        lemmas.append(token.lemma_)
+    return lemmas
+
+
+def title_hash(title, lang):
+    """
+    Function to get the hash of a title saved with its lemmas, the lemmas are computed
+    again when the title (or the model used for its language) changes.
+    """
+    return md5((lang + ":" + title).encode("utf-8")).hexdigest()
+
+
+def pending_titles(db_in, db_out, query, chunk_size, lang):
+    """
+    Generator of the titles of the works that are not lemmatized yet or whose title changed.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the lemmas are stored.
+    query : dict
+        Query to select the works.
+    chunk_size : int
+        Number of works checked against the cache at once.
+    lang : str
+        The language group of the query (es or others).
+
+    Yields:
+    ------
+    tuple
+        (lower case title, (work id, title hash))
+    """
+    chunk = []
+    for work in db_in["works"].find(query, {"titles.title": 1, "titles.lang": 1}, no_cursor_timeout=True):
+        chunk.append(work)
+        if len(chunk) >= chunk_size:
+            yield from pending_chunk(db_out, chunk, lang)
+            chunk = []
+    if chunk:
+        yield from pending_chunk(db_out, chunk, lang)
+
+
+def pending_chunk(db_out, chunk, lang):
+    """
+    Generator of the titles of a chunk of works that are not in the lemmas cache,
+    or that are in the cache with the lemmas of a different title.
+    """
+    cached = {}
+    for reg in db_out["works_lemmas"].find(
+            {"_id": {"$in": [work["_id"] for work in chunk]}}, {"title_hash": 1}):
+        cached[reg["_id"]] = reg.get("title_hash")
+    for work in chunk:
+        title = work["titles"][0]["title"].lower()
+        thash = title_hash(title, lang)
+        if cached.get(work["_id"]) == thash:
+            continue
+        yield (title, (work["_id"], thash))
+
+
+def save_lemmas(db_out, records):
+    """
+    Function to save a batch of lemmas in the cache, replacing the stale records.
+    """
+    if not records:
+        return
+    try:
+        db_out["works_lemmas"].bulk_write(
+            [ReplaceOne({"_id": record["_id"]}, record, upsert=True) for record in records], ordered=False)
+    except BulkWriteError as bwe:
+        print("ERROR: saving lemmas", bwe.details["writeErrors"][0]["errmsg"])
+
+
+def lemmatize_works(db_in, db_out, es_model, en_model, stopwords, batch_size=1000, n_process=1, verbose=0):
+    """
+    Function to lemmatize the title of every work only once, the filtered lemmas are saved
+    in the collection works_lemmas of the calculation database with the work id as _id
+    and the hash of the title, the works already in the collection are not processed again
+    unless their title changed.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the lemmas will be stored.
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The set of stopwords to ignore.
+    batch_size : int
+        Number of titles processed by spaCy in each batch.
+    n_process : int
+        Number of processes used by spaCy.
+    verbose : int
+        The verbosity level.
+    """
+    for lang, model, query in [
+        ("es", es_model, {"titles.0.lang": "es", "titles.title": {"$exists": 1}}),
+        ("others", en_model, {"titles.0.lang": {
+         "$ne": "es"}, "titles.title": {"$exists": 1}}),
+    ]:
+        start = time()
+        count = 0
+        records = []
+        disable = [c for c in disabled_components if c in model.pipe_names]
+        for doc, (work_id, thash) in model.pipe(
+                pending_titles(db_in, db_out, query, batch_size, lang),
+                as_tuples=True,
+                batch_size=batch_size,
+                n_process=n_process,
+                disable=disable):
+            records.append(
+                {"_id": work_id, "lemmas": filter_lemmas(doc, stopwords), "title_hash": thash})
+            count += 1
+            if len(records) >= batch_size:
+                save_lemmas(db_out, records)
+                records = []
+        save_lemmas(db_out, records)
+        if verbose > 0:
+            print(
+                f"INFO: {count} titles lemmatized for lang {lang} in {time() - start:.2f} s")
+
+
+def count_lemmas(db_out, works_ids, chunk_size=10000):
+    """
+    Function to merge the cached lemmas of a list of works.
+
+    Parameters:
+    ----------
+    db_out : pymongo.database.Database (calculation database)
+        The database where the lemmas are stored.
+    works_ids : list
+        The works identifiers, a work repeated in the list is counted as many times as it appears.
+    chunk_size : int
+        Number of works requested at once.
+
+    Returns:
+    -------
+    dict
+        lemma -> number of occurrences
+    """
+    times = {}
+    for work_id in works_ids:
+        times[work_id] = times.get(work_id, 0) + 1
+    ids = list(times.keys())
+    results = {}
+    for i in range(0, len(ids), chunk_size):
+        for reg in db_out["works_lemmas"].find({"_id": {"$in": ids[i:i + chunk_size]}}):
+            for lemma in reg["lemmas"]:
+                results[lemma] = results.get(lemma, 0) + times[reg["_id"]]
+    return results
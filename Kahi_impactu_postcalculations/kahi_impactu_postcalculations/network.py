@@ -0,0 +1,348 @@
+from math import log, exp
+from array import array
+from time import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DocumentTooLarge
+
+
+def new_graph():
+    """
+    Function to create an empty co-occurrence graph.
+
+    The graph maps every entity identifier (ObjectId) to a compact integer index,
+    the weighted adjacency is stored as a list of dicts keyed by those integers.
+    The nodes of the works with more than one entity and the works of every node are
+    also kept, they are needed to discount the works of an entity from the coauthorships
+    among its neighbors (see ego_network).
+
+    Returns:
+    -------
+    dict
+        graph with the keys ids, index, labels, adjacency, works and node_works.
+    """
+    return {
+        "ids": [],
+        "index": {},
+        "labels": [],
+        "adjacency": [],
+        "works": [],
+        "node_works": []
+    }
+
+
+def graph_node(graph, idx, label):
+    """
+    Function to get (or create) the integer index of an entity in the graph.
+
+    Parameters:
+    ----------
+    graph : dict
+        The graph created with new_graph.
+    idx : ObjectId
+        The entity identifier.
+    label : str
+        The name of the entity, only used the first time the entity is seen.
+
+    Returns:
+    -------
+    int
+        The integer index of the entity.
+    """
+    node = graph["index"].get(idx)
+    if node is None:
+        node = len(graph["ids"])
+        graph["index"][idx] = node
+        graph["ids"].append(idx)
+        graph["labels"].append(label)
+        graph["adjacency"].append({})
+        graph["node_works"].append(array("l"))
+    return node
+
+
+def add_work_nodes(graph, work_nodes):
+    """
+    Function to add the co-occurrences of one work to the graph.
+    Every unordered pair of distinct nodes in the work adds one coauthorship.
+
+    Parameters:
+    ----------
+    graph : dict
+        The graph created with new_graph.
+    work_nodes : list
+        Integer indexes of the entities in the work (without duplicates).
+    """
+    if len(work_nodes) < 2:
+        return
+    work = len(graph["works"])
+    graph["works"].append(tuple(work_nodes))
+    for node in work_nodes:
+        graph["node_works"][node].append(work)
+    adjacency = graph["adjacency"]
+    for i, nodea in enumerate(work_nodes):
+        for nodeb in work_nodes[i + 1:]:
+            adjacency[nodea][nodeb] = adjacency[nodea].get(nodeb, 0) + 1
+            adjacency[nodeb][nodea] = adjacency[nodeb].get(nodea, 0) + 1
+
+
+def build_graphs(db_in, author_count, verbose=0):
+    """
+    Function to build the global coauthorship graphs for persons and affiliations
+    streaming the works collection only once.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    author_count : int
+        The maximum number of authors in a work to consider.
+    verbose : int
+        The verbosity level.
+
+    Returns:
+    -------
+    tuple
+        (person graph, affiliations graph)
+    """
+    person_graph = new_graph()
+    affiliations_graph = new_graph()
+    works_count = 0
+    start = time()
+    cursor = db_in["works"].find(
+        {"author_count": {"$lte": author_count}},
+        {"authors.id": 1, "authors.full_name": 1,
+         "authors.affiliations.id": 1, "authors.affiliations.name": 1},
+        no_cursor_timeout=True, batch_size=10000)
+    try:
+        for work in cursor:
+            works_count += 1
+            person_nodes = []
+            affiliation_nodes = []
+            for author in work["authors"]:
+                if author.get("id"):
+                    node = graph_node(
+                        person_graph, author["id"], author.get("full_name", ""))
+                    if node not in person_nodes:
+                        person_nodes.append(node)
+                for aff in author.get("affiliations", []):
+                    if not aff.get("id"):
+                        continue
+                    node = graph_node(
+                        affiliations_graph, aff["id"], aff.get("name", ""))
+                    if node not in affiliation_nodes:
+                        affiliation_nodes.append(node)
+            add_work_nodes(person_graph, person_nodes)
+            add_work_nodes(affiliations_graph, affiliation_nodes)
+            if verbose > 4 and works_count % 1000000 == 0:
+                print(f"INFO: {works_count} works processed for networks")
+    finally:
+        cursor.close()
+    if verbose > 0:
+        print(f"INFO: networks graph built from {works_count} works in {time() - start:.2f} s, "
+              f"{len(person_graph['ids'])} persons and {len(affiliations_graph['ids'])} affiliations")
+    return person_graph, affiliations_graph
+
+
+def ego_network(graph, node, label=None):
+    """
+    Function to extract the coauthorship network of an entity from the global graph.
+    The network has the entity, its coauthors and the coauthorships among all of them,
+    as in the legacy engine the coauthorships between two coauthors only count the works
+    without the entity, so the works of the entity are discounted from the global counts.
+
+    Parameters:
+    ----------
+    graph : dict
+        The graph created with build_graphs.
+    node : int
+        The integer index of the entity.
+    label : str
+        Label for the entity, if None the name found in the works is used.
+
+    Returns:
+    -------
+    dict
+        The network with the keys nodes and edges in the format stored in the database.
+    """
+    adjacency = graph["adjacency"]
+    nodes = [node] + list(adjacency[node].keys())
+    nodes_set = set(nodes)
+    # coauthorships among the neighbors in the works of the entity
+    ego_pairs = {}
+    for work in graph["node_works"][node]:
+        work_nodes = [n for n in graph["works"][work] if n != node]
+        for i, nodea in enumerate(work_nodes):
+            for nodeb in work_nodes[i + 1:]:
+                pair = (nodea, nodeb) if nodea < nodeb else (nodeb, nodea)
+                ego_pairs[pair] = ego_pairs.get(pair, 0) + 1
+    edges = [(node, neighbor, count)
+             for neighbor, count in adjacency[node].items()]
+    for neighbor in nodes[1:]:
+        for other, count in adjacency[neighbor].items():
+            if other == node or other not in nodes_set:
+                continue
+            if neighbor < other:
+                count -= ego_pairs.get((neighbor, other), 0)
+                if count > 0:
+                    edges.append((neighbor, other, count))
+    degree = {}
+    for nodea, nodeb, _ in edges:
+        degree[nodea] = degree.get(nodea, 0) + 1
+        degree[nodeb] = degree.get(nodeb, 0) + 1
+
+    num_nodes = len(nodes)
+    nodes_db = []
+    for n in nodes:
+        size = 50 * log(1 + degree.get(n, 0) / (num_nodes - 1),
+                        2) if num_nodes > 1 else 1
+        nodes_db.append(
+            {
+                "id": str(graph["ids"][n]),
+                "label": label if n == node and label is not None else graph["labels"][n],
+                "degree": degree.get(n, 0),
+                "size": size
+            }
+        )
+    edges_db = []
+    for nodea, nodeb, coauthorships in edges:
+        edges_db.append({
+            "source": str(graph["ids"][nodea]),
+            "target": str(graph["ids"][nodeb]),
+            "coauthorships": coauthorships,
+            "size": coauthorships,
+        })
+    top = max([e["coauthorships"]
+              for e in edges_db]) if len(edges_db) > 0 else 1
+    bot = min([e["coauthorships"]
+              for e in edges_db]) if len(edges_db) > 0 else 1
+    for edge in edges_db:
+        if abs(top - edge["coauthorships"]) < 0.01:
+            edge["size"] = 10
+        elif abs(bot - edge["coauthorships"]) < 0.01:
+            edge["size"] = 1
+        else:
+            size = 10 / (1 + exp(6 - 10 * edge["coauthorships"] / top))
+            edge["size"] = size if size >= 1 else 1
+    return {"nodes": nodes_db, "edges": edges_db}
+
+
+def bulk_upsert(collection, requests):
+    """
+    Function to write a batch of upserts, reporting the records that could not be saved
+    (ex: networks too big for a MongoDB document) without stopping the rest of the batch.
+
+    Parameters:
+    ----------
+    collection : pymongo.collection.Collection
+        The collection where the records are written.
+    requests : list
+        List of pymongo.UpdateOne operations.
+    """
+    if not requests:
+        return
+    try:
+        collection.bulk_write(requests, ordered=False)
+    except DocumentTooLarge:
+        # one of the networks is too big, saving one by one to keep the others
+        for request in requests:
+            try:
+                collection.bulk_write([request])
+            except (BulkWriteError, DocumentTooLarge) as e:
+                print(f"ERROR: too big network in {collection.name}", e)
+    except BulkWriteError as bwe:
+        for error in bwe.details["writeErrors"]:
+            idx = error["op"]["q"]["_id"] if "op" in error.keys() else None
+            print(
+                f"ERROR: network for id {idx} could not be saved in {collection.name}", error["errmsg"])
+
+
+def network_creation_global(db_in, db_out, author_count, bulk_size=1000, verbose=0):
+    """
+    Function to create the networks of coauthorships for all the affiliations and authors
+    from a global graph built in a single pass over the works collection.
+
+    The records are written with the same format of network_creation_affiliations and
+    network_creation_person, the entities that already have a network are skipped,
+    as well as the authors that are not in the person collection.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the information will be stored.
+    author_count : int
+        The maximum number of authors in a work to consider.
+    bulk_size : int
+        Number of records per bulk write.
+    verbose : int
+        The verbosity level.
+    """
+    person_graph, affiliations_graph = build_graphs(
+        db_in, author_count, verbose=verbose)
+
+    # institutions names and units (faculty, department, group do not have network)
+    institutions_labels = {}
+    for aff in db_in["affiliations"].find({}, {"names": 1, "types": 1}):
+        types = [t["type"] for t in aff.get("types", [])]
+        if "faculty" in types or "department" in types or "group" in types:
+            continue
+        name = aff["names"][0]["name"] if aff.get("names") else ""
+        for n in aff.get("names", []):
+            if n["lang"] == "es":
+                name = n["name"]
+                break
+            elif n["lang"] == "en":
+                name = n["name"]
+        institutions_labels[aff["_id"]] = name
+
+    print("INFO: Saving affiliations networks")
+    already = set(x["_id"] for x in db_out["affiliations"].find(
+        {"coauthorship_network": {"$exists": True}}, {"_id": 1}))
+    requests = []
+    requests_edges = []
+    count = 0
+    for node, idx in enumerate(affiliations_graph["ids"]):
+        if idx not in institutions_labels or idx in already:
+            continue
+        network = ego_network(
+            affiliations_graph, node, label=institutions_labels[idx])
+        nedges = int(len(network["edges"]) / 2)
+        requests.append(UpdateOne({"_id": idx}, {"$set": {"coauthorship_network": {
+            "nodes": network["nodes"], "edges": network["edges"][0:nedges]}}}, upsert=True))
+        requests_edges.append(UpdateOne({"_id": idx}, {"$set": {"coauthorship_network": {
+            "edges": network["edges"][nedges:]}}}, upsert=True))
+        count += 1
+        if len(requests) >= bulk_size:
+            bulk_upsert(db_out["affiliations"], requests)
+            bulk_upsert(db_out["affiliations_edges"], requests_edges)
+            requests = []
+            requests_edges = []
+    bulk_upsert(db_out["affiliations"], requests)
+    bulk_upsert(db_out["affiliations_edges"], requests_edges)
+    if verbose > 0:
+        print(f"INFO: {count} affiliations networks saved")
+
+    print("INFO: Saving authors networks")
+    already = set(x["_id"] for x in db_out["person"].find(
+        {"coauthorship_network": {"$exists": True}}, {"_id": 1}))
+    pending = [node for node, idx in enumerate(
+        person_graph["ids"]) if idx not in already]
+    count = 0
+    for i in range(0, len(pending), bulk_size):
+        chunk = pending[i:i + bulk_size]
+        # the label of the author is the name in the person collection, as in the legacy engine
+        names = {}
+        for person in db_in["person"].find({"_id": {"$in": [person_graph["ids"][node] for node in chunk]}}, {"full_name": 1}):
+            names[person["_id"]] = person.get("full_name", "")
+        requests = []
+        for node in chunk:
+            idx = person_graph["ids"][node]
+            if idx not in names.keys():
+                continue
+            network = ego_network(person_graph, node, label=names[idx])
+            requests.append(UpdateOne({"_id": idx}, {"$set": {
+                            "coauthorship_network": network}}, upsert=True))
+            count += 1
+        bulk_upsert(db_out["person"], requests)
+    if verbose > 0:
+        print(f"INFO: {count} authors networks saved")
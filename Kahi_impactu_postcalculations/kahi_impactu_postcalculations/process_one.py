@@ -1,6 +1,7 @@
 from math import log, exp
 from pymongo import MongoClient
 from spacy import load
+from kahi_impactu_postcalculations.lemmas import count_lemmas
 
 # for multiprocessing have to be loaded global
 en_model = None
@@ -16,6 +17,35 @@ def load_nlp_models():
         es_model = load('es_core_news_sm')
 
 
+# for multiprocessing the database clients are created once in every worker process
+worker_databases = None
+
+
+def get_worker_databases(config):
+    """
+    Function to get the databases of the current worker process, the clients are created
+    the first time the function is called and they are reused by all the tasks of the process.
+
+    Parameters:
+    ----------
+    config : dict
+        The configuration dictionary.
+
+    Returns:
+    -------
+    tuple
+        (kahi database, calculation database)
+    """
+    global worker_databases
+    if worker_databases is None:
+        client = MongoClient(config["database_url"])
+        impactu_client = MongoClient(
+            config["impactu_postcalculations"]["database_url"])
+        worker_databases = (client[config["database_name"]],
+                            impactu_client[config["impactu_postcalculations"]["database_name"]])
+    return worker_databases
+
+
 def count_works_one(db, author_id):
     """
     Count the number of works for an author.
@@ -55,10 +85,10 @@ def network_creation_process_one(config, client, impactu_client, idx, author_cou
         The backend to use for the parallel processing. "mutiprocessing" or "threading".
     """
     if backend != "threading":
-        client = MongoClient(config["database_url"])
+        # the clients live as long as the worker process
+        db_in, db_out = get_worker_databases(config)
+    else:
         db_in = client[config["database_name"]]
-        impactu_client = MongoClient(
-            config["impactu_postcalculations"]["database_url"])
         db_out = impactu_client[config["impactu_postcalculations"]
                                 ["database_name"]]
     if net not in ["affiliations", "person"]:
@@ -70,10 +100,6 @@ def network_creation_process_one(config, client, impactu_client, idx, author_cou
     if net == "person":
         network_creation_person(db_in, db_out, idx, author_count)
 
-    if backend != "threading":
-        client.close()
-        impactu_client.close()
-
 
 def network_creation_affiliations(db_in, db_out, idx, author_count):
     """
@@ -366,7 +392,7 @@ def network_creation_person(db_in, db_out, idx, author_count):
         "nodes": nodes_db, "edges": edges_db}}}, upsert=True)
 
 
-def top_words_process_one(config, client, impactu_client, aff, stopwords, top_words, backend):
+def top_words_process_one(config, client, impactu_client, aff, stopwords, top_words, backend, cached=False):
     """
     Function to create the network of coauthorships for an affiliation or author.
 
@@ -386,14 +412,18 @@ def top_words_process_one(config, client, impactu_client, aff, stopwords, top_wo
         The network type, either affiliations or authors.
     backend : str
         The backend to use for the parallel processing. "mutiprocessing" or "threading".
+    cached : bool
+        If True the lemmas are taken from the works_lemmas collection (see lemmas.lemmatize_works).
     """
     global en_model
     global es_model
     if backend != "threading":
-        client = MongoClient(config["database_url"])
+        # the clients and the models live as long as the worker process
+        db_in, db_out = get_worker_databases(config)
+        if not cached:
+            load_nlp_models()
+    else:
         db_in = client[config["database_name"]]
-        impactu_client = MongoClient(
-            config["impactu_postcalculations"]["database_url"])
         db_out = impactu_client[config["impactu_postcalculations"]
                                 ["database_name"]]
     if top_words not in ["affiliations", "affiliations_others", "person"]:
@@ -403,18 +433,16 @@ def top_words_process_one(config, client, impactu_client, aff, stopwords, top_wo
 
     if top_words == "affiliations":
         top_words_affiliations(
-            db_in, db_out, aff, es_model, en_model, stopwords)
+            db_in, db_out, aff, es_model, en_model, stopwords, cached=cached)
     if top_words == "affiliations_others":
         top_words_affiliations_others(
-            db_in, db_out, aff, es_model, en_model, stopwords)
+            db_in, db_out, aff, es_model, en_model, stopwords, cached=cached)
     if top_words == "person":
-        top_words_person(db_in, db_out, aff, es_model, en_model, stopwords)
-    if backend != "threading":
-        client.close()
-        impactu_client.close()
+        top_words_person(db_in, db_out, aff, es_model,
+                         en_model, stopwords, cached=cached)
 
 
-def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords):
+def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords, cached=False):
     """
     Function to get the top words for an affiliation.
 
@@ -434,31 +462,37 @@ def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords):
         The English model for the NLP.
     stopwords : list
         The list of stopwords to ignore.
+    cached : bool
+        If True the lemmas are taken from the works_lemmas collection instead of using the models.
     """
     aff_db = db_out["affiliations"].find_one(
         {"_id": aff["_id"], "top_words": {"$exists": 1}})
     if aff_db:
         return
-    results = {}
-    for work in db_in["works"].find({"authors.affiliations.id": aff["_id"], "titles.title": {"$exists": 1}}, {"titles": 1}):
-        title = work["titles"][0]["title"].lower()
-        lang = work["titles"][0]["lang"]
-        if lang == "es":
-            model = es_model
-        else:
-            model = en_model
-        title = model(title)
-        for token in title:
-            if token.lemma_.isnumeric():
-                continue
-            if token.lemma_ in stopwords:
-                continue
-            if len(token.lemma_) < 4:
-                continue
-            if token.lemma_ in results.keys():
-                results[token.lemma_] += 1
+    if cached:
+        results = count_lemmas(db_out, [work["_id"] for work in db_in["works"].find(
+            {"authors.affiliations.id": aff["_id"], "titles.title": {"$exists": 1}}, {"_id": 1})])
+    else:
+        results = {}
+        for work in db_in["works"].find({"authors.affiliations.id": aff["_id"], "titles.title": {"$exists": 1}}, {"titles": 1}):
+            title = work["titles"][0]["title"].lower()
+            lang = work["titles"][0]["lang"]
+            if lang == "es":
+                model = es_model
             else:
-                results[token.lemma_] = 1
+                model = en_model
+            title = model(title)
+            for token in title:
+                if token.lemma_.isnumeric():
+                    continue
+                if token.lemma_ in stopwords:
+                    continue
+                if len(token.lemma_) < 4:
+                    continue
+                if token.lemma_ in results.keys():
+                    results[token.lemma_] += 1
+                else:
+                    results[token.lemma_] = 1
     topN = sorted(results.items(), key=lambda x: x[1], reverse=True)[:20]
     results = []
     for top in topN:
@@ -472,7 +506,7 @@ def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords):
             {"_id": aff["_id"], "top_words": results})
 
 
-def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwords):
+def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwords, cached=False):
     """
     Function to get the top words for an affiliation for other than institutions, such as group, department, faculty.
 
@@ -492,31 +526,40 @@ def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwo
         The English model for the NLP.
     stopwords : list
         The list of stopwords to ignore.
+    cached : bool
+        If True the lemmas are taken from the works_lemmas collection instead of using the models.
     """
     aff_db = db_out["affiliations"].find_one(
         {"_id": aff["_id"], "top_words": {"$exists": 1}})
     if aff_db:
-        results = {}
-        for author in db_in["person"].find({"affiliations.id": aff["_id"]}):
-            for work in db_in["works"].find({"authors.id": author["_id"], "titles.title": {"$exists": 1}}):
-                title = work["titles"][0]["title"].lower()
-                lang = work["titles"][0]["lang"]
-                if lang == "es":
-                    model = es_model
-                else:
-                    model = en_model
-                title = model(title)
-                for token in title:
-                    if token.lemma_.isnumeric():
-                        continue
-                    if token.lemma_ in stopwords:
-                        continue
-                    if len(token.lemma_) < 4:
-                        continue
-                    if token.lemma_ in results.keys():
-                        results[token.lemma_] += 1
+        if cached:
+            works_ids = []
+            for author in db_in["person"].find({"affiliations.id": aff["_id"]}, {"_id": 1}):
+                works_ids.extend([work["_id"] for work in db_in["works"].find(
+                    {"authors.id": author["_id"], "titles.title": {"$exists": 1}}, {"_id": 1})])
+            results = count_lemmas(db_out, works_ids)
+        else:
+            results = {}
+            for author in db_in["person"].find({"affiliations.id": aff["_id"]}):
+                for work in db_in["works"].find({"authors.id": author["_id"], "titles.title": {"$exists": 1}}):
+                    title = work["titles"][0]["title"].lower()
+                    lang = work["titles"][0]["lang"]
+                    if lang == "es":
+                        model = es_model
                     else:
-                        results[token.lemma_] = 1
+                        model = en_model
+                    title = model(title)
+                    for token in title:
+                        if token.lemma_.isnumeric():
+                            continue
+                        if token.lemma_ in stopwords:
+                            continue
+                        if len(token.lemma_) < 4:
+                            continue
+                        if token.lemma_ in results.keys():
+                            results[token.lemma_] += 1
+                        else:
+                            results[token.lemma_] = 1
         topN = sorted(results.items(), key=lambda x: x[1], reverse=True)[:20]
         results = []
         for top in topN:
@@ -525,7 +568,7 @@ def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwo
             {"_id": aff["_id"]}, {"$set": {"top_words": results}})
 
 
-def top_words_person(db_in, db_out, aff, es_model, en_model, stopwords):
+def top_words_person(db_in, db_out, aff, es_model, en_model, stopwords, cached=False):
     """
     Function to get the top words for an author.
 
@@ -545,31 +588,37 @@ def top_words_person(db_in, db_out, aff, es_model, en_model, stopwords):
         The English model for the NLP.
     stopwords : list
         The list of stopwords to ignore.
+    cached : bool
+        If True the lemmas are taken from the works_lemmas collection instead of using the models.
     """
     aff_db = db_out["person"].find_one(
         {"_id": aff["_id"], "top_words": {"$exists": 1}})
     if aff_db:
         return
-    results = {}
-    for work in db_in["works"].find({"authors.id": aff["_id"], "titles.title": {"$exists": 1}}, {"titles": 1}):
-        title = work["titles"][0]["title"].lower()
-        lang = work["titles"][0]["lang"]
-        if lang == "es":
-            model = es_model
-        else:
-            model = en_model
-        title = model(title)
-        for token in title:
-            if token.lemma_.isnumeric():
-                continue
-            if token.lemma_ in stopwords:
-                continue
-            if len(token.lemma_) < 4:
-                continue
-            if token.lemma_ in results.keys():
-                results[token.lemma_] += 1
+    if cached:
+        results = count_lemmas(db_out, [work["_id"] for work in db_in["works"].find(
+            {"authors.id": aff["_id"], "titles.title": {"$exists": 1}}, {"_id": 1})])
+    else:
+        results = {}
+        for work in db_in["works"].find({"authors.id": aff["_id"], "titles.title": {"$exists": 1}}, {"titles": 1}):
+            title = work["titles"][0]["title"].lower()
+            lang = work["titles"][0]["lang"]
+            if lang == "es":
+                model = es_model
             else:
-                results[token.lemma_] = 1
+                model = en_model
+            title = model(title)
+            for token in title:
+                if token.lemma_.isnumeric():
+                    continue
+                if token.lemma_ in stopwords:
+                    continue
+                if len(token.lemma_) < 4:
+                    continue
+                if token.lemma_ in results.keys():
+                    results[token.lemma_] += 1
+                else:
+                    results[token.lemma_] = 1
     topN = sorted(results.items(), key=lambda x: x[1], reverse=True)[:20]
     results = []
     for top in topN:
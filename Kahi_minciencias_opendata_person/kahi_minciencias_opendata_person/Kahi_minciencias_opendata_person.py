@@ -28,13 +28,23 @@ def parse_ids(product_id, regex, values):
     return ids
 
 
-def process_info_from_works(db, author, entry, groups_production_list):
+def process_info_from_works(db, author, entry, groups_production):
+    """
+    Adds the affiliations (groups and their institutions) and the related works of the products of an author.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        The kahi database.
+    author : dict
+        The author record with the id_persona_pr field.
+    entry : dict
+        The person record to update.
+    groups_production : dict
+        Index of the products of the groups by id_persona_pd.
+    """
     # Works
-    papers = []
-    for prod in groups_production_list:
-        if prod["_id"] == author["id_persona_pr"]:
-            papers = prod["products"]
-            break
+    papers = groups_production.get(author["id_persona_pr"], [])
     if papers:
         groups_cod = []
         inst_cod = []
@@ -148,7 +158,7 @@ def process_info_from_works(db, author, entry, groups_production_list):
                     {"provenance": "minciencias", "source": "scienti", "id": ids})
 
 
-def process_one(author_entry, db, collection, empty_person, cvlac_profile, groups_production_list, privates, verbose):
+def process_one(author_entry, db, collection, empty_person, cvlac_profile, groups_production, privates, verbose):
 
     if not author_entry or not cvlac_profile:
         return
@@ -232,7 +242,7 @@ def process_one(author_entry, db, collection, empty_person, cvlac_profile, group
                     reg_db["ranking"].append(entry_rank)
 
             # Affiliations and related_works
-            # process_info_from_works(db, author, reg_db, groups_production_list)
+            # process_info_from_works(db, author, reg_db, groups_production)
             # Update the record
             collection.update_one(
                 {"_id": reg_db["_id"]},
@@ -358,7 +368,7 @@ def process_one(author_entry, db, collection, empty_person, cvlac_profile, group
             })
 
         # affiliations and related works
-        process_info_from_works(db, author, entry, groups_production_list)
+        process_info_from_works(db, author, entry, groups_production)
 
         # Ranking
         if "nme_clasificacion_pr" in author.keys():
@@ -428,6 +438,37 @@ class Kahi_minciencias_opendata_person(KahiBase):
         self.verbose = config["minciencias_opendata_person"][
             "verbose"] if "verbose" in config["minciencias_opendata_person"].keys() else 0
 
+        self.profiles_batch_size = config["minciencias_opendata_person"][
+            "profiles_batch_size"] if "profiles_batch_size" in config["minciencias_opendata_person"].keys() else 1000
+
+    def with_profiles(self, collection, authors, key=None):
+        """
+        Generator of the authors with their profile, the profiles are fetched
+        with one query for every profiles_batch_size authors.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            The collection of the profiles (cvlac or private profiles).
+        authors : list
+            The authors to process.
+        key : function
+            Function to get the id_persona_pr of an author, the author itself if None.
+
+        Yields
+        ------
+        tuple
+            (author, profile or None)
+        """
+        for i in range(0, len(authors), self.profiles_batch_size):
+            chunk = authors[i:i + self.profiles_batch_size]
+            ids = [key(author) if key else author for author in chunk]
+            profiles = {}
+            for profile in collection.find({"id_persona_pr": {"$in": ids}}):
+                profiles.setdefault(profile["id_persona_pr"], profile)
+            for author, _id in zip(chunk, ids):
+                yield author, profiles.get(_id)
+
     def process_openadata(self):
 
         # Authors aggregate
@@ -457,10 +498,10 @@ class Kahi_minciencias_opendata_person(KahiBase):
             {'$replaceRoot': {'newRoot': '$originalDoc'}},
             {'$group': {'_id': '$id_persona_pd', 'products': {'$push': '$$ROOT'}}}
         ]
-        production_cursor = self.groups_production.aggregate(
-            pipeline, allowDiskUse=True)
-        if production_cursor:
-            groups_production_list = list(production_cursor)
+        # index of the products by id_persona_pd
+        groups_production = {}
+        for prod in self.groups_production.aggregate(pipeline, allowDiskUse=True):
+            groups_production[prod["_id"]] = prod["products"]
 
         # authors not in the cvlac collection
         cvlac_data_ids = list(
@@ -493,13 +534,13 @@ class Kahi_minciencias_opendata_person(KahiBase):
                     db,
                     person_collection,
                     self.empty_person(),
-                    # Find the document in the cvlac_stage collection using the id_persona_pr field.
-                    self.cvlac_stage.find_one(
-                        {"id_persona_pr": author["_id"]}),
-                    groups_production_list,
+                    # The document in the cvlac_stage collection with the id_persona_pr field.
+                    cvlac_profile,
+                    groups_production,
                     False,  # author is list of author documents
                     self.verbose
-                ) for author in cvlac_authors_list  # Iterate over the cvlac_authors_list
+                ) for author, cvlac_profile in self.with_profiles(
+                    self.cvlac_stage, cvlac_authors_list, key=lambda author: author["_id"])  # Iterate over the cvlac_authors_list
             )
             # Process the authors with private profiles
             if self.verbose > 4:
@@ -514,24 +555,23 @@ class Kahi_minciencias_opendata_person(KahiBase):
                     db,
                     person_collection,
                     self.empty_person(),
-                    # Find the document in the private_profiles collection using the id_persona_pr field.
-                    self.private_profiles.find_one(
-                        {"id_persona_pr": author}),
-                    groups_production_list,
+                    # The document in the private_profiles collection with the id_persona_pr field.
+                    private_profile,
+                    groups_production,
                     True,  # author is an author id
                     self.verbose
                     # Iterate over the authors_private_profile_list
-                ) for author in authors_private_profile_list
+                ) for author, private_profile in self.with_profiles(self.private_profiles, authors_private_profile_list)
             )
-            if production_not_cvlac_cursor:
-                groups_production_not_cvlac_list = list(
-                    production_not_cvlac_cursor)
-                # Extract the id_persona_pr id from the groups_production_not_cvlac_list
-                authors_not_cvlac_ids = set(
-                    [author["_id"] for author in groups_production_not_cvlac_list])
+            # index of the products of the authors not in cvlac by id_persona_pd
+            groups_production_not_cvlac = {}
+            for prod in production_not_cvlac_cursor:
+                groups_production_not_cvlac[prod["_id"]] = prod["products"]
+            if groups_production_not_cvlac:
+                authors_not_cvlac_ids = list(groups_production_not_cvlac.keys())
                 if self.verbose > 4:
                     print("Processing {} authors not in cvlac.".format(
-                        len(groups_production_not_cvlac_list)))
+                        len(authors_not_cvlac_ids)))
                 Parallel(
                     n_jobs=self.n_jobs,
                     verbose=10,
@@ -541,14 +581,13 @@ class Kahi_minciencias_opendata_person(KahiBase):
                         db,
                         person_collection,
                         self.empty_person(),
-                        # Find the document in the cvlac_stage collection using the id_persona_pr field.
-                        self.cvlac_stage.find_one(
-                            {"id_persona_pr": author}),
-                        groups_production_not_cvlac_list,
+                        # The document in the cvlac_stage collection with the id_persona_pr field.
+                        cvlac_profile,
+                        groups_production_not_cvlac,
                         True,  # author is an author id
                         self.verbose
                         # Iterate over the ids of the authors not in cvlac.
-                    ) for author in list(authors_not_cvlac_ids)
+                    ) for author, cvlac_profile in self.with_profiles(self.cvlac_stage, authors_not_cvlac_ids)
                 )
             client.close()
 
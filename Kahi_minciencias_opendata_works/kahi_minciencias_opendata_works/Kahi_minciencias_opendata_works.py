@@ -2,7 +2,9 @@ from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from pymongo.errors import ConnectionFailure
 from joblib import Parallel, delayed
-from kahi_minciencias_opendata_works.process_one import process_one
+from kahi_minciencias_opendata_works.process_one import process_batch
+from kahi_minciencias_opendata_works.es_buffer import ESBuffer
+from kahi_minciencias_opendata_works.similarity import work_batches
 from mohan.Similarity import Similarity
 
 
@@ -32,6 +34,9 @@ class Kahi_minciencias_opendata_works(KahiBase):
                 - es_url: the URL for the Elasticsearch server
                 - es_user: the username for the Elasticsearch server
                 - es_password: the password for the Elasticsearch server
+                - es_bulk_size: the number of works inserted together in Elasticsearch
+                - es_flush_on_search: if True the pending works are inserted in Elasticsearch before a search that could find one of them
+                - search_batch_size: the number of works searched together in Elasticsearch
         """
         self.config = config
 
@@ -72,6 +77,12 @@ class Kahi_minciencias_opendata_works(KahiBase):
         ) else 1
         self.verbose = config["minciencias_opendata_works"]["verbose"] if "verbose" in config["minciencias_opendata_works"].keys(
         ) else 0
+        self.es_bulk_size = config["minciencias_opendata_works"]["es_bulk_size"] if "es_bulk_size" in config["minciencias_opendata_works"].keys(
+        ) else 100
+        self.es_flush_on_search = config["minciencias_opendata_works"]["es_flush_on_search"] if "es_flush_on_search" in config["minciencias_opendata_works"].keys(
+        ) else True
+        self.search_batch_size = config["minciencias_opendata_works"]["search_batch_size"] if "search_batch_size" in config["minciencias_opendata_works"].keys(
+        ) else 100
 
         # checking if the databases and collections are available
         self.check_databases_and_collections()
@@ -147,21 +158,33 @@ class Kahi_minciencias_opendata_works(KahiBase):
         paper_list = list(opendata.aggregate(pipeline, allowDiskUse=True))
         print(
             f"INFO: Processing bibliographic production {len(paper_list)} catgories {biblio}")
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=self.verbose,
-            backend="threading")(
-            delayed(process_one)(
-                work,
-                self.db,
-                self.collection,
-                self.empty_work(),
-                self.es_handler,
-                insert_all=self.insert_all,
-                thresholds=self.thresholds,
-                verbose=self.verbose
-            ) for work in paper_list
-        )
+        # the works inserted in elasticsearch are written in batches
+        es_buffer = ESBuffer(self.es_handler, bulk_size=self.es_bulk_size, flush_on_search=self.es_flush_on_search,
+                             verbose=self.verbose) if self.es_handler else None
+        try:
+            Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend="threading")(
+                delayed(process_batch)(
+                    works,
+                    self.db,
+                    self.collection,
+                    self.empty_work(),
+                    es_buffer,
+                    insert_all=self.insert_all,
+                    thresholds=self.thresholds,
+                    verbose=self.verbose
+                ) for works in work_batches(paper_list, self.search_batch_size)
+            )
+        finally:
+            # the pending works are written even if a worker failed, they are already in the database
+            if es_buffer:
+                es_buffer.flush()
+        if es_buffer:
+            if self.verbose > 0:
+                print(f"INFO: elasticsearch buffer {es_buffer.info()}")
+            es_buffer.check()
         client.close()
 
     def run(self):
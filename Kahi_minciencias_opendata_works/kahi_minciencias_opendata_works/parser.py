@@ -1,5 +1,6 @@
 from kahi_impactu_utils.Utils import lang_poll, check_date_format
 from time import time
+from copy import deepcopy
 from re import search
 
 
@@ -16,7 +17,8 @@ def parse_minciencias_opendata(reg, empty_work, verbose=0):
     verbose : int
         The verbosity level. Default is 0.
     """
-    entry = empty_work.copy()
+    # deep copy, the template is shared by the records of a batch
+    entry = deepcopy(empty_work)
     entry["updated"] = [{"source": "minciencias", "time": int(time())}]
     if 'nme_producto_pd' in reg.keys():
         if reg["nme_producto_pd"]:
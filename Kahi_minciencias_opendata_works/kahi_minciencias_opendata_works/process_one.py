@@ -5,6 +5,8 @@ from unidecode import unidecode
 from time import time
 from bson import ObjectId
 from re import search, sub
+from kahi_minciencias_opendata_works.es_buffer import ESBuffer
+from kahi_minciencias_opendata_works.similarity import search_works, inserted_after_search
 
 
 def get_units_affiations(db, author_db, affiliations):
@@ -264,8 +266,8 @@ def process_one_insert(openadata_reg, db, collection, empty_work, es_handler, ve
         Collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
     verbose : int, optional
         Verbosity level. The default is 0.
     """
@@ -408,31 +410,47 @@ def check_work(title_work, authors, response, thresholds):
     return False
 
 
-def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0):
+def get_thresholds(thresholds, verbose=0):
     """
-    Function to process a single register from the minciencias opendata database.
-    This function is used to insert or update a register in the colav(kahi works) database.
+    Function to get the thresholds of the similarity functions as a dict.
 
     Parameters
     ----------
-    openadata_reg : dict
-        Register from the minciencias opendata database
-    db : pymongo.database.Database
-        Database where the colav collections are stored, used to search for authors and affiliations.
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
-    empty_work : dict
-        Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
-    insert_all : bool
-        Flag to insert all the registers in the minciencias opendata database.
     thresholds : list
-        List with the thresholds for the similarity functions.
+        List with the thresholds for author names, a low threshold for works and a high threshold for works.
     verbose : int, optional
         Verbosity level. The default is 0.
+
+    Returns
+    -------
+    dict
+        The thresholds with the keys author_thd, paper_thd_low and paper_thd_high.
+    """
+    if thresholds and len(thresholds) == 3:
+        return {"author_thd": thresholds[0],
+                "paper_thd_low": thresholds[1], "paper_thd_high": thresholds[2]}
+    if verbose > 4:
+        print("Invalid thresholds values provided, using default values")
+    return {"author_thd": 65,
+            "paper_thd_low": 90, "paper_thd_high": 95}
+
+
+def find_product(openadata_reg, collection):
+    """
+    Function to find a register already in the colav database by the product id (COD_RH and COD_PRODUCTO).
+
+    Parameters
+    ----------
+    openadata_reg : dict
+        Register from the minciencias opendata database
+    collection : pymongo.collection.Collection
+        Collection of works in the colav database.
+
+    Returns
+    -------
+    dict or None
+        The register in the colav database.
     """
-    # type id verification
     if "id_producto_pd" in openadata_reg.keys():
         if openadata_reg["id_producto_pd"]:
             COD_RH = ""
@@ -444,112 +462,242 @@ def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_al
                 COD_PROD = match.group(2)
 
                 if COD_RH and COD_PROD:
-                    colav_reg = collection.find_one(
+                    return collection.find_one(
                         {"external_ids.id": {"COD_RH": COD_RH, "COD_PRODUCTO": COD_PROD}})
-                    if colav_reg:
-                        process_one_update(
-                            openadata_reg, colav_reg, db, collection, empty_work, verbose)
-                        return
+    return None
 
-    # elasticsearch section
-    if es_handler:
-        # Search in elasticsearch
-        if thresholds and len(thresholds) == 3:
-            thresholds = {"author_thd": thresholds[0],
-                          "paper_thd_low": thresholds[1], "paper_thd_high": thresholds[2]}
-        else:
-            if verbose > 4:
-                print("Invalid thresholds values provided, using default values")
-            thresholds = {"author_thd": 65,
-                          "paper_thd_low": 90, "paper_thd_high": 95}
-
-        authors = []
-        title_work = ""
-        if 'nme_producto_pd' in openadata_reg.keys():
-            if openadata_reg["nme_producto_pd"]:
-                title_work = openadata_reg["nme_producto_pd"]
-
-        if 'id_persona_pd' in openadata_reg.keys():
-            if openadata_reg["id_persona_pd"]:
-                author_db = db["person"].find_one(
-                    {"external_ids.id.COD_RH": openadata_reg["id_persona_pd"]}, {"_id": 1, "full_name": 1})
-                if author_db:
-                    authors.append(author_db["full_name"])
-
-        if authors and title_work != "":
-            responses = es_handler.search_work(
-                title=title_work,
-                source="",
-                year="0",
-                authors=authors,
-                volume="",
-                issue="",
-                page_start="",
-                page_end="",
-                use_es_thold=True,
-                es_thold=0,
-                hits=20
-            )
-            if responses:
-                for response in responses:
-                    out = check_work(title_work, authors, response, thresholds)
-                    if out:
-                        colav_reg = collection.find_one(
-                            {"_id": ObjectId(response["_id"])})
-                        if colav_reg:
-                            process_one_update(
-                                openadata_reg, colav_reg, db, collection, empty_work, verbose)
-                            return
-                        else:
-                            if verbose > 4:
-                                print("Register with {} not found in mongodb".format(
-                                    response["_id"]))
-                            return
-                # Work not found
-                if insert_all:
-                    process_one_insert(
-                        openadata_reg, db, collection, empty_work, es_handler, verbose)
-
-        elif title_work:
-            # No authors
-            title = sub('[_|,\\\\]', '', title_work).lower()
-            es_results = es_handler.search_work(
-                title=title,
-                source="",
-                year="0",
-                authors=[],
-                volume="",
-                issue="",
-                page_start="",
-                page_end="",
-                use_es_thold=True,
-                es_thold=0,
-                hits=20
-            )
-            if es_results:
-                for es_work in es_results:
+
+def work_query(openadata_reg, db):
+    """
+    Function to get the search parameters of a register for the elasticsearch index.
+
+    Parameters
+    ----------
+    openadata_reg : dict
+        Register from the minciencias opendata database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for the author.
+
+    Returns
+    -------
+    tuple
+        (title, authors, keyword arguments of Similarity.search_work), the last one is None
+        if the register can not be searched.
+    """
+    authors = []
+    title_work = ""
+    if 'nme_producto_pd' in openadata_reg.keys():
+        if openadata_reg["nme_producto_pd"]:
+            title_work = openadata_reg["nme_producto_pd"]
+
+    if 'id_persona_pd' in openadata_reg.keys():
+        if openadata_reg["id_persona_pd"]:
+            author_db = db["person"].find_one(
+                {"external_ids.id.COD_RH": openadata_reg["id_persona_pd"]}, {"_id": 1, "full_name": 1})
+            if author_db:
+                authors.append(author_db["full_name"])
+
+    if authors and title_work != "":
+        title = title_work
+    elif title_work:
+        # No authors
+        title = sub('[_|,\\\\]', '', title_work).lower()
+    else:
+        return title_work, authors, None
+    return title_work, authors, {
+        "title": title,
+        "source": "",
+        "year": "0",
+        "authors": authors,
+        "volume": "",
+        "issue": "",
+        "page_start": "",
+        "page_end": "",
+        "use_es_thold": True,
+        "es_thold": 0,
+        "hits": 20
+    }
+
+
+def process_one_similarity(openadata_reg, title_work, authors, responses, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0):
+    """
+    Function to update or insert a register according to the elasticsearch hits.
+
+    Parameters
+    ----------
+    openadata_reg : dict
+        Register from the minciencias opendata database
+    title_work : str
+        Title of the register.
+    authors : list
+        Name of the author of the register in the colav database (if found).
+    responses : list
+        The hits of Similarity.search_work for the register.
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    insert_all : bool
+        Flag to insert all the registers in the minciencias opendata database.
+    thresholds : dict
+        The thresholds for the similarity functions (see get_thresholds).
+    verbose : int, optional
+        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    bool
+        True if a register of the colav database was updated.
+    """
+    if authors:
+        if responses:
+            for response in responses:
+                out = check_work(title_work, authors, response, thresholds)
+                if out:
                     colav_reg = collection.find_one(
-                        {"_id": ObjectId(es_work["_id"])})
+                        {"_id": ObjectId(response["_id"])})
                     if colav_reg:
-                        titles = [titles.get('title')
-                                  for titles in colav_reg["titles"]]
-                        display_name, score = process.extractOne(
-                            title_work, titles)
-                        if score > thresholds["paper_thd_high"]:
-                            process_one_update(
-                                openadata_reg, colav_reg, db, collection, empty_work, verbose)
-                            return
+                        process_one_update(
+                            openadata_reg, colav_reg, db, collection, empty_work, verbose)
+                        return True
                     else:
                         if verbose > 4:
                             print("Register with {} not found in mongodb".format(
                                 response["_id"]))
-                        return
-
+                        return False
+            # Work not found
             if insert_all:
                 process_one_insert(
                     openadata_reg, db, collection, empty_work, es_handler, verbose)
+    else:
+        # No authors
+        if responses:
+            for es_work in responses:
+                colav_reg = collection.find_one(
+                    {"_id": ObjectId(es_work["_id"])})
+                if colav_reg:
+                    titles = [titles.get('title')
+                              for titles in colav_reg["titles"]]
+                    display_name, score = process.extractOne(
+                        title_work, titles)
+                    if score > thresholds["paper_thd_high"]:
+                        process_one_update(
+                            openadata_reg, colav_reg, db, collection, empty_work, verbose)
+                        return True
+                else:
+                    if verbose > 4:
+                        print("Register with {} not found in mongodb".format(
+                            es_work["_id"]))
+                    return False
+
+        if insert_all:
+            process_one_insert(
+                openadata_reg, db, collection, empty_work, es_handler, verbose)
+    return False
+
+
+def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0):
+    """
+    Function to process a single register from the minciencias opendata database.
+    This function is used to insert or update a register in the colav(kahi works) database.
+
+    Parameters
+    ----------
+    openadata_reg : dict
+        Register from the minciencias opendata database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    insert_all : bool
+        Flag to insert all the registers in the minciencias opendata database.
+    thresholds : list
+        List with the thresholds for the similarity functions.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    # type id verification
+    colav_reg = find_product(openadata_reg, collection)
+    if colav_reg:
+        process_one_update(
+            openadata_reg, colav_reg, db, collection, empty_work, verbose)
+        return
+
+    # elasticsearch section
+    if es_handler:
+        # Search in elasticsearch
+        thresholds = get_thresholds(thresholds, verbose)
+        title_work, authors, query = work_query(openadata_reg, db)
+        if query:
+            responses = es_handler.search_work(**query)
+            process_one_similarity(openadata_reg, title_work, authors, responses, db, collection,
+                                   empty_work, es_handler, insert_all, thresholds, verbose)
     else:
         process_one_insert(
             openadata_reg, db, collection, empty_work, es_handler, verbose)
         if verbose > 4:
             print("No elasticsearch index provided")
+
+
+def process_batch(openadata_regs, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0):
+    """
+    Function to process a batch of registers from the minciencias opendata database.
+    The registers are searched in elasticsearch with one multi-search request and
+    then they are updated or inserted as in process_one.
+
+    With insert_all, a register similar to a work inserted after the multi-search (by any thread
+    with ESBuffer, else by a previous register of the batch) is searched again before inserting it.
+
+    Parameters
+    ----------
+    openadata_regs : list
+        Registers from the minciencias opendata database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    insert_all : bool
+        Flag to insert all the registers in the minciencias opendata database.
+    thresholds : list
+        List with the thresholds for the similarity functions.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    if not es_handler:
+        for openadata_reg in openadata_regs:
+            process_one(openadata_reg, db, collection, empty_work,
+                        es_handler, insert_all, thresholds, verbose)
+        return
+    thresholds = get_thresholds(thresholds, verbose)
+    pending = []
+    for openadata_reg in openadata_regs:
+        colav_reg = find_product(openadata_reg, collection)
+        if colav_reg:
+            process_one_update(
+                openadata_reg, colav_reg, db, collection, empty_work, verbose)
+            continue
+        title_work, authors, query = work_query(openadata_reg, db)
+        if query:
+            pending.append((openadata_reg, title_work, authors, query))
+    mark = es_handler.mark() if isinstance(es_handler, ESBuffer) else None
+    responses = search_works(es_handler, [query for _, _, _, query in pending])
+    not_updated = []
+    for (openadata_reg, title_work, authors, query), response in zip(pending, responses):
+        if insert_all and inserted_after_search(es_handler, query, mark, not_updated):
+            response = es_handler.search_work(**query)
+        updated = process_one_similarity(openadata_reg, title_work, authors, response, db, collection,
+                                         empty_work, es_handler, insert_all, thresholds, verbose)
+        if not updated:
+            not_updated.append(query)
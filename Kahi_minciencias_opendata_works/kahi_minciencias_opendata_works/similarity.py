@@ -0,0 +1,211 @@
+# This module is shared by the works plugins (Kahi_minciencias_opendata_works, Kahi_openalex_works and Kahi_scienti_works).
+# Every plugin is released and installed by itself, so each one has its own copy of the module,
+# keep the copies identical (only the package name in the imports changes), the CI checks it.
+from hunahpu.Similarity import ColavSimilarity, parse_string
+from elasticsearch import __version__ as es_version
+from unidecode import unidecode
+from kahi_minciencias_opendata_works.es_buffer import ESBuffer
+import re
+
+
+def str_normilize(word):
+    """
+    Normalize a string as mohan Similarity does (lower case, without accents and dots).
+    """
+    return unidecode(word).lower().strip().replace(".", "")
+
+
+def search_body(title, source, year, authors, volume, issue, page_start, page_end, parse_title=True):
+    """
+    Build the elasticsearch query of mohan Similarity.search_work for a work.
+
+    Parameters:
+    -----------
+    title, source, year, authors, volume, issue, page_start, page_end, parse_title
+        The same parameters of Similarity.search_work.
+
+    Returns:
+    --------
+    tuple
+        (query body, normalized title, source, year) the last three are used to select the hits.
+    """
+    title = str_normilize(title) if isinstance(title, str) else ""
+    if not isinstance(source, str):
+        source = ""
+    if isinstance(year, int):
+        year = str(year)
+    values = []
+    for value in [volume, issue, page_start, page_end]:
+        if isinstance(value, int):
+            value = str(value)
+        values.append(value if isinstance(value, str) else "")
+    volume, issue, page_start, page_end = values
+    if parse_title:
+        title = parse_string(title)
+    should = [
+        {"match": {"title": {"query": title, "operator": "OR"}}},
+        {"match": {"source": {"query": source, "operator": "AND"}}},
+        {"term": {"year": year}},
+        {"term": {"volume": volume}},
+        {"term": {"issue": issue}},
+        {"term": {"page_start": page_start}},
+        {"term": {"page_end": page_end}},
+    ]
+    for author in authors if isinstance(authors, list) else []:
+        should.append(
+            {"match": {"authors": {"query": str_normilize(author), "operator": "AND"}}})
+    return {"query": {"bool": {"should": should}}, "size": 20}, title, source, year
+
+
+def select_hits(res, title, source, year, use_es_thold=False, es_thold=130,
+                ratio_thold=90, partial_thold=92, low_thold=81, hits=1):
+    """
+    Select the hits of a search response as mohan Similarity.search_work does.
+
+    Returns:
+    --------
+    dict, list or None
+        The list of hits over es_thold if use_es_thold is True,
+        else the first hit similar to the work or None.
+    """
+    if res["hits"]["total"]["value"] == 0:
+        return None
+    if use_es_thold:
+        return [hit for hit in res["hits"]["hits"][0:hits] if hit["_score"] >= es_thold]
+    for hit in res["hits"]["hits"]:
+        paper1 = {"title": title, "journal": source, "year": year}
+        paper2 = {
+            "title": hit["_source"]["title"],
+            "journal": hit["_source"]["source"] if "source" in hit["_source"].keys() else "",
+            "year": hit["_source"]["year"] if "year" in hit["_source"].keys() else ""
+        }
+        if ColavSimilarity(paper1, paper2, ratio_thold=ratio_thold, partial_thold=partial_thold, low_thold=low_thold):
+            return hit
+    return None
+
+
+def search_works(es_handler, queries):
+    """
+    Search a batch of works with one multi-search request, equivalent to call
+    Similarity.search_work for every work.
+
+    Parameters:
+    -----------
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler of the works index, with ESBuffer the pending works are
+        inserted before the search if any of them could be a hit (and flush_on_search is True).
+    queries : list
+        List of dicts with the keyword arguments of Similarity.search_work.
+
+    Returns:
+    --------
+    list
+        The result of Similarity.search_work for every query, in the same order.
+    """
+    if not queries:
+        return []
+    if isinstance(es_handler, ESBuffer):
+        if es_handler.flush_on_search and es_handler.could_match(queries):
+            es_handler.flush()
+        es_handler = es_handler.es_handler
+    searches = []
+    selections = []
+    for query in queries:
+        query = dict(query)
+        select = {key: query.pop(key) for key in ["use_es_thold", "es_thold", "ratio_thold",
+                                                  "partial_thold", "low_thold", "hits"] if key in query.keys()}
+        body, title, source, year = search_body(**query)
+        searches.append({"index": es_handler.es_index})
+        searches.append(body)
+        selections.append((title, source, year, select))
+    if es_version[0] < 8:
+        res = es_handler.es.msearch(body=searches)
+    else:
+        res = es_handler.es.msearch(searches=searches)
+    results = []
+    for response, (title, source, year, select) in zip(res["responses"], selections):
+        if "error" in response.keys():
+            print("ERROR: elasticsearch multi-search failed for", title, response["error"])
+            results.append(None)
+            continue
+        results.append(select_hits(response, title, source, year, **select))
+    return results
+
+
+def similar_works(work1, work2):
+    """
+    Check if two queries of a batch are the same work, comparing title, source and year
+    as it is done with the elasticsearch hits.
+
+    Parameters:
+    -----------
+    work1, work2 : dict
+        Keyword arguments of Similarity.search_work of the works.
+    """
+    papers = []
+    for work in [work1, work2]:
+        year = str(work["year"]) if work["year"] is not None else ""
+        papers.append({
+            "title": str_normilize(work["title"]) if isinstance(work["title"], str) else "",
+            "journal": work["source"] if isinstance(work["source"], str) else "",
+            "year": year if year.isdigit() else ""
+        })
+    return ColavSimilarity(papers[0], papers[1], ratio_thold=90, partial_thold=92, low_thold=81)
+
+
+def title_tokens(title):
+    """
+    Returns the set of words of four or more characters of the normalized title.
+    """
+    return set(re.findall(r"\w{4,}", str_normilize(title))) if isinstance(title, str) else set()
+
+
+def inserted_after_search(es_handler, query, mark, not_found):
+    """
+    Check if a work not found by a multi-search could have been inserted after the search,
+    in that case it has to be searched again before inserting it.
+
+    With ESBuffer the works inserted by all the threads after the mark are compared,
+    otherwise only the works of the batch also not found (inserted after the search).
+    Only the works that share a word of the title are compared with similar_works,
+    as a hit of elasticsearch has to share a term of the title.
+
+    Parameters:
+    -----------
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler of the works index.
+    query : dict
+        Keyword arguments of Similarity.search_work of the work.
+    mark : int
+        The value of ESBuffer.mark before the search (None for Similarity).
+    not_found : list
+        Queries of the previous works of the batch not found.
+    """
+    if isinstance(es_handler, ESBuffer):
+        works = es_handler.inserted_since(mark)
+        if works is None:
+            return True
+    else:
+        works = not_found
+    tokens = title_tokens(query["title"])
+    for work in works:
+        other = title_tokens(work["title"])
+        if tokens and other and not tokens & other:
+            continue
+        if similar_works(query, work):
+            return True
+    return False
+
+
+def work_batches(cursor, batch_size):
+    """
+    Generator of lists of batch_size records of a cursor.
+    """
+    batch = []
+    for reg in cursor:
+        batch.append(reg)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -118,6 +118,12 @@ class Kahi_openalex_person(KahiBase):
         self.openalex_collection_works = self.openalex_db[config["openalex_person"]
                                                           ["collection_name_works"]]
         self.openalex_collection_works.create_index("authorships.author.id")
+        self.staging_collection = self.openalex_db[config["openalex_person"]["staging_collection"]] if "staging_collection" in config["openalex_person"].keys(
+        ) else self.openalex_db[config["openalex_person"]["collection_name_works"] + "_authors"]
+        self.reuse_staging = config["openalex_person"]["reuse_staging"] if "reuse_staging" in config["openalex_person"].keys(
+        ) else False
+        self.author_batch_size = config["openalex_person"]["author_batch_size"] if "author_batch_size" in config["openalex_person"].keys(
+        ) else 1000
 
         self.n_jobs = config["openalex_person"]["num_jobs"] if "num_jobs" in config["openalex_person"].keys(
         ) else 1
@@ -126,7 +132,63 @@ class Kahi_openalex_person(KahiBase):
 
         self.client.close()
 
+    def create_staging(self):
+        """
+        Creates the staging collection of the related works of the authors, with one record
+        {author_id, ids, publication_year, authorships: {institutions}} for every author of every work with doi,
+        reading the openalex works collection only once.
+        """
+        if self.reuse_staging and self.staging_collection.name in self.openalex_db.list_collection_names():
+            print("INFO: using the related works in {}".format(
+                self.staging_collection.name))
+            return
+        start = time()
+        self.openalex_collection_works.aggregate([
+            # only the works with doi are related works of the authors
+            {"$match": {"ids.doi": {"$exists": True}}},
+            {"$project": {"ids": 1, "publication_year": 1,
+                          "authorships.author.id": 1, "authorships.institutions": 1}},
+            {"$unwind": "$authorships"},
+            {"$project": {"_id": 0, "author_id": "$authorships.author.id", "ids": 1, "publication_year": 1,
+                          "authorships": {"institutions": "$authorships.institutions"}}},
+            {"$out": self.staging_collection.name}
+        ], allowDiskUse=True)
+        self.staging_collection.create_index("author_id")
+        if self.verbose > 0:
+            print("INFO: related works of the authors saved in {} in {:.1f} s".format(
+                self.staging_collection.name, time() - start))
+
+    def authors_with_works(self, author_cursor):
+        """
+        Generator of the authors with their related works, the related works are
+        read from the staging collection with one query every author_batch_size authors.
+
+        Yields:
+        -------
+        tuple
+            (author, list of related works)
+        """
+        batch = []
+        for author in author_cursor:
+            batch.append(author)
+            if len(batch) >= self.author_batch_size:
+                yield from self.related_works_batch(batch)
+                batch = []
+        if batch:
+            yield from self.related_works_batch(batch)
+
+    def related_works_batch(self, authors):
+        """
+        Generator of a batch of authors with their related works, read with a single query.
+        """
+        related_works = {}
+        for rwork in self.staging_collection.find({"author_id": {"$in": [author["id"] for author in authors]}}, {"_id": 0}):
+            related_works.setdefault(rwork["author_id"], []).append(rwork)
+        for author in authors:
+            yield author, related_works.get(author["id"], [])
+
     def process_openalex(self):
+        self.create_staging()
         author_cursor = self.openalex_collection.find(no_cursor_timeout=True)
         client = MongoClient(self.mongodb_url)
         Parallel(
@@ -138,14 +200,8 @@ class Kahi_openalex_person(KahiBase):
                 client,
                 self.config["database_name"],
                 self.empty_person(),
-                list(self.openalex_collection_works.aggregate(
-                    # related works
-                    [{"$project": {"ids": 1, "publication_year": 1, "authorships": 1}},
-                     {"$match": {"authorships.author.id": author["id"]}},
-                     {"$unwind": "$authorships"},
-                     {"$match": {"authorships.author.id": author["id"]}},
-                     {"$project": {"ids": 1, "publication_year": 1, "authorships.institutions": 1}}]))
-            ) for author in author_cursor
+                related_works
+            ) for author, related_works in self.authors_with_works(author_cursor)
         )
         client.close()
 
@@ -1,5 +1,5 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient, TEXT
+from pymongo import MongoClient, TEXT, UpdateOne
 from time import time
 from joblib import Parallel, delayed
 
@@ -47,6 +47,37 @@ def process_relation(sub, client, db_name):
             "$set": {"relations": relations}})
 
 
+def relation_entry(sub_db):
+    """
+    Returns the relation of a subject of the database, {id, name (in english if available), level}.
+    """
+    name = sub_db["names"][0]["name"]
+    for n in sub_db["names"]:
+        if n["lang"] == "en":
+            name = n["name"]
+            break
+    return {
+        "id": sub_db["_id"],
+        "name": name,
+        "level": sub_db["level"]
+    }
+
+
+def relations_from_index(sub, subjects_index):
+    """
+    Returns the relations (related concepts and ancestors) of an openalex concept
+    resolved with the index of the subjects of the database by external id.
+    """
+    relations = []
+    for rel in sub["related_concepts"] + sub["ancestors"]:
+        rel_entry = subjects_index.get(rel["id"])
+        if rel_entry:
+            relations.append(rel_entry)
+        else:
+            print("Could not find related concept in colombia db")
+    return relations
+
+
 class Kahi_openalex_subjects(KahiBase):
 
     config = {}
@@ -80,8 +111,10 @@ class Kahi_openalex_subjects(KahiBase):
                                                     ["collection_name"]]
 
         self.n_jobs = config["openalex_subjects"]["num_jobs"]
+        self.preload = config["openalex_subjects"]["preload"] if "preload" in config["openalex_subjects"].keys(
+        ) else True
 
-        self.inserted_concepts = []
+        self.inserted_concepts = set()
         self.inserted_concepts_ids_tuples = []
 
         self.relations_inserted_ids = []
@@ -92,21 +125,36 @@ class Kahi_openalex_subjects(KahiBase):
                     oa_id = ext["id"]
                     break
             if oa_id != "":
-                self.inserted_concepts.append(oa_id)
+                self.inserted_concepts.add(oa_id)
                 self.inserted_concepts_ids_tuples.append((reg["_id"], oa_id))
                 if reg["relations"] != []:
                     self.relations_inserted_ids.append(oa_id)
 
+    def load_subjects_index(self):
+        """
+        Loads the index of the subjects of the database by external id, {external id: {id, name, level}}.
+        """
+        self.subjects_index = {}
+        for reg in self.collection.find({}, {"names": 1, "level": 1, "external_ids.id": 1}):
+            rel_entry = relation_entry(reg)
+            for ext in reg["external_ids"]:
+                self.subjects_index.setdefault(ext["id"], rel_entry)
+
     def process_openalex(self):
+        if self.preload:
+            self.load_subjects_index()
         openalex_subjects = list(self.openalex_collection.find(
-            {"id": {"$nin": self.inserted_concepts}}))
+            {"id": {"$nin": list(self.inserted_concepts)}}))
         for sub in openalex_subjects:
             if sub["id"] in self.inserted_concepts:
                 continue
-            db_reg = self.collection.find_one(
-                {"external_ids.id": sub["id"]})
+            if self.preload:
+                db_reg = {"_id": self.subjects_index[sub["id"]]["id"]} if sub["id"] in self.subjects_index.keys() else None
+            else:
+                db_reg = self.collection.find_one(
+                    {"external_ids.id": sub["id"]})
             if db_reg:
-                self.inserted_concepts.append(sub["id"])
+                self.inserted_concepts.add(sub["id"])
                 self.inserted_concepts_ids_tuples.append(
                     (db_reg["_id"], sub["id"]))
                 continue
@@ -144,13 +192,29 @@ class Kahi_openalex_subjects(KahiBase):
                     {"source": "image", "url": sub["image_url"]})
 
             response = self.collection.insert_one(entry)
-            self.inserted_concepts.append(sub["id"])
+            self.inserted_concepts.add(sub["id"])
             self.inserted_concepts_ids_tuples.append(
                 (response.inserted_id, sub["id"]))
+            if self.preload:
+                rel_entry = relation_entry(entry)
+                for ext in entry["external_ids"]:
+                    self.subjects_index.setdefault(ext["id"], rel_entry)
 
     def process_relations(self):
         openalex_data = list(self.openalex_collection.find(
             {"id": {"$nin": self.relations_inserted_ids}}, {"id": 1, "ancestors": 1, "related_concepts": 1}))
+        if self.preload:
+            # the relations are resolved in memory and written at once
+            operations = []
+            for sub in openalex_data:
+                relations = relations_from_index(sub, self.subjects_index)
+                if len(relations) > 0:
+                    operations.append(UpdateOne({"external_ids.id": sub["id"]}, {
+                        "$set": {"relations": relations}}))
+            if operations:
+                self.collection.bulk_write(operations, ordered=False)
+            print(f"INFO: relations of {len(operations)} subjects updated")
+            return
         client = MongoClient(self.config["database_url"])
         Parallel(
             n_jobs=self.n_jobs,
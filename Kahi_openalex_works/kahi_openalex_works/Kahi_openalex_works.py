@@ -1,7 +1,14 @@
 from kahi.KahiBase import KahiBase
+from time import time
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
-from kahi_openalex_works.process_one import process_one
+from kahi_openalex_works.process_one import process_one, process_batch
+from kahi_openalex_works.similarity import work_batches
+from kahi_openalex_works.parser import openalex_fields
+from kahi_openalex_works.prefetch import prefetch
+from kahi_openalex_works.cache import get_lookup_caches
+from kahi_openalex_works.bulk_writer import BulkWriter
+from kahi_openalex_works.es_buffer import ESBuffer
 from mohan.Similarity import Similarity
 
 
@@ -31,6 +38,19 @@ class Kahi_openalex_works(KahiBase):
                 - es_url: The url of the elasticsearch server.
                 - es_user: The user for the elasticsearch server.
                 - es_password: The password for the elasticsearch server.
+                - cache_size: Maximum number of external ids in each lookup cache (affiliations, sources, subjects).
+                - cache_preload: If True the lookup caches are loaded at once from the database.
+                - bulk_size: Number of inserts/updates written together with the threading backend.
+                - bulk_max_age: Maximum number of seconds an insert/update waits to be written.
+                - es_bulk_size: Number of works inserted together in elasticsearch with the threading backend.
+                - es_flush_on_search: If True the pending works are inserted in elasticsearch before a search that could find one of them.
+                - search_batch_size: Number of works without doi searched together in elasticsearch (1 searches them one by one).
+                - cursor_batch_size: Number of openalex records read from the database in every batch.
+                - prefetch_size: Maximum number of openalex records read in advance waiting for the workers.
+                - task_batch_size: Number of records sent together to a worker.
+                - incremental: If True only the records with updated_date newer than the last run are processed,
+                  and the works already updated with openalex are refreshed with the new information.
+                - watermark_collection: Collection of the log database where the last updated_date processed is saved.
         """
         self.config = config
 
@@ -81,37 +101,169 @@ class Kahi_openalex_works(KahiBase):
         self.backend = "threading" if "backend" not in config[
             "openalex_works"].keys() else config["openalex_works"]["backend"]
 
+        self.cache_size = config["openalex_works"]["cache_size"] if "cache_size" in config["openalex_works"].keys(
+        ) else 1000000
+        self.cache_preload = config["openalex_works"]["cache_preload"] if "cache_preload" in config["openalex_works"].keys(
+        ) else True
+        self.bulk_size = config["openalex_works"]["bulk_size"] if "bulk_size" in config["openalex_works"].keys(
+        ) else 1000
+        self.bulk_max_age = config["openalex_works"]["bulk_max_age"] if "bulk_max_age" in config["openalex_works"].keys(
+        ) else 60
+        self.es_bulk_size = config["openalex_works"]["es_bulk_size"] if "es_bulk_size" in config["openalex_works"].keys(
+        ) else 100
+        self.es_flush_on_search = config["openalex_works"]["es_flush_on_search"] if "es_flush_on_search" in config["openalex_works"].keys(
+        ) else True
+        self.search_batch_size = config["openalex_works"]["search_batch_size"] if "search_batch_size" in config["openalex_works"].keys(
+        ) else 100
+        self.cursor_batch_size = config["openalex_works"]["cursor_batch_size"] if "cursor_batch_size" in config["openalex_works"].keys(
+        ) else 1000
+        self.prefetch_size = config["openalex_works"]["prefetch_size"] if "prefetch_size" in config["openalex_works"].keys(
+        ) else 10000
+        self.task_batch_size = config["openalex_works"]["task_batch_size"] if "task_batch_size" in config["openalex_works"].keys(
+        ) else 10
+        self.incremental = config["openalex_works"]["incremental"] if "incremental" in config["openalex_works"].keys(
+        ) else False
+        self.watermark_collection = config["openalex_works"]["watermark_collection"] if "watermark_collection" in config["openalex_works"].keys(
+        ) else "watermarks"
+        # the watermark is saved per task, the doi and similarity tasks are different steps of the workflow
+        self.watermark_id = "openalex_works/doi" if self.task == "doi" else "openalex_works"
+        if self.incremental:
+            self.openalex_collection.create_index("updated_date")
+
+    def get_watermark(self):
+        """
+        Method to get the last openalex updated_date processed by the task, saved in the log database.
+
+        Returns:
+        --------
+        str or None
+            The updated_date or None if the task was never run in incremental mode.
+        """
+        log_db = self.client[self.config["log_database"]]
+        reg = log_db[self.watermark_collection].find_one(
+            {"_id": self.watermark_id})
+        return reg["updated_date"] if reg else None
+
+    def set_watermark(self, updated_date):
+        """
+        Method to save the last openalex updated_date processed by the task in the log database.
+
+        Parameters:
+        -----------
+        updated_date : str
+            The updated_date of the newest record processed.
+        """
+        log_db = self.client[self.config["log_database"]]
+        log_db[self.watermark_collection].update_one(
+            {"_id": self.watermark_id},
+            {"$set": {"updated_date": updated_date, "time": int(time())}},
+            upsert=True)
+
     def process_openalex(self):
+        # the inserts and updates of all the threads are written in batches
+        writer = BulkWriter(self.collection, bulk_size=self.bulk_size,
+                            max_age=self.bulk_max_age, verbose=self.verbose) if self.backend == "threading" else None
+        # and the works inserted in elasticsearch too
+        es_buffer = ESBuffer(self.es_handler, bulk_size=self.es_bulk_size, flush_on_search=self.es_flush_on_search,
+                             verbose=self.verbose) if self.backend == "threading" and self.es_handler else None
         # selects papers with doi according to task variable
         if self.task == "doi":
-            paper_cursor = self.openalex_collection.find(
-                {"$and": [{"doi": {"$ne": None}}, {"title": {"$ne": None}}]})
-            count = self.openalex_collection.count_documents(
-                {"$and": [{"doi": {"$ne": None}}, {"title": {"$ne": None}}]})
+            query = {"$and": [{"doi": {"$ne": None}}, {"title": {"$ne": None}}]}
+            count = self.openalex_collection.count_documents(query)
             print(f"INFO: proccesing {count} works with DOI")
         else:
-            paper_cursor = list(self.openalex_collection.find(
-                {"$or": [{"doi": {"$eq": None}}], "title": {"$ne": None}}))
-            count = self.openalex_collection.count_documents(
-                {"$or": [{"doi": {"$eq": None}}], "title": {"$ne": None}})
+            query = {"$or": [{"doi": {"$eq": None}}], "title": {"$ne": None}}
+            count = self.openalex_collection.count_documents(query)
             print(f"INFO: proccesing {count} works without DOI")
+        watermark = None
+        if self.incremental:
+            # only the records changed since the last run and up to the newest record now,
+            # the records changed during the run are processed in the next one
+            last = self.get_watermark()
+            newest = self.openalex_collection.find_one(
+                {"updated_date": {"$ne": None}}, {"updated_date": 1}, sort=[("updated_date", -1)])
+            watermark = newest["updated_date"] if newest else last
+            if watermark:
+                updated_date = {"$lte": watermark}
+                if last:
+                    updated_date["$gt"] = last
+                query = {"$and": [query, {"updated_date": updated_date}]}
+                count = self.openalex_collection.count_documents(query)
+                print(
+                    f"INFO: incremental mode, proccesing {count} works updated after {last} up to {watermark}")
+        # the records are streamed with only the fields used by the parser,
+        # a background thread keeps at most prefetch_size records ready for the workers
+        paper_cursor = prefetch(
+            self.openalex_collection.find(query, {field: 1 for field in openalex_fields},
+                                          no_cursor_timeout=True, batch_size=self.cursor_batch_size),
+            maxsize=self.prefetch_size)
 
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=self.verbose,
-            backend=self.backend,
-            batch_size=10)(
-            delayed(process_one)(
-                paper,
-                self.config,
-                self.empty_work(),
-                self.client if self.backend == "threading" else None,
-                self.es_handler if self.backend == "threading" else None,
-                self.backend,
-                verbose=self.verbose
-            ) for paper in paper_cursor
-        )
+        try:
+            if self.task != "doi" and self.search_batch_size > 1:
+                # the works without doi are searched in elasticsearch in batches with one multi-search request
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend=self.backend,
+                    batch_size=1)(
+                    delayed(process_batch)(
+                        papers,
+                        self.config,
+                        self.empty_work(),
+                        self.client if self.backend == "threading" else None,
+                        es_buffer,
+                        self.backend,
+                        writer=writer,
+                        verbose=self.verbose
+                    ) for papers in work_batches(paper_cursor, self.search_batch_size)
+                )
+            else:
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend=self.backend,
+                    batch_size=self.task_batch_size)(
+                    delayed(process_one)(
+                        paper,
+                        self.config,
+                        self.empty_work(),
+                        self.client if self.backend == "threading" else None,
+                        es_buffer,
+                        self.backend,
+                        writer=writer,
+                        verbose=self.verbose
+                    ) for paper in paper_cursor
+                )
+        finally:
+            # the buffered operations are written even if a worker failed,
+            # the works inserted in elasticsearch already have their _id
+            try:
+                if writer:
+                    writer.flush()
+            finally:
+                if es_buffer:
+                    es_buffer.flush()
+        if self.verbose > 0:
+            if writer:
+                print(f"INFO: works bulk writer {writer.info()}")
+            if es_buffer:
+                print(f"INFO: elasticsearch buffer {es_buffer.info()}")
+        # the watermark only advances if all the works were written (the checks raise otherwise),
+        # so the records of a failed run are processed again in the next one
+        if writer:
+            writer.check()
+        if es_buffer:
+            es_buffer.check()
+        if watermark:
+            self.set_watermark(watermark)
 
     def run(self):
+        if self.backend == "threading":
+            # the lookup caches are shared by all the threads
+            caches = get_lookup_caches(
+                self.config, maxsize=self.cache_size, preload=self.cache_preload)
         self.process_openalex()
+        if self.backend == "threading" and self.verbose > 0:
+            for name, cache in caches.items():
+                print(f"INFO: {name} lookup cache {cache.info()}")
         return 0
@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from threading import Lock
+from pymongo import MongoClient
+
+
+def source_name(reg):
+    """
+    Name of a source, spanish name is preferred over english name.
+    """
+    name = reg["names"][0]["name"]
+    for n in reg["names"]:
+        if n["lang"] == "es":
+            name = n["name"]
+            break
+        if n["lang"] == "en":
+            name = n["name"]
+    return name
+
+
+def subject_name(reg):
+    """
+    Name of a subject, english name is preferred over spanish name.
+    """
+    name = reg["names"][0]["name"]
+    for n in reg["names"]:
+        if n["lang"] == "en":
+            name = n["name"]
+            break
+        elif n["lang"] == "es":
+            name = n["name"]
+    return name
+
+
+def affiliation_name(reg):
+    """
+    Name of an affiliation, ror name is preferred, then the last english or spanish name.
+    """
+    name = reg["names"][0]["name"]
+    for n in reg["names"]:
+        if n["source"] == "ror":
+            name = n["name"]
+            break
+        if n["lang"] == "en":
+            name = n["name"]
+        if n["lang"] == "es":
+            name = n["name"]
+    return name
+
+
+class LookupCache:
+    """
+    In-process cache of the entities of a collection (affiliations, sources or subjects)
+    indexed by external_ids.id.
+
+    Every entry is a dict with the _id, the preferred name, the types and the level
+    of the entity, ids not found in the database are also cached (as None).
+    The cache is thread safe, so the same instance can be shared by joblib threads,
+    and it uses LRU eviction when it is bigger than maxsize.
+    """
+
+    def __init__(self, collection, name_function, maxsize=1000000, preload=True):
+        """
+        Parameters:
+        -----------
+        collection : pymongo.collection.Collection
+            Collection of the entities in the colav database.
+        name_function : function
+            Function to select the preferred name of a record.
+        maxsize : int
+            Maximum number of external ids in the cache.
+        preload : bool
+            If True the collection is loaded in the cache at once.
+        """
+        self.collection = collection
+        self.name_function = name_function
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        if preload:
+            self.load()
+
+    def _entry(self, reg):
+        return {
+            "_id": reg["_id"],
+            "name": self.name_function(reg),
+            "types": reg["types"] if "types" in reg.keys() else [],
+            "level": reg["level"] if "level" in reg.keys() else None
+        }
+
+    def _set(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def load(self):
+        """
+        Load all the records of the collection in the cache (up to maxsize external ids).
+        """
+        for reg in self.collection.find({}, {"names": 1, "types": 1, "level": 1, "external_ids.id": 1}):
+            if not reg.get("names"):
+                continue
+            entry = self._entry(reg)
+            with self._lock:
+                for ext in reg.get("external_ids", []):
+                    if len(self._cache) >= self.maxsize:
+                        return
+                    self._cache[ext["id"]] = entry
+
+    def get(self, ext_id):
+        """
+        Get the entry for an external id.
+
+        Parameters:
+        -----------
+        ext_id : str or int
+            The external id (external_ids.id) of the entity.
+
+        Returns:
+        --------
+        dict or None
+            {"_id", "name", "types", "level"} or None if the entity is not in the database.
+        """
+        with self._lock:
+            if ext_id in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(ext_id)
+                return self._cache[ext_id]
+            self.misses += 1
+        reg = self.collection.find_one(
+            {"external_ids.id": ext_id}, {"names": 1, "types": 1, "level": 1})
+        entry = self._entry(reg) if reg and reg.get("names") else None
+        with self._lock:
+            self._set(ext_id, entry)
+        return entry
+
+    def find(self, external_ids):
+        """
+        Get the entry for the first external id found.
+
+        Parameters:
+        -----------
+        external_ids : list
+            List of external ids in the format [{"source": ..., "id": ...}].
+
+        Returns:
+        --------
+        dict or None
+            The entry of the first external id found in the database.
+        """
+        for ext in external_ids:
+            entry = self.get(ext["id"])
+            if entry:
+                return entry
+        return None
+
+    def info(self):
+        """
+        Returns the hits, misses and size of the cache.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+# for multiprocessing the caches are built once in every process
+lookup_caches = None
+
+
+def get_lookup_caches(config, maxsize=1000000, preload=True):
+    """
+    Get the caches of affiliations, sources and subjects of the current process,
+    they are built the first time the function is called with their own database connection,
+    which lives as long as the process.
+
+    Parameters:
+    -----------
+    config : dict
+        The configuration dictionary, database_url and database_name are used.
+    maxsize : int
+        Maximum number of external ids in each cache.
+    preload : bool
+        If True the collections are loaded in the caches at once.
+
+    Returns:
+    --------
+    dict
+        {"affiliations": LookupCache, "sources": LookupCache, "subjects": LookupCache}
+    """
+    global lookup_caches
+    if lookup_caches is None:
+        db = MongoClient(config["database_url"])[config["database_name"]]
+        lookup_caches = {
+            "affiliations": LookupCache(db["affiliations"], affiliation_name, maxsize=maxsize, preload=preload),
+            "sources": LookupCache(db["sources"], source_name, maxsize=maxsize, preload=preload),
+            "subjects": LookupCache(db["subjects"], subject_name, maxsize=maxsize, preload=preload)
+        }
+    return lookup_caches
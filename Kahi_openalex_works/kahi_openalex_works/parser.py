@@ -1,9 +1,16 @@
 from kahi_impactu_utils.Utils import lang_poll
 from kahi_impactu_utils.String import parse_mathml, parse_html
 from time import time
+from copy import deepcopy
 from datetime import datetime as dt
 from kahi_impactu_utils.String import inverted_index_to_text, text_to_inverted_index
 
+# fields of the openalex records used by parse_openalex and process_one,
+# used as projection to read only what is needed from the openalex collection
+openalex_fields = ["id", "doi", "title", "type", "type_crossref", "ids", "publication_year", "publication_date",
+                   "primary_location", "open_access", "apc_paid", "abstract_inverted_index", "authorships",
+                   "biblio", "concepts", "cited_by_count", "counts_by_year"]
+
 
 def parse_openalex(reg, empty_work, verbose=0):
     """
@@ -18,7 +25,8 @@ def parse_openalex(reg, empty_work, verbose=0):
     verbose : int, optional
         Verbosity level. The default is 0.
     """
-    entry = empty_work.copy()
+    # deep copy, the template is shared by the records of a batch
+    entry = deepcopy(empty_work)
     entry["updated"] = [{"source": "openalex", "time": int(time())}]
     if reg["title"]:
         lang = lang_poll(reg["title"], verbose=verbose)
@@ -0,0 +1,65 @@
+from queue import Queue, Full
+from threading import Thread, Event
+
+# marks the end of the cursor in the queue
+_end = object()
+
+
+def prefetch(cursor, maxsize=10000):
+    """
+    Generator of the records of a cursor read by a background thread.
+
+    The thread reads the cursor (in the batches of the cursor) and puts the records in
+    a bounded queue, so the records are ready when the workers ask for them and the memory
+    used is at most maxsize records, regardless of the size of the collection.
+    The cursor is closed when it is exhausted or when the generator is closed.
+
+    Parameters:
+    -----------
+    cursor : pymongo.cursor.Cursor
+        The cursor to read.
+    maxsize : int
+        Maximum number of records waiting in the queue.
+
+    Yields:
+    -------
+    dict
+        The records of the cursor.
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = Event()
+
+    def put(item):
+        # waits for space in the queue unless the consumer is gone
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for reg in cursor:
+                if not put(reg):
+                    break
+            put(_end)
+        except Exception as e:
+            put(e)
+        finally:
+            cursor.close()
+
+    thread = Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -4,9 +4,13 @@ from time import time
 from bson import ObjectId
 from pymongo import MongoClient
 from mohan.Similarity import Similarity
+from kahi_openalex_works.cache import get_lookup_caches
+from kahi_openalex_works.bulk_writer import BulkWriter
+from kahi_openalex_works.es_buffer import ESBuffer
+from kahi_openalex_works.similarity import search_works, inserted_after_search
 
 
-def get_units_affiations(db, author_db, affiliations):
+def get_units_affiations(db, author_db, affiliations, caches):
     """
     Method to get the units of an author in a register. ex: faculty, department and group.
 
@@ -18,6 +22,8 @@ def get_units_affiations(db, author_db, affiliations):
         record from person
     affiliations : list
         list of affiliations from the parse_openalex method
+    caches : dict
+        Lookup caches of affiliations, sources and subjects (see cache.get_lookup_caches)
 
     Returns:
     -------
@@ -30,8 +36,7 @@ def get_units_affiations(db, author_db, affiliations):
         aff_db = None
         if "external_ids" in aff.keys():
             for ext in aff["external_ids"]:
-                aff_db = db["affiliations"].find_one(
-                    {"external_ids.id": ext["id"]}, {"_id": 1, "types": 1})
+                aff_db = caches["affiliations"].get(ext["id"])
                 if aff_db:
                     types = [i["type"] for i in aff_db["types"]]
                     if "group" in types or "department" in types or "faculty" in types:
@@ -58,7 +63,129 @@ def get_units_affiations(db, author_db, affiliations):
     return units
 
 
-def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0):
+def get_subjects(entry, caches):
+    """
+    Function to get the subjects of the colav database for the concepts of a parsed openalex record.
+
+    Parameters
+    ----------
+    entry : dict
+        A record from openalex parsed with parse_openalex.
+    caches : dict
+        Lookup caches of affiliations, sources and subjects (see cache.get_lookup_caches)
+
+    Returns
+    -------
+    list
+        The subjects with the keys id, name and level.
+    """
+    subject_list = []
+    for subjects in entry["subjects"]:
+        for i, subj in enumerate(subjects["subjects"]):
+            sub_db = caches["subjects"].find(subj["external_ids"])
+            if sub_db:
+                subject_list.append({
+                    "id": sub_db["_id"],
+                    "name": sub_db["name"],
+                    "level": sub_db["level"]
+                })
+    return subject_list
+
+
+def process_one_merge(entry, colav_reg, db, writer, caches, verbose=0):
+    """
+    Method to refresh a register of the database already updated with openalex,
+    used in the incremental mode when the record changes in openalex.
+    The values with openalex provenance are replaced by the new ones and the values of other sources are kept.
+
+    Parameters
+    ----------
+    entry : dict
+        A record from openalex parsed with parse_openalex.
+    colav_reg : dict
+        Register from the colav database (kahi database for impactu)
+    db : pymongo.database.Database
+        Database connection to colav database.
+    writer : BulkWriter
+        Buffered writer of the colav database collection for works.
+    caches : dict
+        Lookup caches of affiliations, sources and subjects (see cache.get_lookup_caches)
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    # updated
+    colav_reg["updated"] = [upd for upd in colav_reg["updated"] if upd["source"] != "openalex"] + \
+        [{"source": "openalex", "time": int(time())}]
+    # titles
+    colav_reg["titles"] = [title for title in colav_reg["titles"]
+                           if title.get("source") != "openalex"] + entry["titles"]
+    # external_ids
+    ext_ids = [ext["id"] for ext in colav_reg["external_ids"]]
+    for ext in entry["external_ids"]:
+        if ext["id"] not in ext_ids:
+            colav_reg["external_ids"].append(ext)
+            ext_ids.append(ext["id"])
+    # types
+    colav_reg["types"] = [typ for typ in colav_reg["types"]
+                          if typ.get("provenance") != "openalex"] + entry["types"]
+    # bibliographic info, only the missing values
+    for key, value in entry["bibliographic_info"].items():
+        if key not in colav_reg["bibliographic_info"].keys() or not colav_reg["bibliographic_info"][key]:
+            colav_reg["bibliographic_info"][key] = value
+    # open access info
+    colav_reg["open_access"] = entry["open_access"]
+    # external urls
+    colav_reg["external_urls"] = [url for url in colav_reg["external_urls"]
+                                  if url.get("provenance") != "openalex"] + entry["external_urls"]
+    # abstracts
+    colav_reg["abstracts"] = [abstract for abstract in colav_reg.get("abstracts", [])
+                              if abstract.get("provenance") != "openalex"] + entry["abstracts"]
+    # citations by year
+    colav_reg["citations_by_year"] = entry["citations_by_year"]
+    # citations count
+    colav_reg["citations_count"] = [count for count in colav_reg["citations_count"]
+                                    if count.get("source") != "openalex"] + entry["citations_count"]
+    # subjects
+    colav_reg["subjects"] = [subjects for subjects in colav_reg["subjects"] if subjects.get("source") != "openalex"] + \
+        [{"source": "openalex", "subjects": get_subjects(entry, caches)}]
+    # authors, only the missing units of the affiliations
+    for i, author in enumerate(entry["authors"]):
+        if i >= len(colav_reg["authors"]):
+            break
+        author_db = None
+        for ext in author["external_ids"]:
+            author_db = db["person"].find_one(
+                {"external_ids.id": ext["id"]})
+            if author_db:
+                break
+        if author_db:
+            aff_units = get_units_affiations(
+                db, author_db, author["affiliations"], caches)
+            for aff_unit in aff_units:
+                if aff_unit not in colav_reg["authors"][i]["affiliations"]:
+                    colav_reg["authors"][i]["affiliations"].append(aff_unit)
+    writer.update_one(
+        {"_id": colav_reg["_id"]},
+        {"$set": {
+            "updated": colav_reg["updated"],
+            "titles": colav_reg["titles"],
+            "external_ids": colav_reg["external_ids"],
+            "types": colav_reg["types"],
+            "bibliographic_info": colav_reg["bibliographic_info"],
+            "open_access": colav_reg["open_access"],
+            "external_urls": colav_reg["external_urls"],
+            "abstracts": colav_reg["abstracts"],
+            "subjects": colav_reg["subjects"],
+            "citations_count": colav_reg["citations_count"],
+            "citations_by_year": colav_reg["citations_by_year"],
+            "authors": colav_reg["authors"]
+        }},
+        keys=[str(colav_reg["_id"])] + [ext["id"]
+                                        for ext in colav_reg["external_ids"]]
+    )
+
+
+def process_one_update(oa_reg, colav_reg, db, writer, empty_work, caches, merge=False, verbose=0):
     """
     Method to update a register in the database if it is found in the openalex database.
     This means that the register is already on the database and it is being updated with new information.
@@ -71,18 +198,27 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
         Register from the colav database (kahi database for impactu)
     db : pymongo.database.Database
         Database connection to colav database.
-    collection : pymongo.collection.Collection
-        Collection to insert the register. Colav database collection for works.
+    writer : BulkWriter
+        Buffered writer of the colav database collection for works.
     empty_work : dict
         A template for a work entry, with empty fields.
+    caches : dict
+        Lookup caches of affiliations, sources and subjects (see cache.get_lookup_caches)
+    merge : bool, optional
+        If True a register already updated with openalex is refreshed with process_one_merge (incremental mode).
     verbose : int, optional
         Verbosity level. The default is 0.
     """
     # updated
     for upd in colav_reg["updated"]:
         if upd["source"] == "openalex":
-            return None  # Register already on db
-            # Could be updated with new information when openalex database changes
+            if not merge:
+                return None  # Register already on db
+            # the record changed in openalex since the last run
+            entry = parse_openalex(oa_reg, empty_work.copy(), verbose=verbose)
+            process_one_merge(entry, colav_reg, db, writer,
+                              caches, verbose=verbose)
+            return None
     entry = parse_openalex(oa_reg, empty_work.copy(), verbose=verbose)
     colav_reg["updated"].append(
         {"source": "openalex", "time": int(time())})
@@ -117,28 +253,8 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
     if entry["citations_count"]:
         colav_reg["citations_count"].extend(entry["citations_count"])
     # subjects
-    subject_list = []
-    for subjects in entry["subjects"]:
-        for i, subj in enumerate(subjects["subjects"]):
-            for ext in subj["external_ids"]:
-                sub_db = db["subjects"].find_one(
-                    {"external_ids.id": ext["id"]})
-                if sub_db:
-                    name = sub_db["names"][0]["name"]
-                    for n in sub_db["names"]:
-                        if n["lang"] == "en":
-                            name = n["name"]
-                            break
-                        elif n["lang"] == "es":
-                            name = n["name"]
-                    subject_list.append({
-                        "id": sub_db["_id"],
-                        "name": name,
-                        "level": sub_db["level"]
-                    })
-                    break
     colav_reg["subjects"].append(
-        {"source": "openalex", "subjects": subject_list})
+        {"source": "openalex", "subjects": get_subjects(entry, caches)})
 
     # authors
     for i, author in enumerate(entry["authors"]):
@@ -150,11 +266,11 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
                 break
         if author_db:
             aff_units = get_units_affiations(
-                db, author_db, author["affiliations"])
+                db, author_db, author["affiliations"], caches)
             for aff_unit in aff_units:
                 if aff_unit not in author["affiliations"]:
                     colav_reg["authors"][i]["affiliations"].append(aff_unit)
-    collection.update_one(
+    writer.update_one(
         {"_id": colav_reg["_id"]},
         {"$set": {
             "updated": colav_reg["updated"],
@@ -167,11 +283,13 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
             "citations_count": colav_reg["citations_count"],
             "citations_by_year": colav_reg["citations_by_year"],
             "authors": colav_reg["authors"]
-        }}
+        }},
+        keys=[str(colav_reg["_id"])] + [ext["id"]
+                                        for ext in colav_reg["external_ids"]]
     )
 
 
-def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0):
+def process_one_insert(oa_reg, db, writer, empty_work, es_handler, caches, verbose=0):
     """
     ""
     Function to insert a new register in the database if it is not found in the colav(kahi works) database.
@@ -189,12 +307,14 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
         Register from the openalex database
     db : pymongo.database.Database
         Database where the colav collections are stored, used to search for authors and affiliations.
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
+    writer : BulkWriter
+        Buffered writer of the collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    caches : dict
+        Lookup caches of affiliations, sources and subjects (see cache.get_lookup_caches)
     verbose : int, optional
         Verbosity level. The default is 0
     """
@@ -205,22 +325,12 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
     source_db = None
     if entry["source"]:
         if "external_ids" in entry["source"].keys():
-            for ext in entry["source"]["external_ids"]:
-                source_db = db["sources"].find_one(
-                    {"external_ids.id": ext["id"]})
-                if source_db:
-                    break
+            source_db = caches["sources"].find(
+                entry["source"]["external_ids"])
     if source_db:
-        name = source_db["names"][0]["name"]
-        for n in source_db["names"]:
-            if n["lang"] == "es":
-                name = n["name"]
-                break
-            if n["lang"] == "en":
-                name = n["name"]
         entry["source"] = {
             "id": source_db["_id"],
-            "name": name
+            "name": source_db["name"]
         }
     else:
         if entry["source"]:
@@ -236,23 +346,13 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
             }
     for subjects in entry["subjects"]:
         for i, subj in enumerate(subjects["subjects"]):
-            for ext in subj["external_ids"]:
-                sub_db = db["subjects"].find_one(
-                    {"external_ids.id": ext["id"]})
-                if sub_db:
-                    name = sub_db["names"][0]["name"]
-                    for n in sub_db["names"]:
-                        if n["lang"] == "en":
-                            name = n["name"]
-                            break
-                        elif n["lang"] == "es":
-                            name = n["name"]
-                    entry["subjects"][0]["subjects"][i] = {
-                        "id": sub_db["_id"],
-                        "name": name,
-                        "level": sub_db["level"]
-                    }
-                    break
+            sub_db = caches["subjects"].find(subj["external_ids"])
+            if sub_db:
+                entry["subjects"][0]["subjects"][i] = {
+                    "id": sub_db["_id"],
+                    "name": sub_db["name"],
+                    "level": sub_db["level"]
+                }
 
     # search authors and affiliations in db
     for i, author in enumerate(entry["authors"]):
@@ -289,7 +389,7 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                 "affiliations": author["affiliations"]
             }
             aff_units = get_units_affiations(
-                db, author_db, author["affiliations"])
+                db, author_db, author["affiliations"], caches)
             for aff_unit in aff_units:
                 if aff_unit not in author["affiliations"]:
                     author["affiliations"].append(aff_unit)
@@ -317,7 +417,7 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                     "affiliations": author["affiliations"]
                 }
                 aff_units = get_units_affiations(
-                    db, author_db, author["affiliations"])
+                    db, author_db, author["affiliations"], caches)
                 for aff_unit in aff_units:
                     if aff_unit not in author["affiliations"]:
                         author["affiliations"].append(aff_unit)
@@ -335,24 +435,11 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                 if "group" in types or "department" in types or "faculty" in types:
                     continue
             if "external_ids" in aff.keys():
-                for ext in aff["external_ids"]:
-                    aff_db = db["affiliations"].find_one(
-                        {"external_ids.id": ext["id"]})
-                    if aff_db:
-                        break
+                aff_db = caches["affiliations"].find(aff["external_ids"])
             if aff_db:
-                name = aff_db["names"][0]["name"]
-                for n in aff_db["names"]:
-                    if n["source"] == "ror":
-                        name = n["name"]
-                        break
-                    if n["lang"] == "en":
-                        name = n["name"]
-                    if n["lang"] == "es":
-                        name = n["name"]
                 entry["authors"][i]["affiliations"][j] = {
                     "id": aff_db["_id"],
-                    "name": name,
+                    "name": aff_db["name"],
                     "types": aff_db["types"]
                 }
             else:
@@ -382,7 +469,8 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
 
     entry["author_count"] = len(entry["authors"])
     # insert in mongo
-    response = collection.insert_one(entry)
+    inserted_id = writer.insert_one(
+        entry, keys=[ext["id"] for ext in entry["external_ids"]])
     # insert in elasticsearch
     if es_handler:
         work = {}
@@ -402,10 +490,163 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
         work["authors"] = authors
         work["provenance"] = "openalex"
 
-        es_handler.insert_work(_id=str(response.inserted_id), work=work)
+        es_handler.insert_work(_id=str(inserted_id), work=work)
+
+
+def get_es_handler(config):
+    """
+    Function to create the elasticsearch handler of the works index from the configuration,
+    used by the processes of the backends other than threading.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+
+    Returns
+    -------
+    Similarity or None
+        The handler or None if there is no elasticsearch configuration.
+    """
+    if "es_index" in config["openalex_works"].keys() and "es_url" in config["openalex_works"].keys() and "es_user" in config["openalex_works"].keys() and "es_password" in config["openalex_works"].keys():
+        es_index = config["openalex_works"]["es_index"]
+        es_url = config["openalex_works"]["es_url"]
+        if config["openalex_works"]["es_user"] and config["openalex_works"]["es_password"]:
+            es_auth = (config["openalex_works"]["es_user"],
+                       config["openalex_works"]["es_password"])
+        else:
+            es_auth = None
+        return Similarity(
+            es_index, es_uri=es_url, es_auth=es_auth, es_req_timeout=300, es_max_retries=5, es_retry_on_timeout=True)
+    print("WARNING: No elasticsearch configuration provided")
+    return None
+
+
+# for multiprocessing the clients are created once in every worker process
+worker_clients = None
+
+
+def get_worker_clients(config):
+    """
+    Function to get the database client and the elasticsearch handler of the current worker process,
+    they are created the first time the function is called and reused by all the tasks of the process.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+
+    Returns
+    -------
+    tuple
+        (pymongo.MongoClient, Similarity or None)
+    """
+    global worker_clients
+    if worker_clients is None:
+        worker_clients = (MongoClient(
+            config["database_url"]), get_es_handler(config))
+    return worker_clients
+
+
+def work_query(oa_reg):
+    """
+    Function to get the search parameters of an openalex register for the elasticsearch index.
+
+    Parameters
+    ----------
+    oa_reg : dict
+        Register from the openalex database
+
+    Returns
+    -------
+    dict
+        Keyword arguments of Similarity.search_work.
+    """
+    authors = []
+    for author in oa_reg['authorships']:
+        if "display_name" in author["author"].keys():
+            authors.append(author["author"]["display_name"])
+    source = ""
+    if oa_reg["primary_location"]:
+        if "source" in oa_reg["primary_location"].keys():
+            if oa_reg["primary_location"]["source"]:
+                if "display_name" in oa_reg["primary_location"]["source"].keys():
+                    source = oa_reg["primary_location"]["source"]["display_name"]
+    return {
+        "title": oa_reg["title"],
+        "source": source,
+        "year": str(oa_reg["publication_year"]),
+        "authors": authors,
+        "volume": oa_reg["biblio"]["volume"],
+        "issue": oa_reg["biblio"]["issue"],
+        "page_start": oa_reg["biblio"]["first_page"],
+        "page_end": oa_reg["biblio"]["last_page"],
+    }
+
+
+def process_one_similarity(oa_reg, response, db, writer, empty_work, es_handler, caches, merge=False, verbose=0):
+    """
+    Function to update or insert a register without doi according to the elasticsearch response.
 
+    Parameters
+    ----------
+    oa_reg : dict
+        Register from the openalex database
+    response : dict
+        The hit of Similarity.search_work for the register, None if it was not found.
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    writer : BulkWriter
+        Buffered writer of the works collection.
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    caches : dict
+        Lookup caches of affiliations, sources and subjects.
+    merge : bool, optional
+        If True a register already updated with openalex is refreshed (incremental mode).
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    collection = db["works"]
+    if merge:
+        # in the incremental mode the record could be inserted by a previous run
+        with writer.claim(oa_reg["id"]):
+            colav_reg = collection.find_one({"external_ids.id": oa_reg["id"]})
+            if colav_reg:
+                process_one_update(oa_reg, colav_reg, db, writer,
+                                   empty_work, caches, merge=merge, verbose=verbose)
+                return
+    if response:  # register already on db... update accordingly
+        found = collection.count_documents(
+            # we are assuming here, all works of apenalex are unique.
+            # to avoid things like https://github.com/colav/impactu/issues/181
+            {"exteral_ids.id": oa_reg["id"]})
+        if found:
+            with writer.claim(response["_id"]):
+                colav_reg = collection.find_one(
+                    {"_id": ObjectId(response["_id"])})
+                if colav_reg:
+                    process_one_update(oa_reg, colav_reg, db,
+                                       writer, empty_work, caches, merge=merge, verbose=verbose)
+                else:
+                    if verbose > 4:
+                        print("Register with {} not found in mongodb".format(
+                            response["_id"]))
+                        print(response)
+        else:
+            process_one_insert(oa_reg, db, writer,
+                               empty_work, es_handler, caches, verbose=0)
+
+    else:  # insert new register
+        if verbose > 4:
+            print("INFO: found no register in elasticsearch")
+        process_one_insert(oa_reg, db, writer,
+                           empty_work, es_handler, caches, verbose=0)
 
-def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose=0):
+
+def process_one(oa_reg, config, empty_work, client, es_handler, backend, writer=None, verbose=0):
     """
     Function to process a single register from the scholar database.
     This function is used to insert or update a register in the colav(kahi works) database.
@@ -420,97 +661,110 @@ def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose
         Collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    writer : BulkWriter
+        Buffered writer of the works collection shared by the threads,
+        if None the operations of the register are written immediately.
     verbose : int, optional
         Verbosity level. The default is 0.
     """
     if backend != "threading":
-        client = MongoClient(config["database_url"])
+        # the clients live as long as the worker process
+        client, es_handler = get_worker_clients(config)
     db = client[config["database_name"]]
     collection = db["works"]
-
-    if backend != "threading":
-        es_handler = None
-        if "es_index" in config["openalex_works"].keys() and "es_url" in config["openalex_works"].keys() and "es_user" in config["openalex_works"].keys() and "es_password" in config["openalex_works"].keys():
-            es_index = config["openalex_works"]["es_index"]
-            es_url = config["openalex_works"]["es_url"]
-            if config["openalex_works"]["es_user"] and config["openalex_works"]["es_password"]:
-                es_auth = (config["openalex_works"]["es_user"],
-                           config["openalex_works"]["es_password"])
-            else:
-                es_auth = None
-            es_handler = Similarity(
-                es_index, es_uri=es_url, es_auth=es_auth, es_req_timeout=300, es_max_retries=5, es_retry_on_timeout=True)
-        else:
-            es_handler = None
-            print("WARNING: No elasticsearch configuration provided")
+    if writer is None:
+        writer = BulkWriter(collection, bulk_size=1, raise_on_error=True, verbose=verbose)
+    # built once per process and shared by the threads
+    caches = get_lookup_caches(
+        config,
+        maxsize=config["openalex_works"]["cache_size"] if "cache_size" in config["openalex_works"].keys() else 1000000,
+        preload=config["openalex_works"]["cache_preload"] if "cache_preload" in config["openalex_works"].keys() else True)
+    incremental = config["openalex_works"]["incremental"] if "incremental" in config["openalex_works"].keys() else False
 
     doi = oa_reg["doi"]
 
     if doi:
-        # is the doi in colavdb?
-        colav_reg = collection.find_one({"external_ids.id": doi})
-        if colav_reg:  # update the register
-            process_one_update(
-                oa_reg, colav_reg, db, collection, empty_work, verbose=verbose)
-        else:  # insert a new register
-            process_one_insert(
-                oa_reg, db, collection, empty_work, es_handler, verbose=verbose)
+        # the doi is processed by one thread at a time and its pending operations are written before the query
+        with writer.claim(doi):
+            # is the doi in colavdb?
+            colav_reg = collection.find_one({"external_ids.id": doi})
+            if colav_reg:  # update the register
+                process_one_update(
+                    oa_reg, colav_reg, db, writer, empty_work, caches, merge=incremental, verbose=verbose)
+            else:  # insert a new register
+                process_one_insert(
+                    oa_reg, db, writer, empty_work, es_handler, caches, verbose=verbose)
     else:  # does not have a doi identifier
         # elasticsearch section
         if es_handler:
             # Search in elasticsearch
-            authors = []
-            for author in oa_reg['authorships']:
-                if "display_name" in author["author"].keys():
-                    authors.append(author["author"]["display_name"])
-            source = ""
-            if oa_reg["primary_location"]:
-                if "source" in oa_reg["primary_location"].keys():
-                    if oa_reg["primary_location"]["source"]:
-                        if "display_name" in oa_reg["primary_location"]["source"].keys():
-                            source = oa_reg["primary_location"]["source"]["display_name"]
-            response = es_handler.search_work(
-                title=oa_reg["title"],
-                source=source,
-                year=str(oa_reg["publication_year"]),
-                authors=authors,
-                volume=oa_reg["biblio"]["volume"],
-                issue=oa_reg["biblio"]["issue"],
-                page_start=oa_reg["biblio"]["first_page"],
-                page_end=oa_reg["biblio"]["last_page"],
-            )
-
-            if response:  # register already on db... update accordingly
-                found = collection.count_documents(
-                    # we are assuming here, all works of apenalex are unique.
-                    # to avoid things like https://github.com/colav/impactu/issues/181
-                    {"exteral_ids.id": oa_reg["id"]})
-                if found:
-                    colav_reg = collection.find_one(
-                        {"_id": ObjectId(response["_id"])})
-                    if colav_reg:
-                        process_one_update(oa_reg, colav_reg, db,
-                                           collection, empty_work, verbose=verbose)
-                    else:
-                        if verbose > 4:
-                            print("Register with {} not found in mongodb".format(
-                                response["_id"]))
-                            print(response)
-                else:
-                    process_one_insert(oa_reg, db, collection,
-                                       empty_work, es_handler, verbose=0)
-
-            else:  # insert new register
-                if verbose > 4:
-                    print("INFO: found no register in elasticsearch")
-                process_one_insert(oa_reg, db, collection,
-                                   empty_work, es_handler, verbose=0)
+            response = es_handler.search_work(**work_query(oa_reg))
+            process_one_similarity(oa_reg, response, db, writer,
+                                   empty_work, es_handler, caches, merge=incremental, verbose=verbose)
         else:
             if verbose > 4:
                 print("No elasticsearch index provided")
     if backend != "threading":
-        client.close()
-        if es_handler:
-            es_handler.close()
+        writer.flush()
+
+
+def process_batch(oa_regs, config, empty_work, client, es_handler, backend, writer=None, verbose=0):
+    """
+    Function to process a batch of registers without doi from the openalex database.
+    The registers are searched in elasticsearch with one multi-search request and
+    then they are updated or inserted as in process_one.
+
+    A register not found that is similar to a work inserted after the multi-search (by any thread
+    with ESBuffer, else by a previous register of the batch) is searched again before inserting it.
+
+    Parameters
+    ----------
+    oa_regs : list
+        Registers from the openalex database
+    config : dict
+        The configuration dictionary.
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    client : pymongo.MongoClient
+        Client of the colav database (only for the threading backend).
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    backend : str
+        The joblib backend.
+    writer : BulkWriter
+        Buffered writer of the works collection shared by the threads,
+        if None the operations of the registers are written immediately.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    if backend != "threading":
+        # the clients live as long as the worker process
+        client, es_handler = get_worker_clients(config)
+    db = client[config["database_name"]]
+    if writer is None:
+        writer = BulkWriter(db["works"], bulk_size=1, raise_on_error=True, verbose=verbose)
+    caches = get_lookup_caches(
+        config,
+        maxsize=config["openalex_works"]["cache_size"] if "cache_size" in config["openalex_works"].keys() else 1000000,
+        preload=config["openalex_works"]["cache_preload"] if "cache_preload" in config["openalex_works"].keys() else True)
+    incremental = config["openalex_works"]["incremental"] if "incremental" in config["openalex_works"].keys() else False
+
+    if es_handler:
+        queries = [work_query(oa_reg) for oa_reg in oa_regs]
+        mark = es_handler.mark() if isinstance(es_handler, ESBuffer) else None
+        responses = search_works(es_handler, queries)
+        not_found = []
+        for oa_reg, query, response in zip(oa_regs, queries, responses):
+            if not response and inserted_after_search(es_handler, query, mark, not_found):
+                response = es_handler.search_work(**query)
+            if not response:
+                not_found.append(query)
+            process_one_similarity(oa_reg, response, db, writer,
+                                   empty_work, es_handler, caches, merge=incremental, verbose=verbose)
+    else:
+        if verbose > 4:
+            print("No elasticsearch index provided")
+    if backend != "threading":
+        writer.flush()
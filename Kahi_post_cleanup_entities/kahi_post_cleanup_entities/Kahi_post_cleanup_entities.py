@@ -25,6 +25,9 @@ class Kahi_post_cleanup_entities(KahiBase):
             post_cleanup_entities: # run this after all works plugins are done
                 num_jobs: 20
                 verbose: 4
+                mode: set # set (default) or legacy
+                dry_run: False
+                delete_batch_size: 10000
         """
         self.config = config
         self.mongodb_url = config["database_url"]
@@ -40,6 +43,12 @@ class Kahi_post_cleanup_entities(KahiBase):
         ) else 1
         self.verbose = config["post_cleanup_entities"]["verbose"] if "verbose" in config["post_cleanup_entities"].keys(
         ) else 0
+        self.mode = config["post_cleanup_entities"]["mode"] if "mode" in config["post_cleanup_entities"].keys(
+        ) else "set"
+        self.dry_run = config["post_cleanup_entities"]["dry_run"] if "dry_run" in config["post_cleanup_entities"].keys(
+        ) else False
+        self.delete_batch_size = config["post_cleanup_entities"]["delete_batch_size"] if "delete_batch_size" in config["post_cleanup_entities"].keys(
+        ) else 10000
 
     def cleanup_author(self, author):
         """
@@ -72,10 +81,87 @@ class Kahi_post_cleanup_entities(KahiBase):
             return 1
         return 0
 
+    def find_orphans(self):
+        """
+        find the authors without works and the affiliations without authors (after removing the authors)
+        with a single pass over the works, the person and the affiliations collections
+
+        Returns:
+        ----------
+        tuple
+            (list of ids of authors to remove, list of ids of affiliations to remove)
+        """
+        # ids of the authors of the works
+        pipeline = [
+            {"$project": {"authors.id": 1}},
+            {"$unwind": "$authors"},
+            {"$group": {"_id": "$authors.id"}}
+        ]
+        works_authors = set(reg["_id"] for reg in self.works.aggregate(
+            pipeline, allowDiskUse=True))
+        # ids of the affiliations of the authors that are not removed
+        authors = []
+        persons_affiliations = set()
+        for author in self.person.find({}, {"_id": 1, "affiliations.id": 1}):
+            if author["_id"] not in works_authors:
+                authors.append(author["_id"])
+                continue
+            for aff in author.get("affiliations") or []:
+                if "id" in aff.keys():
+                    persons_affiliations.add(aff["id"])
+        del works_authors
+        affiliations = [affiliation["_id"] for affiliation in self.affiliations.find(
+            {}, {"_id": 1}) if affiliation["_id"] not in persons_affiliations]
+        return authors, affiliations
+
+    def delete_ids(self, collection, ids):
+        """
+        remove the documents of a collection with delete_many in chunks of delete_batch_size ids
+
+        Parameters:
+        ----------
+        collection : pymongo.collection.Collection
+            collection where the documents are removed
+        ids : list
+            ids of the documents to remove
+
+        Returns:
+        ----------
+        int
+            number of documents removed
+        """
+        deleted = 0
+        for i in range(0, len(ids), self.delete_batch_size):
+            result = collection.delete_many(
+                {"_id": {"$in": ids[i:i + self.delete_batch_size]}})
+            deleted += result.deleted_count
+        return deleted
+
+    def run_set(self):
+        """
+        Run the post cleanup process for authors and affiliations comparing the sets of ids
+        """
+        authors, affiliations = self.find_orphans()
+        print("INFO: Found {} of {} authors without works".format(
+            len(authors), self.person.estimated_document_count()))
+        print("INFO: Found {} of {} affiliations without authors".format(
+            len(affiliations), self.affiliations.estimated_document_count()))
+        if self.dry_run:
+            print("INFO: Dry run, nothing was removed")
+            return 0
+        print("INFO: Removed {} authors".format(
+            self.delete_ids(self.person, authors)))
+        print("INFO: Removed {} affiliations".format(
+            self.delete_ids(self.affiliations, affiliations)))
+        return 0
+
     def run(self):
         """
         Run the post cleanup process for authors and affiliations
         """
+        if self.mode == "set":
+            return self.run_set()
+
         authors = self.person.find({}, {"_id": 1})
         out = Parallel(
             n_jobs=self.n_jobs,
@@ -1,5 +1,6 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from joblib import Parallel, delayed
 
 
 class Kahi_post_person_work_cleaning(KahiBase):
@@ -17,6 +18,17 @@ class Kahi_post_person_work_cleaning(KahiBase):
         self.works = self.db["works"]
         self.person = self.db["person"]
 
+        self.n_jobs = config["post_person_work_cleaning"]["num_jobs"] if "num_jobs" in config["post_person_work_cleaning"].keys(
+        ) else 1
+        self.verbose = config["post_person_work_cleaning"]["verbose"] if "verbose" in config["post_person_work_cleaning"].keys(
+        ) else 0
+        self.fast = config["post_person_work_cleaning"]["fast"] if "fast" in config["post_person_work_cleaning"].keys(
+        ) else True
+        self.work_batch_size = config["post_person_work_cleaning"]["work_batch_size"] if "work_batch_size" in config["post_person_work_cleaning"].keys(
+        ) else 1000
+        self.author_batch_size = config["post_person_work_cleaning"]["author_batch_size"] if "author_batch_size" in config["post_person_work_cleaning"].keys(
+        ) else 100000
+
     def process_one(self, author):
         works = works = list(self.works.find(
             {"authors.id": author["_id"]}, {"authors": 1, "external_ids": 1}))
@@ -52,9 +64,92 @@ class Kahi_post_person_work_cleaning(KahiBase):
                         self.works.update_one({"_id": work['_id']}, {
                                               "$set": {"authors": work["authors"]}})
 
+    def authors_map(self, authors):
+        """
+        Builds the map of the authors to check, {person_id: (set of affiliation ids, cod_rh)}
+        """
+        authors_map = {}
+        for author in authors:
+            cod_rh = next((x["id"]["COD_RH"] for x in author["external_ids"] if x["source"] in ("scienti", "minciencias")),
+                          None)
+            affiliations = set(aff["id"] for aff in author.get("affiliations") or [] if "id" in aff.keys())
+            authors_map[author["_id"]] = (affiliations, cod_rh)
+        return authors_map
+
+    def process_works(self, works, authors_map):
+        """
+        Removes the id of the authors of a chunk of works when none of the affiliations of the author in the work
+        is an affiliation of the person, deciding with the authors map and writing the changes
+        with positional updates in a single bulk_write.
+
+        Returns:
+            int: number of authors removed from the works
+        """
+        operations = []
+        for work in works:
+            cod_rh_work = [
+                x["id"]["COD_RH"]
+                for x in work["external_ids"]
+                if x.get("source") == "scienti" and "COD_RH" in x.get("id", {})
+            ]
+            for j, work_author in enumerate(work["authors"]):
+                if work_author.get("id") not in authors_map.keys():
+                    continue
+                affiliations, cod_rh = authors_map[work_author["id"]]
+                if cod_rh in cod_rh_work:
+                    # The author has the cod_rh in the work
+                    continue
+                if not work_author.get("affiliations"):
+                    # if not affiliation we assume it is right
+                    continue
+                if any(aff.get("id") in affiliations for aff in work_author["affiliations"]):
+                    continue
+                operations.append(UpdateOne(
+                    {"_id": work["_id"], f"authors.{j}.id": work_author["id"]},
+                    {"$set": {f"authors.{j}.id": ""}}))
+        if operations:
+            self.works.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    def work_batches(self, authors_map):
+        """
+        Generator of chunks of work_batch_size works with authors of the map,
+        the works are searched by chunks of author_batch_size authors and every work is returned once.
+        """
+        author_ids = list(authors_map.keys())
+        seen = set()
+        batch = []
+        for i in range(0, len(author_ids), self.author_batch_size):
+            for work in self.works.find({"authors.id": {"$in": author_ids[i:i + self.author_batch_size]}},
+                                        {"authors.id": 1, "authors.affiliations.id": 1, "external_ids": 1}):
+                if work["_id"] in seen:
+                    continue
+                seen.add(work["_id"])
+                batch.append(work)
+                if len(batch) >= self.work_batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
     def run(self):
         # https://github.com/colav/impactu/issues/141
         # only authors from scienti, staff or ciarp
+        if self.fast:
+            authors_map = self.authors_map(self.person.find({"$or": [{"updated.source": "scienti"}, {
+                "updated.source": "staff"}, {"updated.source": "ciarp"}]}, {"_id": 1, "external_ids": 1, "affiliations.id": 1}))
+            print(f"INFO: checking the works of {len(authors_map)} authors")
+            out = Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend="threading")(
+                delayed(self.process_works)(
+                    works,
+                    authors_map
+                ) for works in self.work_batches(authors_map)
+            )
+            print(f"INFO: removed {sum(out)} authors from the works")
+            return 0
         authors = list(self.person.find({"$or": [{"updated.source": "scienti"}, {
                        "updated.source": "staff"}, {"updated.source": "ciarp"}]}, {"_id": 1, "external_ids": 1, "affilations": 1}))
         for author in authors:
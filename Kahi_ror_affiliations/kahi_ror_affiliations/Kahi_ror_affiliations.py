@@ -1,7 +1,92 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
+from pymongo.errors import BulkWriteError
 from time import time
 from joblib import Parallel, delayed
+from zipfile import ZipFile
+import ijson
+
+
+def ror_records(file_path):
+    """
+    Generator of the records of a ROR dump (json or zip file with the json),
+    the file is parsed incrementally so the array of records is never in memory.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the ROR dump, a .json file or the .zip file downloaded from ROR.
+    """
+    if file_path.endswith(".zip"):
+        with ZipFile(file_path) as zip_file:
+            names = [name for name in zip_file.namelist() if name.endswith(".json")]
+            # the recent dumps have a file for the schema v2, the records are read in the schema v1
+            names = [name for name in names if "schema_v2" not in name] or names
+            if not names:
+                raise Exception(f"ROR json file not found in {file_path}")
+            with zip_file.open(names[0]) as f:
+                yield from ijson.items(f, "item", use_float=True)
+    else:
+        with open(file_path, "rb") as f:
+            yield from ijson.items(f, "item", use_float=True)
+
+
+def ror_entry(inst, empty_affiliations):
+    """
+    Returns the affiliation of a ROR record.
+    """
+    entry = empty_affiliations.copy()
+    entry["updated"].append({"time": int(time()), "source": "ror"})
+    entry["names"].append(
+        {"source": "ror", "name": inst["name"], "lang": "en"})
+    entry["aliases"].extend(inst["aliases"])
+    entry["abbreviations"].extend(inst["acronyms"])
+    entry["year_established"] = int(
+        inst["established"]) if inst["established"] else -1
+    entry["status"] = [inst["status"]]
+
+    # types
+    for typ in inst["types"]:
+        entry["types"].append({"source": "ror", "type": typ})
+
+    # addresses
+    for add in inst["addresses"]:
+        add_entry = {
+            "lat": add["lat"],
+            "lng": add["lng"],
+            "postcode": add["postcode"] if add["postcode"] else "",
+            "state": add["state"],
+            "city": add["city"],
+            "country": "",
+            "country_code": "",
+        }
+        entry["addresses"].append(add_entry)
+    entry["addresses"][0]["country"] = inst["country"]["country_name"]
+    entry["addresses"][0]["country_code"] = inst["country"]["country_code"]
+
+    # external_urls
+    if inst["links"]:
+        for link in inst["links"]:
+            url_entry = {"source": "site", "url": inst["links"][0]}
+            if url_entry not in entry["external_urls"]:
+                entry["external_urls"].append(url_entry)
+    if inst["wikipedia_url"]:
+        entry["external_urls"].append(
+            {"source": "wikipedia", "url": inst["wikipedia_url"]})
+
+    # external_ids
+    if inst["external_ids"]:
+        for key, ext in inst["external_ids"].items():
+            if isinstance(ext["all"], list):
+                alll = ext["all"][0] if len(
+                    ext["all"]) > 0 else ext["all"]
+                ext_entry = {"source": key.lower(), "id": alll}
+                if ext_entry not in entry["external_ids"]:
+                    entry["external_ids"].append(ext_entry)
+    entry["external_ids"].append(
+        {"source": "ror", "id": inst["id"]})
+    entry["_id"] = inst["id"].split("/")[-1]
+    return entry
 
 
 def process_one(inst, collection, empty_affiliations):
@@ -10,57 +95,7 @@ def process_one(inst, collection, empty_affiliations):
         return
         # may be updatable, check accordingly
     else:
-        entry = empty_affiliations.copy()
-        entry["updated"].append({"time": int(time()), "source": "ror"})
-        entry["names"].append(
-            {"source": "ror", "name": inst["name"], "lang": "en"})
-        entry["aliases"].extend(inst["aliases"])
-        entry["abbreviations"].extend(inst["acronyms"])
-        entry["year_established"] = int(
-            inst["established"]) if inst["established"] else -1
-        entry["status"] = [inst["status"]]
-
-        # types
-        for typ in inst["types"]:
-            entry["types"].append({"source": "ror", "type": typ})
-
-        # addresses
-        for add in inst["addresses"]:
-            add_entry = {
-                "lat": add["lat"],
-                "lng": add["lng"],
-                "postcode": add["postcode"] if add["postcode"] else "",
-                "state": add["state"],
-                "city": add["city"],
-                "country": "",
-                "country_code": "",
-            }
-            entry["addresses"].append(add_entry)
-        entry["addresses"][0]["country"] = inst["country"]["country_name"]
-        entry["addresses"][0]["country_code"] = inst["country"]["country_code"]
-
-        # external_urls
-        if inst["links"]:
-            for link in inst["links"]:
-                url_entry = {"source": "site", "url": inst["links"][0]}
-                if url_entry not in entry["external_urls"]:
-                    entry["external_urls"].append(url_entry)
-        if inst["wikipedia_url"]:
-            entry["external_urls"].append(
-                {"source": "wikipedia", "url": inst["wikipedia_url"]})
-
-        # external_ids
-        if inst["external_ids"]:
-            for key, ext in inst["external_ids"].items():
-                if isinstance(ext["all"], list):
-                    alll = ext["all"][0] if len(
-                        ext["all"]) > 0 else ext["all"]
-                    ext_entry = {"source": key.lower(), "id": alll}
-                    if ext_entry not in entry["external_ids"]:
-                        entry["external_ids"].append(ext_entry)
-        entry["external_ids"].append(
-            {"source": "ror", "id": inst["id"]})
-        entry["_id"] = inst["id"].split("/")[-1]
+        entry = ror_entry(inst, empty_affiliations)
         collection.insert_one(entry)
 
 
@@ -76,25 +111,33 @@ class Kahi_ror_affiliations(KahiBase):
         self.db = self.client[config["database_name"]]
         self.collection = self.db["affiliations"]
 
-        self.ror_client = MongoClient(
-            config["ror_affiliations"]["database_url"])
-        if config["ror_affiliations"]["database_name"] not in self.ror_client.list_database_names():
-            raise Exception("Database {} not found in {}".format(
-                config["ror_affiliations"]['database_name'], config["ror_affiliations"]["database_url"]))
-        self.ror_db = self.ror_client[config["ror_affiliations"]
-                                      ["database_name"]]
-        if config["ror_affiliations"]["collection_name"] not in self.ror_db.list_collection_names():
-            raise Exception("Collection {}.{} not found in {}".format(config["ror_affiliations"]['database_name'],
-                                                                      config["ror_affiliations"]['collection_name'], config["ror_affiliations"]["database_url"]))
-
-        self.ror_collection = self.ror_db[config["ror_affiliations"]
-                                          ["collection_name"]]
+        # with file_path the ROR dump is read directly, without the stage collection
+        self.file_path = config["ror_affiliations"]["file_path"] if "file_path" in config["ror_affiliations"].keys(
+        ) else None
+        self.bulk_size = config["ror_affiliations"]["bulk_size"] if "bulk_size" in config["ror_affiliations"].keys(
+        ) else 1000
+
+        if not self.file_path:
+            self.ror_client = MongoClient(
+                config["ror_affiliations"]["database_url"])
+            if config["ror_affiliations"]["database_name"] not in self.ror_client.list_database_names():
+                raise Exception("Database {} not found in {}".format(
+                    config["ror_affiliations"]['database_name'], config["ror_affiliations"]["database_url"]))
+            self.ror_db = self.ror_client[config["ror_affiliations"]
+                                          ["database_name"]]
+            if config["ror_affiliations"]["collection_name"] not in self.ror_db.list_collection_names():
+                raise Exception("Collection {}.{} not found in {}".format(config["ror_affiliations"]['database_name'],
+                                                                          config["ror_affiliations"]['collection_name'], config["ror_affiliations"]["database_url"]))
+
+            self.ror_collection = self.ror_db[config["ror_affiliations"]
+                                              ["collection_name"]]
 
         self.collection.create_index("external_ids.id")
         self.collection.create_index("types.type")
         self.collection.create_index([("names.name", TEXT)])
 
-        self.n_jobs = config["ror_affiliations"]["num_jobs"]
+        self.n_jobs = config["ror_affiliations"]["num_jobs"] if "num_jobs" in config["ror_affiliations"].keys(
+        ) else 1
         self.client.close()
         self.config = config
 
@@ -118,6 +161,47 @@ class Kahi_ror_affiliations(KahiBase):
             )
             client.close()
 
+    def process_ror_file(self):
+        """
+        Inserts the ROR records of the dump in file_path that are not in the affiliations collection,
+        the ids in the collection are loaded with a single query and the new records are inserted
+        with insert_many in batches of bulk_size records.
+        """
+        print(f"Processing {self.file_path}...")
+        with MongoClient(self.mongodb_url) as client:
+            collection = client[self.config["database_name"]]["affiliations"]
+            existing_ids = set()
+            for reg in collection.find({}, {"external_ids.id": 1}):
+                for ext in reg["external_ids"]:
+                    existing_ids.add(ext["id"])
+            inserted = 0
+            batch = []
+            for inst in ror_records(self.file_path):
+                if inst["id"] in existing_ids:
+                    continue
+                existing_ids.add(inst["id"])
+                batch.append(ror_entry(inst, self.empty_affiliation()))
+                if len(batch) >= self.bulk_size:
+                    inserted += self.insert_batch(collection, batch)
+                    batch = []
+            if batch:
+                inserted += self.insert_batch(collection, batch)
+            print(f"INFO: {inserted} ROR affiliations inserted")
+
+    def insert_batch(self, collection, batch):
+        """
+        Inserts a batch of affiliations, returns the number of affiliations inserted.
+        """
+        try:
+            return len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as bwe:
+            for error in bwe.details["writeErrors"]:
+                print(f"ERROR: inserting ROR affiliation {error['op']['_id']}: {error['errmsg']}")
+            return bwe.details["nInserted"]
+
     def run(self):
-        self.process_ror()
+        if self.file_path:
+            self.process_ror_file()
+        else:
+            self.process_ror()
         return 0
@@ -4,6 +4,7 @@ from joblib import Parallel, delayed
 
 from mohan.Similarity import Similarity
 from kahi_scholar_works.process_one import process_one
+from kahi_scholar_works.es_buffer import ESBuffer
 
 
 class Kahi_scholar_works(KahiBase):
@@ -32,6 +33,8 @@ class Kahi_scholar_works(KahiBase):
                 - es_url: The url of the elasticsearch server.
                 - es_user: The user for the elasticsearch server.
                 - es_password: The password for the elasticsearch server.
+                - es_bulk_size: The number of works inserted together in elasticsearch.
+                - es_flush_on_search: If True the pending works are inserted in elasticsearch before a search that could find one of them.
         """
         self.config = config
 
@@ -80,6 +83,10 @@ class Kahi_scholar_works(KahiBase):
         ) else 1
         self.verbose = config["scholar_works"]["verbose"] if "verbose" in config["scholar_works"].keys(
         ) else 0
+        self.es_bulk_size = config["scholar_works"]["es_bulk_size"] if "es_bulk_size" in config["scholar_works"].keys(
+        ) else 100
+        self.es_flush_on_search = config["scholar_works"]["es_flush_on_search"] if "es_flush_on_search" in config["scholar_works"].keys(
+        ) else True
 
     def process_scholar(self):
         """
@@ -103,20 +110,32 @@ class Kahi_scholar_works(KahiBase):
         client = MongoClient(self.mongodb_url)
         db = client[self.config["database_name"]]
         collection = db["works"]
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=self.verbose,
-            backend="threading")(
-            delayed(process_one)(
-                paper,
-                db,
-                collection,
-                self.empty_work(),
-                False if self.task == "doi" else True,
-                es_handler=self.es_handler,
-                verbose=self.verbose
-            ) for paper in paper_cursor
-        )
+        # the works inserted in elasticsearch are written in batches
+        es_buffer = ESBuffer(self.es_handler, bulk_size=self.es_bulk_size, flush_on_search=self.es_flush_on_search,
+                             verbose=self.verbose) if self.es_handler else None
+        try:
+            Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend="threading")(
+                delayed(process_one)(
+                    paper,
+                    db,
+                    collection,
+                    self.empty_work(),
+                    False if self.task == "doi" else True,
+                    es_handler=es_buffer,
+                    verbose=self.verbose
+                ) for paper in paper_cursor
+            )
+        finally:
+            # the pending works are written even if a worker failed, they are already in the database
+            if es_buffer:
+                es_buffer.flush()
+        if es_buffer:
+            if self.verbose > 0:
+                print(f"INFO: elasticsearch buffer {es_buffer.info()}")
+            es_buffer.check()
         client.close()
 
     def run(self):
@@ -0,0 +1,226 @@
+# This module is shared by the works plugins (Kahi_minciencias_opendata_works, Kahi_openalex_works, Kahi_scholar_works and Kahi_scienti_works).
+# Every plugin is released and installed by itself, so each one has its own copy of the module,
+# keep the copies identical (only the package name in the imports changes), the CI checks it.
+from collections import deque
+from hunahpu.Similarity import ColavSimilarity
+from itertools import islice
+from threading import Lock
+from time import sleep
+
+
+class ESBuffer:
+    """
+    Write-behind buffer for the elasticsearch index of works.
+
+    The works are accumulated and sent with Similarity.insert_bulk when the buffer
+    reaches bulk_size works, instead of one index request plus one refresh per work.
+    The buffer has the same insert_work/search_work interface of mohan Similarity,
+    so it can be passed as es_handler, and it is thread safe.
+    By default the pending works are flushed (and the index refreshed) before a search
+    that could find one of them, so a search always sees the works inserted before it.
+    A bulk insert that fails is retried, if it still fails the exception is raised,
+    the works rejected one by one are counted as errors and check fails at the end of the run.
+    The last works inserted are kept, so a batch searched with one multi-search request can check
+    the works inserted by all the threads after its search (see mark and inserted_since).
+    """
+
+    def __init__(self, es_handler, bulk_size=100, flush_on_search=True, max_retries=3, history=10000, verbose=0):
+        """
+        Parameters:
+        -----------
+        es_handler : mohan.Similarity.Similarity
+            Elasticsearch handler of the works index.
+        bulk_size : int
+            Number of works per bulk insert.
+        flush_on_search : bool
+            If True the pending works are written before a search that could find one of them.
+        max_retries : int
+            Number of retries of a bulk insert that fails, with exponential backoff.
+        history : int
+            Number of the last works inserted that are kept for inserted_since.
+        verbose : int
+            Verbosity level.
+        """
+        self.es_handler = es_handler
+        self.bulk_size = bulk_size
+        self.flush_on_search = flush_on_search
+        self.max_retries = max_retries
+        self.verbose = verbose
+        self.counters = {"batches": 0, "inserted": 0, "errors": 0}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._entries = []
+        self._inflight = []
+        self._inserted = deque(maxlen=history)
+        self._inserted_count = 0
+
+    def insert_work(self, _id, work):
+        """
+        Add a work to the buffer, the values are normalized as in Similarity.insert_work.
+
+        Parameters:
+        -----------
+        _id : str
+            Id of the work (mongodb id as string).
+        work : dict
+            Work with title, source, year, volume, issue, pages, authors and provenance.
+        """
+        for key in work.keys():
+            if key == "authors":
+                work["authors"] = [self.es_handler.str_normilize(
+                    author) for author in work["authors"]]
+            else:
+                work[key] = self.es_handler.str_normilize(str(work[key]))
+        with self._lock:
+            self._entries.append(
+                {"_index": self.es_handler.es_index, "_id": _id, "_source": work})
+            self._inserted.append(work)
+            self._inserted_count += 1
+            full = len(self._entries) >= self.bulk_size
+        if full:
+            self.flush()
+
+    def search_work(self, **kwargs):
+        """
+        Search a work with Similarity.search_work, see its documentation for the parameters.
+        """
+        if self.flush_on_search and self.could_match([kwargs]):
+            self.flush()
+        return self.es_handler.search_work(**kwargs)
+
+    def could_match(self, queries):
+        """
+        Check if a work in the buffer (or being written) could be a hit of any of the searches,
+        comparing title, source and year as the hits are selected.
+        The searches with use_es_thold select the hits by score, so any pending work could be one.
+
+        Parameters:
+        -----------
+        queries : list
+            List of dicts with the keyword arguments of Similarity.search_work.
+        """
+        with self._lock:
+            works = [entry["_source"] for entry in self._entries + self._inflight]
+        if not works:
+            return False
+        for query in queries:
+            if "use_es_thold" in query.keys() and query["use_es_thold"]:
+                return True
+            year = str(query["year"]) if "year" in query.keys() and query["year"] is not None else ""
+            paper = {
+                "title": self.es_handler.str_normilize(query["title"]) if isinstance(query["title"], str) else "",
+                "journal": self.es_handler.str_normilize(query["source"]) if isinstance(query["source"], str) else "",
+                "year": year if year.isdigit() else ""
+            }
+            for work in works:
+                other = {
+                    "title": work["title"],
+                    "journal": work["source"] if "source" in work.keys() else "",
+                    "year": work["year"] if "year" in work.keys() and work["year"].isdigit() else ""
+                }
+                if ColavSimilarity(dict(paper), other,
+                                   ratio_thold=query["ratio_thold"] if "ratio_thold" in query.keys() else 90,
+                                   partial_thold=query["partial_thold"] if "partial_thold" in query.keys() else 92,
+                                   low_thold=query["low_thold"] if "low_thold" in query.keys() else 81):
+                    return True
+        return False
+
+    def mark(self):
+        """
+        Returns the number of works inserted so far, to get the works inserted after it with inserted_since.
+        """
+        with self._lock:
+            return self._inserted_count
+
+    def inserted_since(self, mark):
+        """
+        Returns the works inserted (by any thread) after the mark, flushed or not,
+        or None if some of them are not kept anymore (more than history works were inserted).
+
+        Parameters:
+        -----------
+        mark : int
+            The value of mark before the search.
+        """
+        with self._lock:
+            count = self._inserted_count - mark
+            if count > len(self._inserted):
+                return None
+            return list(islice(reversed(self._inserted), count))
+
+    def pending(self):
+        """
+        Returns the number of works in the buffer.
+        """
+        with self._lock:
+            return len(self._entries)
+
+    def flush(self):
+        """
+        Write the works in the buffer with a bulk insert and refresh the index.
+        """
+        # the flush lock keeps the searches waiting until the works of other threads are searchable
+        with self._flush_lock:
+            with self._lock:
+                entries = self._entries
+                self._entries = []
+                self._inflight = entries
+            if not entries:
+                return
+            try:
+                inserted, errors = self._insert(entries)
+            finally:
+                with self._lock:
+                    self._inflight = []
+            if errors:
+                print(
+                    f"ERROR: {errors} of {len(entries)} works of a bulk insert in {self.es_handler.es_index} were not inserted")
+            with self._lock:
+                self.counters["batches"] += 1
+                self.counters["inserted"] += inserted
+                self.counters["errors"] += errors
+            if self.verbose > 4:
+                print(
+                    f"INFO: bulk insert of {len(entries)} works in elasticsearch, totals {self.counters}")
+
+    def _insert(self, entries):
+        for retry in range(self.max_retries + 1):
+            try:
+                inserted, errors = self.es_handler.insert_bulk(
+                    entries, refresh=True)
+                return inserted, len(errors) if isinstance(errors, list) else errors
+            except Exception as e:
+                if retry == self.max_retries:
+                    # the works are already in the database, without them the next searches would insert duplicates
+                    with self._lock:
+                        self.counters["batches"] += 1
+                        self.counters["errors"] += len(entries)
+                    print(
+                        f"ERROR: bulk insert of {len(entries)} works in {self.es_handler.es_index} failed", e)
+                    raise
+                print(
+                    f"WARNING: bulk insert of {len(entries)} works in {self.es_handler.es_index} failed, retrying", e)
+                sleep(2 ** retry)
+
+    def info(self):
+        """
+        Returns the counters of the buffer (batches, inserted and errors).
+        """
+        with self._lock:
+            return dict(self.counters)
+
+    def check(self):
+        """
+        Raise an exception if any work of the buffer was not inserted, to be called after the last flush.
+        """
+        errors = self.info()["errors"]
+        if errors > 0:
+            raise Exception(
+                f"{errors} works were not inserted in {self.es_handler.es_index}, see the errors above")
+
+    def close(self):
+        """
+        Write the pending works and close the elasticsearch handler.
+        """
+        self.flush()
+        self.es_handler.close()
@@ -106,8 +106,8 @@ def process_one_insert(scholar_reg, db, collection, empty_work, es_handler, verb
         Collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
     verbose : int, optional
         Verbosity level. The default is 0.
     """
@@ -285,8 +285,8 @@ def process_one(scholar_reg, db, collection, empty_work, similarity, es_handler,
         Collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
     verbose : int, optional
         Verbosity level. The default is 0.
     """
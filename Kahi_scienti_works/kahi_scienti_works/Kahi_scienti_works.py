@@ -1,7 +1,10 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
-from kahi_scienti_works.process_one import process_one
+from kahi_scienti_works.process_one import process_one, process_batch
+from kahi_scienti_works.bulk_writer import BulkWriter
+from kahi_scienti_works.es_buffer import ESBuffer
+from kahi_scienti_works.similarity import work_batches
 from mohan.Similarity import Similarity
 from kahi_impactu_utils.Utils import doi_processor
 import re
@@ -26,6 +29,11 @@ class Kahi_scienti_works(KahiBase):
                 - task: the task to be performed. It can be "doi" or "all"
                 - num_jobs: the number of jobs to be used in parallel processing
                 - verbose: the verbosity level
+                - bulk_size: the number of inserts/updates written together
+                - bulk_max_age: the maximum number of seconds an insert/update waits to be written
+                - es_bulk_size: the number of works inserted together in elasticsearch
+                - es_flush_on_search: if True the pending works are inserted in elasticsearch before a search that could find one of them
+                - search_batch_size: the number of works without doi searched together in elasticsearch
                 - databases: a list of dictionaries with the following keys:
                     - database_url: the URL for the MongoDB database
                     - database_name: the name of the database
@@ -70,6 +78,16 @@ class Kahi_scienti_works(KahiBase):
         ) else 1
         self.verbose = config["scienti_works"]["verbose"] if "verbose" in config["scienti_works"].keys(
         ) else 0
+        self.bulk_size = config["scienti_works"]["bulk_size"] if "bulk_size" in config["scienti_works"].keys(
+        ) else 1000
+        self.bulk_max_age = config["scienti_works"]["bulk_max_age"] if "bulk_max_age" in config["scienti_works"].keys(
+        ) else 60
+        self.es_bulk_size = config["scienti_works"]["es_bulk_size"] if "es_bulk_size" in config["scienti_works"].keys(
+        ) else 100
+        self.es_flush_on_search = config["scienti_works"]["es_flush_on_search"] if "es_flush_on_search" in config["scienti_works"].keys(
+        ) else True
+        self.search_batch_size = config["scienti_works"]["search_batch_size"] if "search_batch_size" in config["scienti_works"].keys(
+        ) else 100
 
         # checking if the databases and collections are available
         self.check_databases_and_collections()
@@ -88,7 +106,7 @@ class Kahi_scienti_works(KahiBase):
                                                                     db_info['collection_name']))
             client.close()
 
-    def process_doi_group(self, group, db, collection, collection_scienti, empty_work, es_handler, similarity, verbose=0):
+    def process_doi_group(self, group, db, collection, collection_scienti, empty_work, es_handler, similarity, writer=None, verbose=0):
         """
         This method processes a group of documents with the same DOI.
         This allows to process the documents in parallel without having to worry about the DOI being processed more than once.
@@ -111,13 +129,15 @@ class Kahi_scienti_works(KahiBase):
             The Elasticsearch handler to be used for similarity checks. Take a look in Mohan package.
         similarity : bool
             A flag to indicate if similarity checks should be performed if doi is not available.
+        writer : BulkWriter
+            The buffered writer of the works collection shared by the threads.
         verbose : int
             The verbosity level. Default is 0.
         """
         for i in group["ids"]:
             reg = collection_scienti.find_one({"_id": i})
             process_one(reg, db, collection, empty_work,
-                        es_handler, similarity, verbose)
+                        es_handler, similarity, writer=writer, verbose=verbose)
 
     def process_scienti(self, db, collection, config):
         """
@@ -142,6 +162,12 @@ class Kahi_scienti_works(KahiBase):
         """
         client = MongoClient(config["database_url"])
         scienti = client[config["database_name"]][config["collection_name"]]
+        # the inserts and updates of all the threads are written in batches
+        writer = BulkWriter(collection, bulk_size=self.bulk_size,
+                            max_age=self.bulk_max_age, verbose=self.verbose)
+        # and the works inserted in elasticsearch too
+        es_buffer = ESBuffer(self.es_handler, bulk_size=self.es_bulk_size, flush_on_search=self.es_flush_on_search,
+                             verbose=self.verbose) if self.es_handler else None
         types_level0 = ['111', '112', '113', '114',  # articulos
                         '121', '122',  # Trabajos en eventos
                         '131', '132', '133', '134', '135', '136', '137', '138', '139', '140',  # libros
@@ -154,109 +180,126 @@ class Kahi_scienti_works(KahiBase):
                         '61', '62', '63', '64', '65', '66'  # Trabajos dirigidos/Tutorías
                         ]
 
-        if self.task == "doi":
-            pipeline = [
-                {"$match": {"product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}}},
-                {"$match": {"TXT_DOI": {"$ne": None}}},
-                {"$match": {"TXT_NME_PROD_FILTRO": {"$ne": None}}},
-                {"$match": {"TXT_NME_PROD": {"$ne": " "}}},
-                {"$project": {"doi": {"$trim": {"input": "$TXT_DOI"}}}},
-                {"$project": {"doi": {"$toLower": "$doi"}}},
-                {"$group": {"_id": "$doi", "ids": {"$push": "$_id"}}}
-            ]
-            paper_group_doi_cursor = scienti.aggregate(
-                pipeline)  # update for doi and not doi
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(self.process_doi_group)(
-                    doi_group,
-                    db,
-                    collection,
-                    scienti,
-                    self.empty_work(),
-                    self.es_handler,
-                    similarity=False,
-                    verbose=self.verbose
-                ) for doi_group in paper_group_doi_cursor
-            )
-        else:
-            # correr doi processor para TXT_DOI y TXT_WEBSITE*
-            # saco los dois malos y luego hago un find $in sobre esos COD_RH /COD_PRODUCTO y paso el cursor a parallel
+        try:
+            if self.task == "doi":
+                pipeline = [
+                    {"$match": {"product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}}},
+                    {"$match": {"TXT_DOI": {"$ne": None}}},
+                    {"$match": {"TXT_NME_PROD_FILTRO": {"$ne": None}}},
+                    {"$match": {"TXT_NME_PROD": {"$ne": " "}}},
+                    {"$project": {"doi": {"$trim": {"input": "$TXT_DOI"}}}},
+                    {"$project": {"doi": {"$toLower": "$doi"}}},
+                    {"$group": {"_id": "$doi", "ids": {"$push": "$_id"}}}
+                ]
+                paper_group_doi_cursor = scienti.aggregate(
+                    pipeline)  # update for doi and not doi
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend="threading")(
+                    delayed(self.process_doi_group)(
+                        doi_group,
+                        db,
+                        collection,
+                        scienti,
+                        self.empty_work(),
+                        es_buffer,
+                        similarity=False,
+                        writer=writer,
+                        verbose=self.verbose
+                    ) for doi_group in paper_group_doi_cursor
+                )
+            else:
+                # correr doi processor para TXT_DOI y TXT_WEBSITE*
+                # saco los dois malos y luego hago un find $in sobre esos COD_RH /COD_PRODUCTO y paso el cursor a parallel
 
-            pipeline = [
-                {"$match": {"product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}}},
-                {"$match": {"TXT_DOI": {"$ne": None}}},
-                {"$match": {"TXT_NME_PROD_FILTRO": {"$ne": None}}},
-                {"$match": {"TXT_NME_PROD": {"$ne": " "}}},
-                {"$project": {"doi": {"$trim": {"input": "$TXT_DOI"}},
-                              "web_doi": {"$trim": {"input": "$TXT_WEB_PRODUCTO"}}}},
-                {"$project": {"doi": {"$toLower": "$doi"},
-                              "web_doi": {"$toLower": "$web_doi"}}},
-                {"$group": {"_id": {"doi": "$doi", "web_doi": "$web_doi"},
-                            "ids": {"$push": "$_id"}}}
-            ]
-            paper_group_doi_cursor = scienti.aggregate(
-                pipeline)  # update for doi and not doi
+                pipeline = [
+                    {"$match": {"product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}}},
+                    {"$match": {"TXT_DOI": {"$ne": None}}},
+                    {"$match": {"TXT_NME_PROD_FILTRO": {"$ne": None}}},
+                    {"$match": {"TXT_NME_PROD": {"$ne": " "}}},
+                    {"$project": {"doi": {"$trim": {"input": "$TXT_DOI"}},
+                                  "web_doi": {"$trim": {"input": "$TXT_WEB_PRODUCTO"}}}},
+                    {"$project": {"doi": {"$toLower": "$doi"},
+                                  "web_doi": {"$toLower": "$web_doi"}}},
+                    {"$group": {"_id": {"doi": "$doi", "web_doi": "$web_doi"},
+                                "ids": {"$push": "$_id"}}}
+                ]
+                paper_group_doi_cursor = scienti.aggregate(
+                    pipeline)  # update for doi and not doi
 
-            works_nodoi = []
-            count = 0
-            for scienti_reg in paper_group_doi_cursor:
-                count += 1
-                if scienti_reg["_id"]["doi"]:
-                    doi = doi_processor(scienti_reg["_id"]["doi"])
-                if not doi:
-                    if "web_doi" in scienti_reg["_id"].keys() and scienti_reg["_id"]["web_doi"] and "10." in scienti_reg["_id"]["web_doi"]:
-                        doi = doi_processor(scienti_reg["_id"]["web_doi"])
-                        if doi:
-                            extracted_doi = re.compile(
-                                r'10\.\d{4,9}/[-._;()/:A-Z0-9]+', re.IGNORECASE).match(doi)
-                            if extracted_doi:
-                                doi = extracted_doi.group(0)
-                                for keyword in ['abstract', 'homepage', 'tpmd200765', 'event_abstract']:
-                                    doi = doi.split(
-                                        f'/{keyword}')[0] if keyword in doi else doi
-                if not doi:
-                    works_nodoi.extend(scienti_reg["ids"])
-            print(f"INFO: processing {len(works_nodoi)} records with bad dois")
-            paper_cursor = scienti.find(
-                {"_id": {"$in": works_nodoi}, "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(process_one)(
-                    work,
-                    db,
-                    collection,
-                    self.empty_work(),
-                    self.es_handler,
-                    similarity=True,
-                    verbose=self.verbose
-                ) for work in paper_cursor
-            )
+                works_nodoi = []
+                count = 0
+                for scienti_reg in paper_group_doi_cursor:
+                    count += 1
+                    if scienti_reg["_id"]["doi"]:
+                        doi = doi_processor(scienti_reg["_id"]["doi"])
+                    if not doi:
+                        if "web_doi" in scienti_reg["_id"].keys() and scienti_reg["_id"]["web_doi"] and "10." in scienti_reg["_id"]["web_doi"]:
+                            doi = doi_processor(scienti_reg["_id"]["web_doi"])
+                            if doi:
+                                extracted_doi = re.compile(
+                                    r'10\.\d{4,9}/[-._;()/:A-Z0-9]+', re.IGNORECASE).match(doi)
+                                if extracted_doi:
+                                    doi = extracted_doi.group(0)
+                                    for keyword in ['abstract', 'homepage', 'tpmd200765', 'event_abstract']:
+                                        doi = doi.split(
+                                            f'/{keyword}')[0] if keyword in doi else doi
+                    if not doi:
+                        works_nodoi.extend(scienti_reg["ids"])
+                print(f"INFO: processing {len(works_nodoi)} records with bad dois")
+                paper_cursor = scienti.find(
+                    {"_id": {"$in": works_nodoi}, "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend="threading")(
+                    delayed(process_batch)(
+                        works,
+                        db,
+                        collection,
+                        self.empty_work(),
+                        es_buffer,
+                        writer=writer,
+                        verbose=self.verbose
+                    ) for works in work_batches(paper_cursor, self.search_batch_size)
+                )
 
-            paper_cursor = scienti.find(
-                {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
-            paper_cursor_count = scienti.count_documents(
-                {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
-            print(f"INFO: processing {paper_cursor_count} records without doi")
+                paper_cursor = scienti.find(
+                    {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
+                paper_cursor_count = scienti.count_documents(
+                    {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
+                print(f"INFO: processing {paper_cursor_count} records without doi")
 
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(process_one)(
-                    work,
-                    db,
-                    collection,
-                    self.empty_work(),
-                    self.es_handler,
-                    similarity=True,
-                    verbose=self.verbose
-                ) for work in paper_cursor
-            )
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend="threading")(
+                    delayed(process_batch)(
+                        works,
+                        db,
+                        collection,
+                        self.empty_work(),
+                        es_buffer,
+                        writer=writer,
+                        verbose=self.verbose
+                    ) for works in work_batches(paper_cursor, self.search_batch_size)
+                )
+        finally:
+            # the buffered operations are written even if a worker failed,
+            # the works inserted in elasticsearch already have their _id
+            try:
+                writer.flush()
+            finally:
+                if es_buffer:
+                    es_buffer.flush()
+        if self.verbose > 0:
+            print(f"INFO: works bulk writer {writer.info()}")
+            if es_buffer:
+                print(f"INFO: elasticsearch buffer {es_buffer.info()}")
+        writer.check()
+        if es_buffer:
+            es_buffer.check()
         client.close()
 
     def run(self):
@@ -1,5 +1,6 @@
 from kahi_impactu_utils.Utils import lang_poll, doi_processor, check_date_format
 from time import time
+from copy import deepcopy
 import re
 from kahi_impactu_utils.String import text_to_inverted_index
 
@@ -17,7 +18,8 @@ def parse_scienti(reg, empty_work, doi=None, verbose=0):
     verbose : int
         The verbosity level. Default is 0.
     """
-    entry = empty_work.copy()
+    # deep copy, the template is shared by the records of a batch
+    entry = deepcopy(empty_work)
     entry["updated"] = [{"source": "scienti", "time": int(time())}]
     title = reg["TXT_NME_PROD"].strip().replace("\t", "").replace('"', '')
     lang = lang_poll(title, verbose=verbose)
@@ -3,6 +3,9 @@ from kahi_impactu_utils.Utils import lang_poll, doi_processor, compare_author, s
 import re
 from time import time
 from bson import ObjectId
+from kahi_scienti_works.bulk_writer import BulkWriter
+from kahi_scienti_works.es_buffer import ESBuffer
+from kahi_scienti_works.similarity import search_works, inserted_after_search
 
 
 def cod_product_mismatch(list1, list2):
@@ -274,7 +277,7 @@ def process_author(entry, colav_reg, db, verbose=0):
                     break
 
 
-def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbose=0):
+def process_one_update(scienti_reg, colav_reg, db, writer, empty_work, verbose=0):
     """
     Method to update a register in the kahi database from scholar database if it is found.
     This means that the register is already on the kahi database and it is being updated with new information.
@@ -288,8 +291,8 @@ def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbo
         Register from the colav database (kahi database for impactu)
     db: pymongo.collection.Collection
         Database where ETL result is stored
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
+    writer : BulkWriter
+        Buffered writer of the collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
     verbose : int, optional
@@ -437,7 +440,7 @@ def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbo
             if not group_reg:
                 print(
                     f'WARNING: group with ids {scienti_reg["group"]["COD_ID_GRUPO"]} and {scienti_reg["group"]["NRO_ID_GRUPO"]} not found in affiliation')
-    collection.update_one(
+    writer.update_one(
         {"_id": colav_reg["_id"]},
         {"$set": {
             "updated": colav_reg["updated"],
@@ -451,11 +454,13 @@ def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbo
             "authors": colav_reg["authors"],
             "subjects": colav_reg["subjects"],
             "groups": colav_reg["groups"]
-        }}
+        }},
+        keys=[str(colav_reg["_id"])] + [ext["id"]
+                                        for ext in colav_reg["external_ids"]]
     )
 
 
-def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=None, verbose=0):
+def process_one_insert(scienti_reg, db, writer, empty_work, es_handler, doi=None, verbose=0):
     """
     Function to insert a new register in the database if it is not found in the colav(kahi works) database.
     This means that the register is not on the database and it is being inserted.
@@ -472,12 +477,12 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
         Register from the scienti database
     db : pymongo.database.Database
         Database where the colav collections are stored, used to search for authors and affiliations.
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
+    writer : BulkWriter
+        Buffered writer of the collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
     verbose : int, optional
         Verbosity level. The default is 0.
     """
@@ -676,7 +681,8 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
                     f'WARNING: group with ids {scienti_reg["group"]["COD_ID_GRUPO"]} and {scienti_reg["group"]["NRO_ID_GRUPO"]} not found in affiliation')
 
     # insert in mongo
-    response = collection.insert_one(entry)
+    inserted_id = writer.insert_one(
+        entry, keys=[ext["id"] for ext in entry["external_ids"]])
     # insert in elasticsearch
     if es_handler:
         work = {}
@@ -696,31 +702,26 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
         work["authors"] = authors
         work["provenance"] = "scienti"
 
-        es_handler.insert_work(_id=str(response.inserted_id), work=work)
+        es_handler.insert_work(_id=str(inserted_id), work=work)
     else:
         if verbose > 4:
             print("No elasticsearch index provided")
 
 
-def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity, verbose=0):
+def scienti_doi(scienti_reg):
     """
-    Function to process a single register from the scienti database.
-    This function is used to insert or update a register in the colav(kahi works) database.
+    Function to get the doi of a register from the scienti database,
+    from TXT_DOI or from TXT_WEB_PRODUCTO.
 
     Parameters
     ----------
     scienti_reg : dict
         Register from the scienti database
-    db : pymongo.database.Database
-        Database where the colav collections are stored, used to search for authors and affiliations.
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
-    empty_work : dict
-        Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
-    verbose : int, optional
-        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    str or None
+        The doi of the register.
     """
     doi = None
     # register has doi
@@ -738,82 +739,201 @@ def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity,
                     for keyword in ['abstract', 'homepage', 'tpmd200765', 'event_abstract']:
                         doi = doi.split(
                             f'/{keyword}')[0] if keyword in doi else doi
+    return doi
+
+
+def work_query(entry):
+    """
+    Function to get the search parameters of a parsed register for the elasticsearch index.
+
+    Parameters
+    ----------
+    entry : dict
+        Register parsed with parse_scienti.
+
+    Returns
+    -------
+    dict
+        Keyword arguments of Similarity.search_work.
+    """
+    authors = []
+    for author in entry['authors']:
+        if len(authors) >= 5:
+            break
+        if "full_name" in author.keys():
+            authors.append(author["full_name"])
+    return {
+        "title": entry["titles"][0]["title"],
+        "source": entry["source"]["name"] if "name" in entry["source"].keys() else "",
+        "year": str(entry["year_published"] if entry["year_published"] else "0"),
+        "authors": authors,
+        "volume": entry["bibliographic_info"]["volume"] if "volume" in entry["bibliographic_info"].keys() else "",
+        "issue": entry["bibliographic_info"]["issue"] if "issue" in entry["bibliographic_info"].keys() else "",
+        "page_start": entry["bibliographic_info"]["first_page"] if "first_page" in entry["bibliographic_info"].keys() else "",
+        "page_end": entry["bibliographic_info"]["last_page"] if "last_page" in entry["bibliographic_info"].keys() else ""
+    }
+
+
+def process_one_similarity(scienti_reg, entry, response, db, collection, writer, empty_work, es_handler, verbose=0):
+    """
+    Function to update or insert a register without doi according to the elasticsearch response.
+
+    Parameters
+    ----------
+    scienti_reg : dict
+        Register from the scienti database
+    entry : dict
+        The register parsed with parse_scienti.
+    response : dict
+        The hit of Similarity.search_work for the register, None if it was not found.
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    writer : BulkWriter
+        Buffered writer of the works collection.
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    if response:  # register already on db... update accordingly
+        with writer.claim(response["_id"]):
+            colav_reg = collection.find_one(
+                {"_id": ObjectId(response["_id"])})
+            if colav_reg:
+                # TODO: add author check here before to do the update
+                if has_scienti_source(entry["external_ids"]) and has_scienti_source(colav_reg["external_ids"]):
+                    if cod_product_mismatch(entry["external_ids"], colav_reg["external_ids"]):
+                        # if they have the same COD_RH  but different COD_PRODUCTO
+                        # then insert the new register
+                        process_one_insert(scienti_reg, db, writer,
+                                           empty_work, es_handler, doi=None, verbose=verbose)
+                        return
+                if has_scienti_source(entry["types"]) and has_scienti_source(colav_reg["types"]):
+                    # if type is equal, then update the register
+                    if check_first_level_type(entry["types"], colav_reg["types"]):
+                        process_one_update(scienti_reg, colav_reg, db,
+                                           writer, empty_work, verbose)
+                    else:
+                        process_one_insert(scienti_reg, db, writer,
+                                           empty_work, es_handler, doi=None, verbose=verbose)
+                else:  # there is not scienti types to compare, then update them
+                    process_one_update(scienti_reg, colav_reg, db,
+                                       writer, empty_work, verbose)
+
+            else:
+                if verbose > 4:
+                    print("Register with {} not found in mongodb".format(
+                        response["_id"]))
+                    print(response)
+    else:  # insert new register
+        process_one_insert(scienti_reg, db, writer,
+                           empty_work, es_handler, doi=None, verbose=verbose)
+
+
+def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity, writer=None, verbose=0):
+    """
+    Function to process a single register from the scienti database.
+    This function is used to insert or update a register in the colav(kahi works) database.
+
+    Parameters
+    ----------
+    scienti_reg : dict
+        Register from the scienti database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    writer : BulkWriter
+        Buffered writer of the works collection shared by the threads,
+        if None the operations of the register are written immediately.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    if writer is None:
+        writer = BulkWriter(collection, bulk_size=1, raise_on_error=True, verbose=verbose)
+    doi = scienti_doi(scienti_reg)
     if doi:
-        # is the doi in colavdb?
-        colav_reg = collection.find_one({"external_ids.id": doi})
-
-        if colav_reg:  # update the register
-            process_one_update(
-                scienti_reg, colav_reg, db, collection, empty_work, verbose=verbose)
-        else:  # insert a new register
-            process_one_insert(
-                scienti_reg, db, collection, empty_work, es_handler, doi, verbose=verbose)
+        # the doi is processed by one thread at a time and its pending operations are written before the query
+        with writer.claim(doi):
+            # is the doi in colavdb?
+            colav_reg = collection.find_one({"external_ids.id": doi})
+
+            if colav_reg:  # update the register
+                process_one_update(
+                    scienti_reg, colav_reg, db, writer, empty_work, verbose=verbose)
+            else:  # insert a new register
+                process_one_insert(
+                    scienti_reg, db, writer, empty_work, es_handler, doi, verbose=verbose)
     elif similarity:  # does not have a doi identifier
         # elasticsearch section
         if es_handler:
             # Search in elasticsearch
             entry = parse_scienti(
                 scienti_reg, empty_work.copy(), verbose=verbose)
-            work = {}
-            work["title"] = entry["titles"][0]["title"]
-            work["source"] = entry["source"]["name"] if "name" in entry["source"].keys(
-            ) else ""
-            work["year"] = entry["year_published"] if entry["year_published"] else "0"
-            work["volume"] = entry["bibliographic_info"]["volume"] if "volume" in entry["bibliographic_info"].keys() else ""
-            work["issue"] = entry["bibliographic_info"]["issue"] if "issue" in entry["bibliographic_info"].keys() else ""
-            work["first_page"] = entry["bibliographic_info"]["first_page"] if "first_page" in entry["bibliographic_info"].keys() else ""
-            work["last_page"] = entry["bibliographic_info"]["last_page"] if "last_page" in entry["bibliographic_info"].keys() else ""
-            authors = []
-            for author in entry['authors']:
-                if len(authors) >= 5:
-                    break
-                if "full_name" in author.keys():
-                    authors.append(author["full_name"])
-            work["authors"] = authors
-            work["provenance"] = "scienti"
-            response = es_handler.search_work(
-                title=work["title"],
-                source=work["source"],
-                year=str(work["year"]),
-                authors=authors,
-                volume=work["volume"],
-                issue=work["issue"],
-                page_start=work["first_page"],
-                page_end=work["last_page"]
-            )
-
-            if response:  # register already on db... update accordingly
-                colav_reg = collection.find_one(
-                    {"_id": ObjectId(response["_id"])})
-                if colav_reg:
-                    # TODO: add author check here before to do the update
-                    if has_scienti_source(entry["external_ids"]) and has_scienti_source(colav_reg["external_ids"]):
-                        if cod_product_mismatch(entry["external_ids"], colav_reg["external_ids"]):
-                            # if they have the same COD_RH  but different COD_PRODUCTO
-                            # then insert the new register
-                            process_one_insert(scienti_reg, db, collection,
-                                               empty_work, es_handler, doi=None, verbose=verbose)
-                            return
-                    if has_scienti_source(entry["types"]) and has_scienti_source(colav_reg["types"]):
-                        # if type is equal, then update the register
-                        if check_first_level_type(entry["types"], colav_reg["types"]):
-                            process_one_update(scienti_reg, colav_reg, db,
-                                               collection, empty_work, verbose)
-                        else:
-                            process_one_insert(scienti_reg, db, collection,
-                                               empty_work, es_handler, doi=None, verbose=verbose)
-                    else:  # there is not scienti types to compare, then update them
-                        process_one_update(scienti_reg, colav_reg, db,
-                                           collection, empty_work, verbose)
-
-                else:
-                    if verbose > 4:
-                        print("Register with {} not found in mongodb".format(
-                            response["_id"]))
-                        print(response)
-            else:  # insert new register
-                process_one_insert(scienti_reg, db, collection,
-                                   empty_work, es_handler, doi=None, verbose=verbose)
+            response = es_handler.search_work(**work_query(entry))
+            process_one_similarity(scienti_reg, entry, response, db, collection,
+                                   writer, empty_work, es_handler, verbose=verbose)
         else:
             if verbose > 4:
                 print("No elasticsearch index provided")
+
+
+def process_batch(scienti_regs, db, collection, empty_work, es_handler, writer=None, verbose=0):
+    """
+    Function to process a batch of registers from the scienti database with similarity.
+    The registers with doi are processed with process_one, the others are searched in elasticsearch
+    with one multi-search request and then they are updated or inserted as in process_one.
+
+    A register not found that is similar to a work inserted after the multi-search (by any thread
+    with ESBuffer, else by a previous register of the batch) is searched again before inserting it.
+
+    Parameters
+    ----------
+    scienti_regs : list
+        Registers from the scienti database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity or ESBuffer
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class or its write-behind buffer.
+    writer : BulkWriter
+        Buffered writer of the works collection shared by the threads,
+        if None the operations of the registers are written immediately.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    if writer is None:
+        writer = BulkWriter(collection, bulk_size=1, raise_on_error=True, verbose=verbose)
+    pending = []
+    for scienti_reg in scienti_regs:
+        if scienti_doi(scienti_reg) or not es_handler:
+            process_one(scienti_reg, db, collection, empty_work,
+                        es_handler, True, writer=writer, verbose=verbose)
+        else:
+            pending.append(scienti_reg)
+    if not pending:
+        return
+    entries = [parse_scienti(scienti_reg, empty_work.copy(), verbose=verbose)
+               for scienti_reg in pending]
+    queries = [work_query(entry) for entry in entries]
+    mark = es_handler.mark() if isinstance(es_handler, ESBuffer) else None
+    responses = search_works(es_handler, queries)
+    not_found = []
+    for scienti_reg, entry, query, response in zip(pending, entries, queries, responses):
+        if not response and inserted_after_search(es_handler, query, mark, not_found):
+            response = es_handler.search_work(**query)
+        if not response:
+            not_found.append(query)
+        process_one_similarity(scienti_reg, entry, response, db, collection,
+                               writer, empty_work, es_handler, verbose=verbose)
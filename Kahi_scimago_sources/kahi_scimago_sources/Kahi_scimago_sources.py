@@ -1,5 +1,5 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne
 from datetime import datetime as dt
 from time import time
 from pandas import read_csv
@@ -24,11 +24,21 @@ class Kahi_scimago_sources(KahiBase):
 
         self.scimago_file_paths = self.config["scimago_sources"]["file_path"]
 
+        self.bulk_size = self.config["scimago_sources"]["bulk_size"] if "bulk_size" in self.config["scimago_sources"].keys(
+        ) else 1000
+
         self.already_in_db = []
 
+        # sources of the database and new sources by issn, filled by resolve_issns and process_scimago
+        self.sources_by_issn = {}
+        # sources to update and to insert by _id, written at the end by write_sources
+        self.updated_sources = {}
+        self.new_sources = []
+
     def update_scimago(self, sjr, entry):
-        _id = entry["_id"]
-        del (entry["_id"])
+        """
+        Updates (in memory) a source with the record of the scimago file of the current year.
+        """
 
         for upd in entry["updated"]:
             if upd["source"] == "scimago":
@@ -63,6 +73,7 @@ class Kahi_scimago_sources(KahiBase):
             extid = extid[:4] + "-" + extid[4:]
             if extid not in ids:
                 entry["external_ids"].append({"source": "issn", "id": extid})
+                self.sources_by_issn.setdefault(extid, entry)
 
         rankings = [(rank["source"], rank["from_date"], rank["to_date"])
                     for rank in entry["ranking"]]
@@ -123,10 +134,52 @@ class Kahi_scimago_sources(KahiBase):
                 "subjects": scimago_subjects
             })
 
-        self.collection.update_one({"_id": _id}, {"$set": entry})
+        # the new sources do not have _id until they are inserted by write_sources
+        if "_id" in entry.keys():
+            self.updated_sources[entry["_id"]] = entry
+
+    def issn_variants(self, issn_list):
+        """
+        Returns the issns (with the dash) of the Issn field of a scimago record.
+        """
+        ext_ids = []
+        for issn in issn_list.split(","):
+            issn = issn.strip()
+            ext_ids.append(issn[:4] + "-" + issn[4:])
+        return ext_ids
+
+    def resolve_issns(self, issn_lists):
+        """
+        Finds the sources of the database with the issns of the scimago files,
+        with one query for every bulk_size issns.
+
+        Parameters:
+        ----------
+        issn_lists : iterable
+            The unique values of the Issn field of the scimago files.
+        """
+        extids = list({extid for issn_list in issn_lists for extid in self.issn_variants(issn_list)})
+        sources = {}
+        for i in range(0, len(extids), self.bulk_size):
+            chunk = extids[i:i + self.bulk_size]
+            for reg in self.collection.find({"external_ids.id": {"$in": chunk}}):
+                # a source found in several chunks is the same entry
+                reg = sources.setdefault(reg["_id"], reg)
+                for ext in reg["external_ids"]:
+                    if ext["id"] in chunk and ext["id"] not in self.sources_by_issn.keys():
+                        self.sources_by_issn[ext["id"]] = reg
 
     def process_scimago(self):
-        for issn_list in self.scimago["Issn"].unique():
+        """
+        Processes the records of the scimago file of the current year,
+        the first record of every Issn updates the source found with one of its issns
+        or creates a new source.
+        """
+        records = {}
+        for sjr in self.scimago.to_dict("records"):
+            if sjr["Issn"] not in records.keys():
+                records[sjr["Issn"]] = sjr
+        for issn_list, sjr in records.items():
             db_found = False
             db_reg = None
             ext_ids = []
@@ -134,7 +187,7 @@ class Kahi_scimago_sources(KahiBase):
             for issn in issn_list.split(","):
                 issn = issn.strip()
                 extid = issn[:4] + "-" + issn[4:]
-                db_reg = self.collection.find_one({"external_ids.id": extid})
+                db_reg = self.sources_by_issn.get(extid)
                 if db_reg:
                     found_issn = issn
                     db_found = True
@@ -142,14 +195,10 @@ class Kahi_scimago_sources(KahiBase):
                 ext_ids.append({"source": "issn", "id": extid})
             if db_found:
                 self.already_in_db.append(found_issn)
-                sjr = self.scimago[self.scimago["Issn"] == issn_list]
-                sjr = sjr.iloc[0]
                 self.update_scimago(sjr, db_reg)
             else:
                 entry = self.empty_source()
                 entry["updated"] = [{"source": "scimago", "time": int(time())}]
-                sjr = self.scimago[self.scimago["Issn"] == issn_list]
-                sjr = sjr.iloc[0]
                 entry["types"].append(
                     {"source": "scimago", "type": sjr["Type"]})
                 entry["external_ids"] = ext_ids
@@ -234,17 +283,41 @@ class Kahi_scimago_sources(KahiBase):
                     "source": "Scimago",
                     "subjects": scimago_subjects
                 })
-                self.collection.insert_one(entry)
+                # the next years of the source are merged in this entry
+                for ext in ext_ids:
+                    self.sources_by_issn[ext["id"]] = entry
+                self.new_sources.append(entry)
+
+    def write_sources(self):
+        """
+        Writes the new and updated sources with bulk writes of bulk_size operations.
+        """
+        operations = [InsertOne(entry) for entry in self.new_sources]
+        for _id, entry in self.updated_sources.items():
+            entry = {key: value for key, value in entry.items() if key != "_id"}
+            operations.append(UpdateOne({"_id": _id}, {"$set": entry}))
+        for i in range(0, len(operations), self.bulk_size):
+            self.collection.bulk_write(
+                operations[i:i + self.bulk_size], ordered=False)
+        print(
+            f"INFO: scimago sources inserted {len(self.new_sources)}, updated {len(self.updated_sources)}")
 
     def run(self):
+        # all the files are read first to resolve their issns in the database at once,
+        # then the years are merged in memory and every source is written only once
+        files = []
         for filename in self.scimago_file_paths:
+            files.append((filename, read_csv(filename,
+                                             sep=";", dtype={"Sourceid": str})))
+        self.resolve_issns({issn_list for _, scimago in files for issn_list in scimago["Issn"].unique()})
+        for filename, scimago in files:
             self.scimago_year = int(
                 filename.replace(".csv", "").split(" ")[-1])
             self.scimago_start_ts = dt.strptime(
                 "01 01 " + str(self.scimago_year), "%d %m %Y").timestamp()
             self.scimago_end_ts = dt.strptime(
                 "31 12 " + str(self.scimago_year), "%d %m %Y").timestamp()
-            self.scimago = read_csv(filename,
-                                    sep=";", dtype={"Sourceid": str})
+            self.scimago = scimago
             self.process_scimago()
+        self.write_sources()
         return 0
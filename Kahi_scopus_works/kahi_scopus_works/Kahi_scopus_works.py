@@ -5,6 +5,7 @@ from joblib import Parallel, delayed
 from math import isnan
 from re import split, UNICODE
 from kahi_impactu_utils.Utils import doi_processor, lang_poll
+from kahi_scopus_works.bulk_writer import BulkWriter
 
 
 def parse_scopus(reg, empty_work, verbose=0):
@@ -129,134 +130,120 @@ def parse_scopus(reg, empty_work, verbose=0):
     return entry
 
 
-def process_one(scopus_reg, db, collection, empty_work, verbose=0):
+def process_one(scopus_reg, db, collection, empty_work, writer=None, verbose=0):
     doi = None
     # register has doi
     if scopus_reg["DOI"]:
         if isinstance(scopus_reg["DOI"], str):
             doi = doi_processor(scopus_reg["DOI"])
+    if writer is None:
+        writer = BulkWriter(collection, bulk_size=1, raise_on_error=True, verbose=verbose)
     if doi:
-        # is the doi in colavdb?
-        colav_reg = collection.find_one({"external_ids.id": doi})
-        if colav_reg:  # update the register
-            # updated
-            for upd in colav_reg["updated"]:
-                if upd["source"] == "scopus":
-                    # client.close()
-                    return None  # Register already on db
-                    # Could be updated with new information when scopus database changes
-            entry = parse_scopus(
-                scopus_reg, empty_work.copy(), verbose=verbose)
-            colav_reg["updated"].append(
-                {"source": "scopus", "time": int(time())})
-            # titles
-            colav_reg["titles"].extend(entry["titles"])
-            # external_ids
-            ext_ids = [ext["id"] for ext in colav_reg["external_ids"]]
-            for ext in entry["external_ids"]:
-                if ext["id"] not in ext_ids:
-                    colav_reg["external_ids"].append(ext)
-                    ext_ids.append(ext["id"])
-            # types
-            colav_reg["types"].append(
-                {"source": "scopus", "type": entry["types"][0]["type"]})
-            # open access
-            if "is_open_acess" not in colav_reg["bibliographic_info"].keys():
-                if "is_open_access" in entry["bibliographic_info"].keys():
-                    colav_reg["bibliographic_info"]["is_open_acess"] = entry["bibliographic_info"]["is_open_access"]
-            if "open_access_status" not in colav_reg["bibliographic_info"].keys():
-                if "open_access_status" in entry["bibliographic_info"].keys():
-                    colav_reg["bibliographic_info"]["open_access_status"] = entry["bibliographic_info"]["open_access_status"]
-            # external urls
-            urls_sources = [url["source"]
-                            for url in colav_reg["external_urls"]]
-            for ext in entry["external_urls"]:
-                if ext["url"] not in urls_sources:
-                    colav_reg["external_urls"].append(ext)
-                    urls_sources.append(ext["url"])
+        # the doi is processed by one thread at a time and its pending operations are written before the query
+        with writer.claim(doi):
+            # is the doi in colavdb?
+            colav_reg = collection.find_one({"external_ids.id": doi})
+            if colav_reg:  # update the register
+                # updated
+                for upd in colav_reg["updated"]:
+                    if upd["source"] == "scopus":
+                        # client.close()
+                        return None  # Register already on db
+                        # Could be updated with new information when scopus database changes
+                entry = parse_scopus(
+                    scopus_reg, empty_work.copy(), verbose=verbose)
+                colav_reg["updated"].append(
+                    {"source": "scopus", "time": int(time())})
+                # titles
+                colav_reg["titles"].extend(entry["titles"])
+                # external_ids
+                ext_ids = [ext["id"] for ext in colav_reg["external_ids"]]
+                for ext in entry["external_ids"]:
+                    if ext["id"] not in ext_ids:
+                        colav_reg["external_ids"].append(ext)
+                        ext_ids.append(ext["id"])
+                # types
+                colav_reg["types"].append(
+                    {"source": "scopus", "type": entry["types"][0]["type"]})
+                # open access
+                if "is_open_acess" not in colav_reg["bibliographic_info"].keys():
+                    if "is_open_access" in entry["bibliographic_info"].keys():
+                        colav_reg["bibliographic_info"]["is_open_acess"] = entry["bibliographic_info"]["is_open_access"]
+                if "open_access_status" not in colav_reg["bibliographic_info"].keys():
+                    if "open_access_status" in entry["bibliographic_info"].keys():
+                        colav_reg["bibliographic_info"]["open_access_status"] = entry["bibliographic_info"]["open_access_status"]
+                # external urls
+                urls_sources = [url["source"]
+                                for url in colav_reg["external_urls"]]
+                for ext in entry["external_urls"]:
+                    if ext["url"] not in urls_sources:
+                        colav_reg["external_urls"].append(ext)
+                        urls_sources.append(ext["url"])
 
-            # citations count
-            if entry["citations_count"]:
-                colav_reg["citations_count"].extend(entry["citations_count"])
+                # citations count
+                if entry["citations_count"]:
+                    colav_reg["citations_count"].extend(entry["citations_count"])
 
-            collection.update_one(
-                {"_id": colav_reg["_id"]},
-                {"$set": {
-                    "updated": colav_reg["updated"],
-                    "titles": colav_reg["titles"],
-                    "external_ids": colav_reg["external_ids"],
-                    "types": colav_reg["types"],
-                    "bibliographic_info": colav_reg["bibliographic_info"],
-                    "external_urls": colav_reg["external_urls"],
-                    "citations_count": colav_reg["citations_count"],
-                    "citations_by_year": colav_reg["citations_by_year"]
-                }}
-            )
-        else:  # insert a new register
-            # parse
-            entry = parse_scopus(
-                scopus_reg, empty_work.copy(), verbose=verbose)
-            # link
-            source_db = None
-            if "external_ids" in entry["source"].keys():
-                for ext in entry["source"]["external_ids"]:
-                    source_db = db["sources"].find_one(
-                        {"external_ids.id": ext["id"]})
-                    if source_db:
-                        break
-            if source_db:
-                name = source_db["names"][0]["name"]
-                for n in source_db["names"]:
-                    if n["lang"] == "es":
-                        name = n["name"]
-                        break
-                    if n["lang"] == "en":
-                        name = n["name"]
-                entry["source"] = {
-                    "id": source_db["_id"],
-                    "name": name
-                }
-            else:
-                if len(entry["source"]["external_ids"]) == 0:
-                    if verbose > 4:
-                        print(
-                            f'Register with doi: {scopus_reg["DOI"]} does not provide a source')
+                writer.update_one(
+                    {"_id": colav_reg["_id"]},
+                    {"$set": {
+                        "updated": colav_reg["updated"],
+                        "titles": colav_reg["titles"],
+                        "external_ids": colav_reg["external_ids"],
+                        "types": colav_reg["types"],
+                        "bibliographic_info": colav_reg["bibliographic_info"],
+                        "external_urls": colav_reg["external_urls"],
+                        "citations_count": colav_reg["citations_count"],
+                        "citations_by_year": colav_reg["citations_by_year"]
+                    }},
+                    keys=[ext["id"] for ext in colav_reg["external_ids"]]
+                )
+            else:  # insert a new register
+                # parse
+                entry = parse_scopus(
+                    scopus_reg, empty_work.copy(), verbose=verbose)
+                # link
+                source_db = None
+                if "external_ids" in entry["source"].keys():
+                    for ext in entry["source"]["external_ids"]:
+                        source_db = db["sources"].find_one(
+                            {"external_ids.id": ext["id"]})
+                        if source_db:
+                            break
+                if source_db:
+                    name = source_db["names"][0]["name"]
+                    for n in source_db["names"]:
+                        if n["lang"] == "es":
+                            name = n["name"]
+                            break
+                        if n["lang"] == "en":
+                            name = n["name"]
+                    entry["source"] = {
+                        "id": source_db["_id"],
+                        "name": name
+                    }
                 else:
-                    if verbose > 4:
-                        print("No source found for\n\t",
-                              entry["source"]["external_ids"])
-                entry["source"] = {
-                    "id": "",
-                    "name": entry["source"]["name"]
-                }
+                    if len(entry["source"]["external_ids"]) == 0:
+                        if verbose > 4:
+                            print(
+                                f'Register with doi: {scopus_reg["DOI"]} does not provide a source')
+                    else:
+                        if verbose > 4:
+                            print("No source found for\n\t",
+                                  entry["source"]["external_ids"])
+                    entry["source"] = {
+                        "id": "",
+                        "name": entry["source"]["name"]
+                    }
 
-            # search authors and affiliations in db
-            for i, author in enumerate(entry["authors"]):
-                author_db = None
-                for ext in author["external_ids"]:
-                    author_db = db["person"].find_one(
-                        {"external_ids.id": ext["id"]})
-                    if author_db:
-                        break
-                if author_db:
-                    sources = [ext["source"]
-                               for ext in author_db["external_ids"]]
-                    ids = [ext["id"] for ext in author_db["external_ids"]]
+                # search authors and affiliations in db
+                for i, author in enumerate(entry["authors"]):
+                    author_db = None
                     for ext in author["external_ids"]:
-                        if ext["id"] not in ids:
-                            author_db["external_ids"].append(ext)
-                            sources.append(ext["source"])
-                            ids.append(ext["id"])
-                    entry["authors"][i] = {
-                        "id": author_db["_id"],
-                        "full_name": author_db["full_name"],
-                        "affiliations": author["affiliations"]
-                    }
-                    if "external_ids" in author.keys():
-                        del (author["external_ids"])
-                else:
-                    author_db = db["person"].find_one(
-                        {"full_name": author["full_name"]})
+                        author_db = db["person"].find_one(
+                            {"external_ids.id": ext["id"]})
+                        if author_db:
+                            break
                     if author_db:
                         sources = [ext["source"]
                                    for ext in author_db["external_ids"]]
@@ -271,38 +258,39 @@ def process_one(scopus_reg, db, collection, empty_work, verbose=0):
                             "full_name": author_db["full_name"],
                             "affiliations": author["affiliations"]
                         }
+                        if "external_ids" in author.keys():
+                            del (author["external_ids"])
                     else:
-                        entry["authors"][i] = {
-                            "id": "",
-                            "full_name": author["full_name"],
-                            "affiliations": author["affiliations"]
-                        }
-                for j, aff in enumerate(author["affiliations"]):
-                    aff_db = None
-                    if "external_ids" in aff.keys():
-                        for ext in aff["external_ids"]:
-                            aff_db = db["affiliations"].find_one(
-                                {"external_ids.id": ext["id"]})
-                            if aff_db:
-                                break
-                    if aff_db:
-                        name = aff_db["names"][0]["name"]
-                        for n in aff_db["names"]:
-                            if n["source"] == "ror":
-                                name = n["name"]
-                                break
-                            if n["lang"] == "en":
-                                name = n["name"]
-                            if n["lang"] == "es":
-                                name = n["name"]
-                        entry["authors"][i]["affiliations"][j] = {
-                            "id": aff_db["_id"],
-                            "name": name,
-                            "types": aff_db["types"]
-                        }
-                    else:
-                        aff_db = db["affiliations"].find_one(
-                            {"names.name": aff["name"]})
+                        author_db = db["person"].find_one(
+                            {"full_name": author["full_name"]})
+                        if author_db:
+                            sources = [ext["source"]
+                                       for ext in author_db["external_ids"]]
+                            ids = [ext["id"] for ext in author_db["external_ids"]]
+                            for ext in author["external_ids"]:
+                                if ext["id"] not in ids:
+                                    author_db["external_ids"].append(ext)
+                                    sources.append(ext["source"])
+                                    ids.append(ext["id"])
+                            entry["authors"][i] = {
+                                "id": author_db["_id"],
+                                "full_name": author_db["full_name"],
+                                "affiliations": author["affiliations"]
+                            }
+                        else:
+                            entry["authors"][i] = {
+                                "id": "",
+                                "full_name": author["full_name"],
+                                "affiliations": author["affiliations"]
+                            }
+                    for j, aff in enumerate(author["affiliations"]):
+                        aff_db = None
+                        if "external_ids" in aff.keys():
+                            for ext in aff["external_ids"]:
+                                aff_db = db["affiliations"].find_one(
+                                    {"external_ids.id": ext["id"]})
+                                if aff_db:
+                                    break
                         if aff_db:
                             name = aff_db["names"][0]["name"]
                             for n in aff_db["names"]:
@@ -319,16 +307,35 @@ def process_one(scopus_reg, db, collection, empty_work, verbose=0):
                                 "types": aff_db["types"]
                             }
                         else:
-                            entry["authors"][i]["affiliations"][j] = {
-                                "id": "",
-                                "name": aff["name"],
-                                "types": []
-                            }
+                            aff_db = db["affiliations"].find_one(
+                                {"names.name": aff["name"]})
+                            if aff_db:
+                                name = aff_db["names"][0]["name"]
+                                for n in aff_db["names"]:
+                                    if n["source"] == "ror":
+                                        name = n["name"]
+                                        break
+                                    if n["lang"] == "en":
+                                        name = n["name"]
+                                    if n["lang"] == "es":
+                                        name = n["name"]
+                                entry["authors"][i]["affiliations"][j] = {
+                                    "id": aff_db["_id"],
+                                    "name": name,
+                                    "types": aff_db["types"]
+                                }
+                            else:
+                                entry["authors"][i]["affiliations"][j] = {
+                                    "id": "",
+                                    "name": aff["name"],
+                                    "types": []
+                                }
 
-            entry["author_count"] = len(entry["authors"])
-            # insert in mongo
-            collection.insert_one(entry)
-            # insert in elasticsearch
+                entry["author_count"] = len(entry["authors"])
+                # insert in mongo
+                writer.insert_one(
+                    entry, keys=[ext["id"] for ext in entry["external_ids"]])
+                # insert in elasticsearch
     else:  # does not have a doi identifier
         # elasticsearch section
         pass
@@ -371,6 +378,10 @@ class Kahi_scopus_works(KahiBase):
         ) else 1
         self.verbose = config["scopus_works"]["verbose"] if "verbose" in config["scopus_works"].keys(
         ) else 0
+        self.bulk_size = config["scopus_works"]["bulk_size"] if "bulk_size" in config["scopus_works"].keys(
+        ) else 1000
+        self.bulk_max_age = config["scopus_works"]["bulk_max_age"] if "bulk_max_age" in config["scopus_works"].keys(
+        ) else 60
 
         self.client.close()
 
@@ -379,19 +390,30 @@ class Kahi_scopus_works(KahiBase):
         with MongoClient(self.mongodb_url) as client:
             db = client[self.config["database_name"]]
             collection = db["works"]
+            # the inserts and updates of all the threads are written in batches
+            writer = BulkWriter(collection, bulk_size=self.bulk_size,
+                                max_age=self.bulk_max_age, verbose=self.verbose)
 
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(process_one)(
-                    paper,
-                    db,
-                    collection,
-                    self.empty_work(),
-                    verbose=self.verbose
-                ) for paper in paper_list
-            )
+            try:
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend="threading")(
+                    delayed(process_one)(
+                        paper,
+                        db,
+                        collection,
+                        self.empty_work(),
+                        writer=writer,
+                        verbose=self.verbose
+                    ) for paper in paper_list
+                )
+            finally:
+                # the buffered operations are written even if a worker failed
+                writer.flush()
+            if self.verbose > 0:
+                print(f"INFO: works bulk writer {writer.info()}")
+            writer.check()
 
     def run(self):
         self.process_scopus()
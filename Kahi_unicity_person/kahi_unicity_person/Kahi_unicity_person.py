@@ -1,5 +1,7 @@
 from kahi_impactu_utils.Utils import compare_author, split_names, split_names_fix
-from pymongo import MongoClient, TEXT
+from kahi_unicity_person.doi_clusters import compare_doi_group, doi_clusters, id_group_chunks
+from kahi_unicity_person.blocking import blocking_keys, group_size_bucket
+from pymongo import MongoClient, TEXT, UpdateOne, DeleteOne
 from joblib import Parallel, delayed
 from kahi.KahiBase import KahiBase
 from bson import ObjectId
@@ -44,6 +46,23 @@ class Kahi_unicity_person(KahiBase):
         self.verbose = config["unicity_person"][
             "verbose"] if "verbose" in config["unicity_person"].keys() else 0
 
+        self.doi_engine = config["unicity_person"]["doi_engine"] if "doi_engine" in config["unicity_person"].keys(
+        ) else "union_find"
+
+        self.doi_chunk_size = config["unicity_person"]["doi_chunk_size"] if "doi_chunk_size" in config["unicity_person"].keys(
+        ) else 10000
+
+        self.id_batch_size = config["unicity_person"]["id_batch_size"] if "id_batch_size" in config["unicity_person"].keys(
+        ) else 100
+
+        self.blocking = config["unicity_person"]["blocking"] if "blocking" in config["unicity_person"].keys(
+        ) else True
+        # compare_author is pure python, a process backend compares the doi groups in parallel
+        self.compare_backend = config["unicity_person"]["compare_backend"] if "compare_backend" in config["unicity_person"].keys(
+        ) else "loky"
+        # counters of the comparisons by size of the doi groups
+        self.blocking_counters = {}
+
     # Function to merge affiliations
 
     def merge_affiliations(self, target_doc, doc):
@@ -108,11 +127,11 @@ class Kahi_unicity_person(KahiBase):
         for field in fields:
             if not target[field]:
                 target[field] = source[field]
-    # Function to merge, store and delete documents
+    # Function to merge documents in memory
 
-    def merge_documents(self, authors_docs, target_doc):
+    def merge_target(self, authors_docs, target_doc):
         """
-        Merges information from multiple author documents into a target document, updates the target document in the collection, and deletes other documents.
+        Merges information from multiple author documents into a target document in memory.
 
         Parameters:
         ----------
@@ -122,8 +141,11 @@ class Kahi_unicity_person(KahiBase):
             A list of author documents containing information to be merged into the target document.
         target_doc : dict
             The target document where information will be merged.
-        collection : Collection
-            The MongoDB collection to be used.
+
+        Returns:
+        ----------
+        list
+            The documents merged into the target document.
         """
         target_id = target_doc["_id"]
         other_docs = []
@@ -169,6 +191,27 @@ class Kahi_unicity_person(KahiBase):
                 # we need to think is a strategy
                 # self.merge_affiliations(target_doc, doc)
                 other_docs.append(doc)
+        return other_docs
+
+    # Function to merge, store and delete documents
+
+    def merge_documents(self, authors_docs, target_doc):
+        """
+        Merges information from multiple author documents into a target document, updates the target document in the collection, and deletes other documents.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        authors_docs : list
+            A list of author documents containing information to be merged into the target document.
+        target_doc : dict
+            The target document where information will be merged.
+        collection : Collection
+            The MongoDB collection to be used.
+        """
+        target_id = target_doc["_id"]
+        other_docs = self.merge_target(authors_docs, target_doc)
         # Update the target document with new external ids
         for other_doc in other_docs:
             if target_id != other_doc["_id"]:  # double check
@@ -254,6 +297,58 @@ class Kahi_unicity_person(KahiBase):
         self.collection_merged_sets.insert_one(
             {"source": _id, _id: reg["_id"], "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": [aid["_id"] for aid in author_docs]})
 
+    # Function to process a chunk of groups of authors based on ids
+
+    def id_unicity_batch(self, regs, _id, verbose=0):
+        """
+        Checks unicity by id among many groups of author documents.
+        The documents of all the groups are fetched with a single query and merged in memory,
+        then the merged documents, the deletions and the target documents are written
+        with one bulk_write each and the sets with one insert_many.
+        The groups that share documents have to be in the same chunk (see id_group_chunks).
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        regs : list
+            A list of registries of aggregated author documents by id.
+        _id : str
+            The source of the id (ex: orcid).
+        """
+        author_ids = list({ObjectId(aid) for reg in regs for aid in reg["document_ids"]})
+        docs = {doc["_id"]: doc for doc in self.collection.find(
+            {"_id": {"$in": author_ids}})}
+        merged = {}
+        targets = {}
+        sets = []
+        for reg in regs:
+            # the documents merged by a previous group of the chunk are not in docs anymore
+            author_docs = [docs[ObjectId(aid)]
+                           for aid in reg["document_ids"] if ObjectId(aid) in docs.keys()]
+            if not author_docs:
+                if verbose > 4:
+                    print("No authors found with the provided IDs.")
+                continue
+            target_doc = self.find_target_doc(author_docs, "orcid")
+            for other_doc in self.merge_target(author_docs, target_doc):
+                merged[other_doc["_id"]] = other_doc
+                targets.pop(other_doc["_id"], None)
+                del docs[other_doc["_id"]]
+            targets[target_doc["_id"]] = target_doc
+            sets.append({"source": _id, _id: reg["_id"], "target_author": {
+                        "_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": [aid["_id"] for aid in author_docs]})
+        if merged:
+            self.collection_merged.bulk_write([UpdateOne({"_id": _id_doc}, {"$set": doc}, upsert=True)
+                                               for _id_doc, doc in merged.items()], ordered=False)
+            self.collection.bulk_write([DeleteOne({"_id": _id_doc})
+                                        for _id_doc in merged.keys()], ordered=False)
+        if targets:
+            self.collection.bulk_write([UpdateOne({"_id": _id_doc}, {"$set": doc})
+                                        for _id_doc, doc in targets.items()], ordered=False)
+        if sets:
+            self.collection_merged_sets.insert_many(sets)
+
     # Function to compare authors based on DOI
 
     def doi_unicity(self, reg, jobs, verbose=0):
@@ -324,6 +419,114 @@ class Kahi_unicity_person(KahiBase):
             self.collection_merged_sets.insert_one(
                 {"source": "doi", "doi": reg["_id"], "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": author_found})
 
+    # Function to find the pairs of similar authors of many DOI groups
+
+    def doi_pairs(self, regs):
+        """
+        Finds the pairs of similar authors of a chunk of DOI groups (phase one of the union-find engine).
+        The author documents of all the groups are fetched once with a projection and
+        the groups are compared in parallel with compare_backend, the blocking keys are
+        computed for the authors of the chunk only and released with it.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        regs : list
+            A list of registries of aggregated author documents by DOI.
+
+        Returns:
+        ----------
+        list
+            List of (doi, pairs of similar author ids) of every group.
+        """
+        author_ids = list({aid for reg in regs for aid in reg["authors"]})
+        author_docs = {}
+        blocks = {}
+        for doc in self.collection.find({"_id": {"$in": author_ids}}, {
+                "first_names": 1, "last_names": 1, "full_name": 1, "updated": 1, "external_ids": 1, "initials": 1}):
+            author_docs[doc["_id"]] = doc
+            if self.blocking:
+                blocks[doc["_id"]] = blocking_keys(doc)
+        groups = []
+        for reg in regs:
+            docs = [author_docs[aid] for aid in reg["authors"] if aid in author_docs]
+            # only the keys of the group are sent to the worker
+            group_blocks = {doc["_id"]: blocks[doc["_id"]] for doc in docs} if self.blocking else None
+            groups.append((reg["_id"], docs, len(reg["authors"]), group_blocks))
+        results = Parallel(
+            n_jobs=self.n_jobs,
+            verbose=self.verbose,
+            backend=self.compare_backend)(
+            delayed(compare_doi_group)(
+                doi,
+                docs,
+                n_authors,
+                group_blocks
+            ) for doi, docs, n_authors, group_blocks in groups
+        )
+        groups_pairs = []
+        for reg, (doi, pairs, comparisons, skipped) in zip(regs, results):
+            bucket = group_size_bucket(len(reg["authors"]))
+            counters = self.blocking_counters.setdefault(
+                bucket, {"groups": 0, "comparisons": 0, "skipped": 0, "pairs": 0})
+            counters["groups"] += 1
+            counters["comparisons"] += comparisons
+            counters["skipped"] += skipped
+            counters["pairs"] += len(pairs)
+            groups_pairs.append((doi, pairs))
+        return groups_pairs
+
+    def print_blocking_counters(self):
+        """
+        Prints the counters of the comparisons of the DOI unicity by number of authors of the DOIs,
+        the skipped comparisons are the pairs of authors without a common blocking key.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        """
+        total = {"groups": 0, "comparisons": 0, "skipped": 0, "pairs": 0}
+        for bucket in sorted(self.blocking_counters.keys(), key=lambda x: int(x[2:])):
+            counters = self.blocking_counters[bucket]
+            for key in total.keys():
+                total[key] += counters[key]
+            calls = counters["comparisons"] + counters["skipped"]
+            print("INFO: DOIs with {} authors: {} groups, {} compare_author calls, {} skipped ({:.1f}%), {} pairs found".format(
+                bucket, counters["groups"], counters["comparisons"], counters["skipped"],
+                100 * counters["skipped"] / calls if calls else 0, counters["pairs"]))
+        calls = total["comparisons"] + total["skipped"]
+        print("INFO: DOI unicity total: {} groups, {} compare_author calls, {} skipped ({:.1f}%), {} pairs found".format(
+            total["groups"], total["comparisons"], total["skipped"],
+            100 * total["skipped"] / calls if calls else 0, total["pairs"]))
+
+    # Function to merge a cluster of authors found with DOI
+
+    def doi_cluster_unicity(self, author_ids, dois, verbose=0):
+        """
+        Merges a cluster of authors found by the union-find engine of DOI unicity (phase two).
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        author_ids : list
+            The ids of the authors of the cluster.
+        dois : list
+            The DOIs that connect the authors of the cluster.
+        """
+        author_docs = list(self.collection.find(
+            {"_id": {"$in": author_ids}}))
+        if not author_docs:
+            return
+
+        target_doc = self.find_target_doc(author_docs, "doi")
+        if target_doc:
+            self.merge_documents(author_docs, target_doc)
+        self.collection_merged_sets.insert_one(
+            {"source": "doi", "doi": dois[0], "dois": dois, "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": author_ids})
+
     def process_authors(self):
         """
         Processes authors' information including checking unicity by ORCID id and DOI among author documents.
@@ -354,16 +557,28 @@ class Kahi_unicity_person(KahiBase):
                         f"INFO: {task} unicity for groups of authors is started!")
                     print(
                         f"INFO: the number of groups are {len(authors_cursor)}")
-                    Parallel(
-                        n_jobs=self.n_jobs,
-                        verbose=self.verbose,
-                        backend="threading")(
-                        delayed(self.id_unicity)(
-                            reg,
-                            task,
-                            self.verbose
-                        ) for reg in authors_cursor
-                    )
+                    if self.id_batch_size > 1:
+                        Parallel(
+                            n_jobs=self.n_jobs,
+                            verbose=self.verbose,
+                            backend="threading")(
+                            delayed(self.id_unicity_batch)(
+                                chunk,
+                                task,
+                                self.verbose
+                            ) for chunk in id_group_chunks(authors_cursor, self.id_batch_size)
+                        )
+                    else:
+                        Parallel(
+                            n_jobs=self.n_jobs,
+                            verbose=self.verbose,
+                            backend="threading")(
+                            delayed(self.id_unicity)(
+                                reg,
+                                task,
+                                self.verbose
+                            ) for reg in authors_cursor
+                        )
                     if self.verbose > 1:
                         print(
                             f"INFO: {task} unicity for {len(authors_cursor)} groups of authors is done!")
@@ -389,20 +604,44 @@ class Kahi_unicity_person(KahiBase):
             print("INFO: DOI unicity for groups of authors is started!")
             print("INFO: Number of groups of authors to process: {}".format(
                 len(authors_cursor)))
-            print("INFO: Number of jobs set to 1, this can not be parallelized!")
-            # this can not be parallelized, because we need to merge the authors and delete the documents
-            # different dois can have the same authors and this can produce that the target author in one doi can not be the target in another doi
-            # then all the authors similar can be deleted
-            # at the moment jobs were hardcode to 1
-            Parallel(
-                n_jobs=1,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(self.doi_unicity)(
-                    reg,
-                    self.verbose
-                ) for reg in authors_cursor
-            )
+            if self.doi_engine == "union_find":
+                # phase one: pairs of similar authors of every doi group, compared in parallel
+                groups_pairs = []
+                for i in range(0, len(authors_cursor), self.doi_chunk_size):
+                    groups_pairs.extend(self.doi_pairs(
+                        authors_cursor[i:i + self.doi_chunk_size]))
+                # phase two: the pairs of all the dois are joined in disjoint clusters
+                # so the clusters can be merged in parallel without conflicts
+                clusters = doi_clusters(groups_pairs)
+                if self.verbose > 0:
+                    self.print_blocking_counters()
+                print("INFO: Number of clusters of authors to merge: {}".format(
+                    len(clusters)))
+                Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend="threading")(
+                    delayed(self.doi_cluster_unicity)(
+                        author_ids,
+                        dois,
+                        self.verbose
+                    ) for author_ids, dois in clusters
+                )
+            else:
+                print("INFO: Number of jobs set to 1, this can not be parallelized!")
+                # this can not be parallelized, because we need to merge the authors and delete the documents
+                # different dois can have the same authors and this can produce that the target author in one doi can not be the target in another doi
+                # then all the authors similar can be deleted
+                # at the moment jobs were hardcode to 1
+                Parallel(
+                    n_jobs=1,
+                    verbose=self.verbose,
+                    backend="threading")(
+                    delayed(self.doi_unicity)(
+                        reg,
+                        self.verbose
+                    ) for reg in authors_cursor
+                )
             if self.verbose > 1:
                 print("DOI unicity for {} groups of authors is done!".format(
                     len(authors_cursor)))
@@ -0,0 +1,60 @@
+from kahi_impactu_utils.Utils import normalize_name
+from re import split
+
+# sources of the external ids used by compare_author to match two authors
+id_sources = ["scienti", "scopus", "orcid", "scholar"]
+
+
+def name_tokens(name):
+    """
+    Function to split a name in normalized tokens (without accents, lower case and without punctuation).
+    """
+    return [token for token in split(r"[^a-z0-9]+", normalize_name(name)) if token]
+
+
+def blocking_keys(author):
+    """
+    Function to compute the blocking keys of an author, two authors can be matched by
+    compare_author only if they share at least one key.
+
+    The keys are the ids of the sources used by compare_author, the normalized full name
+    and the pairs of a name token with an initial (from the initials and the prefix of the names).
+    The tokens of the full name are used together with the first and last names, because
+    compare_author splits and fixes the full name when the names of one of the authors are missing.
+
+    Parameters:
+    ----------
+    author : dict
+        The author document (first_names, last_names, full_name, external_ids and initials).
+
+    Returns:
+    -------
+    frozenset
+        The blocking keys of the author.
+    """
+    keys = set()
+    for ext in author.get("external_ids", []):
+        if ext["source"] in id_sources:
+            keys.add("id:{}:{}".format(ext["source"], ext["id"]))
+    full_name = author.get("full_name", "") or ""
+    if full_name:
+        keys.add("fn:" + normalize_name(full_name))
+    tokens = set(name_tokens(full_name))
+    for name in author.get("first_names", []) + author.get("last_names", []):
+        tokens.update(name_tokens(name))
+    initials = {token[0] for token in tokens}
+    initials.update("".join(name_tokens(author.get("initials", "") or "")))
+    for token in tokens:
+        for initial in initials:
+            keys.add("ln:{}:{}".format(token, initial))
+    return frozenset(keys)
+
+
+def group_size_bucket(n_authors):
+    """
+    Function to get the bucket of the number of authors of a doi used in the blocking counters.
+    """
+    bucket = 10
+    while n_authors > bucket:
+        bucket *= 10
+    return "<={}".format(bucket)
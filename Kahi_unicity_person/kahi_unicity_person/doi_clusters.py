@@ -0,0 +1,139 @@
+from kahi_impactu_utils.Utils import compare_author
+
+# only the authors with a profile from these sources are compared with the others in a doi group
+doi_sources = ['staff', 'scienti', 'minciencias', "scholar"]
+
+
+def compare_doi_group(doi, author_docs, n_authors, blocks=None):
+    """
+    Function to find the pairs of similar authors in the group of authors of a doi.
+
+    Parameters:
+    ----------
+    doi : str
+        The doi of the group.
+    author_docs : list
+        The author documents of the group (first_names, last_names, full_name, updated, external_ids and initials).
+    n_authors : int
+        The number of authors of the doi, used by compare_author.
+    blocks : dict
+        Blocking keys of the authors by id, if given compare_author is only called
+        for the authors that share a key.
+
+    Returns:
+    -------
+    tuple
+        (doi, list of pairs of similar author ids, number of comparisons, number of skipped comparisons)
+    """
+    pairs = []
+    comparisons = 0
+    skipped = 0
+    for author in author_docs:
+        # Skip the author if the source of the profile is not in doi_sources
+        if not any(updt["source"] in doi_sources for updt in author["updated"]):
+            continue
+        for other_author in author_docs:
+            if author["_id"] == other_author["_id"]:
+                continue
+            if blocks is not None and blocks[author["_id"]].isdisjoint(blocks[other_author["_id"]]):
+                skipped += 1
+                continue
+            comparisons += 1
+            if compare_author(author, other_author, n_authors):
+                pairs.append((author["_id"], other_author["_id"]))
+    return doi, pairs, comparisons, skipped
+
+
+def find_root(parent, node):
+    """
+    Function to find the root of a node in the union-find forest, compressing the path.
+    """
+    root = node
+    while parent[root] != root:
+        root = parent[root]
+    while parent[node] != root:
+        parent[node], node = root, parent[node]
+    return root
+
+
+def union(parent, nodea, nodeb):
+    """
+    Function to join the sets of two nodes in the union-find forest.
+    """
+    for node in (nodea, nodeb):
+        if node not in parent:
+            parent[node] = node
+    roota = find_root(parent, nodea)
+    rootb = find_root(parent, nodeb)
+    if roota != rootb:
+        parent[rootb] = roota
+
+
+def doi_clusters(groups_pairs):
+    """
+    Function to build the final clusters of authors to merge from the pairs of all the doi groups,
+    two authors are in the same cluster if they are connected by a chain of pairs.
+
+    Parameters:
+    ----------
+    groups_pairs : list
+        List of (doi, pairs) returned by compare_doi_group.
+
+    Returns:
+    -------
+    list
+        List of (author ids, dois) of every cluster, the clusters are disjoint.
+    """
+    parent = {}
+    for doi, pairs in groups_pairs:
+        for nodea, nodeb in pairs:
+            union(parent, nodea, nodeb)
+    members = {}
+    dois = {}
+    for doi, pairs in groups_pairs:
+        for nodea, nodeb in pairs:
+            root = find_root(parent, nodea)
+            dois.setdefault(root, [])
+            if doi not in dois[root]:
+                dois[root].append(doi)
+    for node in parent.keys():
+        members.setdefault(find_root(parent, node), []).append(node)
+    return [(members[root], dois[root]) for root in members.keys()]
+
+
+def id_group_chunks(regs, chunk_size):
+    """
+    Function to split the groups of authors of the unicity by id in chunks of about chunk_size groups,
+    the groups that share a document are always in the same chunk, so the chunks can be merged
+    at the same time without merging a document that other chunk uses as target.
+
+    Parameters:
+    ----------
+    regs : list
+        List of groups of authors by id (with the key document_ids).
+    chunk_size : int
+        Number of groups per chunk, a chunk can be bigger if it has a set of groups that share documents.
+
+    Returns:
+    -------
+    list
+        List of chunks (lists of groups), the groups keep their order.
+    """
+    parent = {}
+    for i, reg in enumerate(regs):
+        parent[("group", i)] = ("group", i)
+        for aid in reg["document_ids"]:
+            union(parent, ("group", i), str(aid))
+    components = {}
+    for i, reg in enumerate(regs):
+        components.setdefault(find_root(parent, ("group", i)), []).append(reg)
+    chunks = []
+    chunk = []
+    for component in components.values():
+        if chunk and len(chunk) + len(component) > chunk_size:
+            chunks.append(chunk)
+            chunk = []
+        chunk.extend(component)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
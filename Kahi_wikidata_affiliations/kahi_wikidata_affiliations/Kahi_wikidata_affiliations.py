@@ -1,39 +1,44 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from time import time
 from joblib import Parallel, delayed
 
 
-def process_one(kahi_col, wikid_col, inst, verbose):
+# fields of the wikidata records used to update the institutions
+wikidata_projection = {"id": 1, "labels": 1, "claims.P154.mainsnak.datavalue.value": 1,
+                       "claims.P18.mainsnak.datavalue.value": 1}
+
+
+def wikidata_id_of(inst):
     """
-    This function processes one institution, and seve the the titles and images from wikidata.
+    Returns the wikidata id of an institution or None if it already has the names from wikidata.
+    """
+    for name in inst["names"]:
+        if name["source"] == "wikidata":
+            return None
+    for j in inst["external_ids"]:
+        if j["source"] == "wikidata":
+            return j["id"]
+    return None
+
+
+def wikidata_update(inst, rec):
+    """
+    This function adds to the institution the titles and images of the wikidata record.
     Images are taken from P154 (logo) or P18 (image) if P154 is not present then P18 is used.
 
     Parameters:
     ----------
-    kahi_col: pymongo.collection.Collection
-        collection of institutions
-    wikid_col: pymongo.collection.Collection
-        collection of wikidata records
     inst: dict
         institution record
-    verbose: int
-    """
-    for name in inst["names"]:
-        if name["source"] == "wikidata":
-            return
-    wikidata_id = None
-    for j in inst["external_ids"]:
-        if j["source"] == "wikidata":
-            wikidata_id = j["id"]
-            break
-    rec = wikid_col.find_one({"id": wikidata_id}, {
-                             "labels": 1, "claims.P154.mainsnak.datavalue.value": 1, "claims.P18.mainsnak.datavalue.value": 1})
+    rec: dict
+        wikidata record (labels, P154 and P18 claims)
 
-    if not rec:
-        if verbose > 4:
-            print(f"WARNING: record with id {wikidata_id} not found")
-        return
+    Returns:
+    -------
+    dict
+        The $set update of the institution.
+    """
     for lang in rec["labels"].keys():
         name = {"name": rec["labels"][lang]["value"], "lang": lang,
                 "source": "wikidata", "provenance": "wikidata"}
@@ -50,8 +55,87 @@ def process_one(kahi_col, wikid_col, inst, verbose):
         inst["external_urls"].append(
             {"provenance": "wikidata", "source": "logo", "url": url_img})
     inst["updated"].append({"source": "wikidata", "time": int(time())})
-    kahi_col.update_one({"_id": inst["_id"]}, {
-        "$set": {"names": inst["names"], "external_urls": inst["external_urls"], "updated": inst["updated"]}})
+    return {"$set": {"names": inst["names"], "external_urls": inst["external_urls"], "updated": inst["updated"]}}
+
+
+def process_one(kahi_col, wikid_col, inst, verbose):
+    """
+    This function processes one institution, and seve the the titles and images from wikidata.
+    Images are taken from P154 (logo) or P18 (image) if P154 is not present then P18 is used.
+
+    Parameters:
+    ----------
+    kahi_col: pymongo.collection.Collection
+        collection of institutions
+    wikid_col: pymongo.collection.Collection
+        collection of wikidata records
+    inst: dict
+        institution record
+    verbose: int
+    """
+    wikidata_id = wikidata_id_of(inst)
+    if wikidata_id is None:
+        return
+    rec = wikid_col.find_one({"id": wikidata_id}, wikidata_projection)
+
+    if not rec:
+        if verbose > 4:
+            print(f"WARNING: record with id {wikidata_id} not found")
+        return
+    kahi_col.update_one({"_id": inst["_id"]}, wikidata_update(inst, rec))
+
+
+def process_batch(kahi_col, wikid_col, insts, verbose):
+    """
+    This function processes a batch of institutions as process_one does, but the wikidata records
+    are fetched with one query and the institutions are updated with one bulk write.
+
+    Parameters:
+    ----------
+    kahi_col: pymongo.collection.Collection
+        collection of institutions
+    wikid_col: pymongo.collection.Collection
+        collection of wikidata records
+    insts: list
+        institution records
+    verbose: int
+    """
+    wikidata_ids = {}
+    for inst in insts:
+        wikidata_id = wikidata_id_of(inst)
+        if wikidata_id is not None:
+            wikidata_ids[inst["_id"]] = wikidata_id
+    if not wikidata_ids:
+        return
+    records = {}
+    for rec in wikid_col.find({"id": {"$in": list(set(wikidata_ids.values()))}}, wikidata_projection):
+        records[rec["id"]] = rec
+    updates = []
+    for inst in insts:
+        if inst["_id"] not in wikidata_ids.keys():
+            continue
+        wikidata_id = wikidata_ids[inst["_id"]]
+        if wikidata_id not in records.keys():
+            if verbose > 4:
+                print(f"WARNING: record with id {wikidata_id} not found")
+            continue
+        updates.append(UpdateOne({"_id": inst["_id"]}, wikidata_update(inst, records[wikidata_id])))
+    if updates:
+        kahi_col.bulk_write(updates, ordered=False)
+
+
+def institution_batches(cursor, batch_size):
+    """
+    Generator of lists of batch_size records of a cursor.
+    """
+    batch = []
+    for reg in cursor:
+        batch.append(reg)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 class Kahi_wikidata_affiliations(KahiBase):
@@ -72,6 +156,7 @@ class Kahi_wikidata_affiliations(KahiBase):
             database_name: wikidata
             collection_name: data
             num_jobs: 5
+            batch_size: 1000
             verbose: 5
 
         This has to be added in the workflow file in yml.
@@ -95,11 +180,31 @@ class Kahi_wikidata_affiliations(KahiBase):
         self.verbose = config["wikidata_affiliations"]["verbose"] if "verbose" in config["wikidata_affiliations"].keys(
         ) else 0
 
+        # number of institutions processed with one query to wikidata, 1 processes them one by one
+        self.batch_size = config["wikidata_affiliations"]["batch_size"] if "batch_size" in config["wikidata_affiliations"].keys(
+        ) else 1000
+
+        # create_index does nothing if the index already exists
         self.wikidata_col.create_index("id")
         self.wikidata_col.create_index(
             "claims.P31.mainsnak.datavalue.value.id")
 
     def process_wikidata(self):
+        if self.batch_size > 1:
+            institutions = self.collection.find(
+                {"external_ids.source": "wikidata", "names.source": {"$ne": "wikidata"}},
+                {"names": 1, "external_ids": 1, "external_urls": 1, "updated": 1},
+                no_cursor_timeout=True)
+            Parallel(
+                n_jobs=self.n_jobs,
+                backend="threading",
+                verbose=10
+            )(delayed(process_batch)(
+                self.collection, self.wikidata_col,
+                insts, self.verbose) for insts in institution_batches(institutions, self.batch_size))
+            institutions.close()
+            return
+
         institutions = list(self.collection.find(
             {"external_ids.source": "wikidata"}))
 
@@ -5,9 +5,20 @@ import requests
 from urllib.parse import unquote
 from thefuzz import fuzz
 from joblib import Parallel, delayed
+from kahi_wikipedia_affiliations.wikipedia_client import get_client
 
 
-def get_wikipedia_names(url="", name="", lang="en", verbose=0):
+def api_get(base, lang, params, client=None):
+    '''
+    Request to the wikipedia API, with the client if it is given (pool of connections,
+    rate limit and cache) else with a plain request to base.
+    '''
+    if client:
+        return client.get(lang, params)
+    return requests.get(base, params=params).json()
+
+
+def get_wikipedia_names(url="", name="", lang="en", verbose=0, client=None):
     '''
     Find the different possible names of a wikipedia entity.
     Right now it is only tested on organizations gotten from ror db
@@ -20,6 +31,8 @@ def get_wikipedia_names(url="", name="", lang="en", verbose=0):
         The name of keywords to do the search over wikipedia api
     lang : str
         The iso-639 lang code to fix the language endpooint of the search language
+    client : WikipediaClient
+        The client used for the requests, if None the requests are done without pool, rate limit and cache
 
     Returns
     -------
@@ -45,7 +58,7 @@ def get_wikipedia_names(url="", name="", lang="en", verbose=0):
         'srsearch': subject
     }
 
-    data = requests.get(base, params=params).json()
+    data = api_get(base, lang, params, client)
     entry = ""
     pageid = ""
     if "query" not in data.keys():
@@ -82,14 +95,13 @@ def get_wikipedia_names(url="", name="", lang="en", verbose=0):
             # 'explaintext': True,
         }
 
-        response = requests.get(base, params=params)
-        data = response.json()
+        data = api_get(base, lang, params, client)
         return data
     else:
         return None
 
 
-def get_logo_wikipedia(url="", name="", lang="en", verbose=5):
+def get_logo_wikipedia(url="", name="", lang="en", verbose=5, client=None):
     '''
     Find and image of a wikipedia page.
     Right now it is only tested for the logos of organizations gotten from ror db
@@ -102,6 +114,8 @@ def get_logo_wikipedia(url="", name="", lang="en", verbose=5):
         The name of keywords to do the search over wikipedia api
     lang : str
         The iso-639 lang code to fix the language endpooint of the search language
+    client : WikipediaClient
+        The client used for the requests, if None the requests are done without pool, rate limit and cache
 
     Returns
     -------
@@ -127,7 +141,7 @@ def get_logo_wikipedia(url="", name="", lang="en", verbose=5):
         'srsearch': subject
     }
 
-    data = requests.get(base, params=params).json()
+    data = api_get(base, lang, params, client)
     # print(data)
     entry = ""
     pageid = ""
@@ -161,8 +175,7 @@ def get_logo_wikipedia(url="", name="", lang="en", verbose=5):
             'prop': 'images'
         }
 
-        response = requests.get(base, params=params)
-        data = response.json()
+        data = api_get(base, lang, params, client)
         try:
             title = ""
             for img in data["query"]["pages"][str(pageid)]["images"]:
@@ -183,8 +196,7 @@ def get_logo_wikipedia(url="", name="", lang="en", verbose=5):
                 'prop': 'imageinfo',
                 'iiprop': "url"
             }
-            response = requests.get(base, params=params)
-            data = response.json()
+            data = api_get(base, lang, params, client)
             return data
         except Exception as e:
             if verbose > 5:
@@ -196,7 +208,7 @@ def get_logo_wikipedia(url="", name="", lang="en", verbose=5):
         return None
 
 
-def process_one_wikipedia_name(inst, url, db_name, verbose=0):
+def process_one_wikipedia_name(inst, url, db_name, verbose=0, client_options=None):
     for name in inst["names"]:
         if name["source"] == "wikipedia":
             return
@@ -218,12 +230,13 @@ def process_one_wikipedia_name(inst, url, db_name, verbose=0):
             print(
                 "No information could be used for wikipedia API query in ", inst["_id"])
         return
+    wiki_client = get_client(client_options) if client_options is not None else None
     result = {}
     res = []
     if wikipedia_url:
-        res = get_wikipedia_names(url=wikipedia_url, verbose=verbose)
+        res = get_wikipedia_names(url=wikipedia_url, verbose=verbose, client=wiki_client)
     elif wikipedia_name:
-        res = get_wikipedia_names(name=wikipedia_name, verbose=verbose)
+        res = get_wikipedia_names(name=wikipedia_name, verbose=verbose, client=wiki_client)
     try:
         k = list(res["query"]["pages"].keys())[0]
         result = {"response": res,
@@ -239,10 +252,10 @@ def process_one_wikipedia_name(inst, url, db_name, verbose=0):
         result = {"response": res, "names": []}
         if wikipedia_url:
             res = get_wikipedia_names(
-                url=wikipedia_url, lang="es", verbose=verbose)
+                url=wikipedia_url, lang="es", verbose=verbose, client=wiki_client)
         elif wikipedia_name:
             res = get_wikipedia_names(
-                name=wikipedia_name, lang="es", verbose=verbose)
+                name=wikipedia_name, lang="es", verbose=verbose, client=wiki_client)
         try:
             k = list(res["query"]["pages"].keys())[0]
             result = {"response": res,
@@ -270,19 +283,20 @@ def process_one_wikipedia_name(inst, url, db_name, verbose=0):
                               "$set": {"names": names, "updated": inst["updated"]}})
 
 
-def process_one_wikipedia_logo(inst, url, db_name, verbose=0):
+def process_one_wikipedia_logo(inst, url, db_name, verbose=0, client_options=None):
     client = MongoClient(url)
 
     db = client[db_name]
     collection = db["affiliations"]
 
+    wiki_client = get_client(client_options) if client_options is not None else None
     logo_url = None
     url = None
     for ext in inst["external_urls"]:
         if ext["source"] == "wikipedia":
             url = ext["url"]
     if url:
-        logo_url = get_logo_wikipedia(url=url)
+        logo_url = get_logo_wikipedia(url=url, client=wiki_client)
     else:
         name = None
         lang = None
@@ -292,7 +306,7 @@ def process_one_wikipedia_logo(inst, url, db_name, verbose=0):
                 lang = n["lang"]
                 break
         if name and lang:
-            logo_url = get_logo_wikipedia(name=name, lang=lang)
+            logo_url = get_logo_wikipedia(name=name, lang=lang, client=wiki_client)
         if not logo_url:
             for n in inst["names"]:
                 if n["lang"] == "es":
@@ -300,7 +314,7 @@ def process_one_wikipedia_logo(inst, url, db_name, verbose=0):
                     lang = n["lang"]
                     break
             if name and lang:
-                logo_url = get_logo_wikipedia(name=name, lang=lang)
+                logo_url = get_logo_wikipedia(name=name, lang=lang, client=wiki_client)
     if logo_url:
         try:
             logo_url = logo_url["query"]["pages"][list(logo_url["query"]["pages"].keys())[
@@ -336,6 +350,17 @@ class Kahi_wikipedia_affiliations(KahiBase):
 
         self.wikipedia_updated = []
 
+        # options of the client of the wikipedia API shared by the workers
+        self.client_options = {
+            "cache_path": config["wikipedia_affiliations"]["cache_path"] if "cache_path" in config["wikipedia_affiliations"].keys() else "wikipedia_cache.sqlite",
+            "cache_ttl": config["wikipedia_affiliations"]["cache_ttl"] if "cache_ttl" in config["wikipedia_affiliations"].keys() else 30,
+            "max_concurrency": config["wikipedia_affiliations"]["max_concurrency"] if "max_concurrency" in config["wikipedia_affiliations"].keys() else max(1, self.n_jobs),
+            "rate_limit": config["wikipedia_affiliations"]["rate_limit"] if "rate_limit" in config["wikipedia_affiliations"].keys() else 10,
+            "verbose": self.verbose
+        }
+        if "api_url" in config["wikipedia_affiliations"].keys():
+            self.client_options["api_url"] = config["wikipedia_affiliations"]["api_url"]
+
     def process_wikipedia(self):
         for task in self.tasks:
             if task == "names":
@@ -351,23 +376,30 @@ class Kahi_wikipedia_affiliations(KahiBase):
                     inst,
                     self.config["database_url"],
                     self.config["database_name"],
-                    self.verbose
+                    self.verbose,
+                    self.client_options
                 ) for inst in institutions)
             elif task == "logos":
                 if self.verbose > 0:
                     print("Getting logos from wikipedia")
                 institutions = list(self.collection.find(
                     {"updated.source": "ror", "_id": {"$nin": self.wikipedia_updated}}))
+                # threads share the client, so the concurrency and rate limits are global
                 Parallel(
                     n_jobs=self.n_jobs,
-                    backend="multiprocessing",
+                    backend="threading",
                     verbose=10
                 )(delayed(process_one_wikipedia_logo)(
                     inst,
                     self.config["database_url"],
                     self.config["database_name"],
-                    self.verbose
+                    self.verbose,
+                    self.client_options
                 ) for inst in institutions)
+            client = get_client(self.client_options)
+            if self.verbose > 0:
+                print("Wikipedia requests: {}, cached responses: {}".format(
+                    client.counters["requests"], client.counters["cached"]))
 
     def run(self):
         self.process_wikipedia()
@@ -0,0 +1,180 @@
+from threading import BoundedSemaphore, Lock
+from time import time, sleep
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+import requests
+import sqlite3
+import json
+
+# clients of the process by options, see get_client
+clients = {}
+clients_lock = Lock()
+
+
+class WikipediaClient:
+    """
+    Client of the wikipedia API shared by the workers.
+
+    The requests use a session with a pool of connections, at most max_concurrency requests
+    are done at the same time and at most rate_limit requests per second are started.
+    The responses are saved in a SQLite cache keyed by the url and the parameters, the responses
+    in the cache younger than cache_ttl days are returned without a request, so the next runs
+    only query the institutions that changed.
+    The transport (the function that does the request) can be replaced, ex: to use a fake API in tests.
+    """
+
+    def __init__(self, api_url="https://{lang}.wikipedia.org/w/api.php", cache_path=None, cache_ttl=30,
+                 max_concurrency=10, rate_limit=10, timeout=30, transport=None, verbose=0):
+        """
+        Parameters:
+        -----------
+        api_url : str
+            Url of the API, {lang} is replaced by the language of the request.
+        cache_path : str
+            Path of the SQLite file of the cache, if None the responses are not cached.
+        cache_ttl : float
+            Days a response is valid in the cache.
+        max_concurrency : int
+            Maximum number of requests at the same time.
+        rate_limit : float
+            Maximum number of requests per second, 0 for no limit.
+        timeout : int
+            Timeout of the requests in seconds.
+        transport : function
+            Function transport(url, params) that returns the json response of the request,
+            by default the request is done with the session of the client.
+        verbose : int
+            Verbosity level.
+        """
+        # at least one request at a time (ex: num_jobs -1 of joblib)
+        max_concurrency = max(1, max_concurrency)
+        self.api_url = api_url
+        self.cache_ttl = cache_ttl * 24 * 3600
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.transport = transport if transport else self.session_transport
+        self.verbose = verbose
+        self.counters = {"requests": 0, "cached": 0}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {"User-Agent": "kahi_wikipedia_affiliations (http://colav.udea.edu.co/)"})
+
+        self._semaphore = BoundedSemaphore(max_concurrency)
+        self._counters_lock = Lock()
+        self._rate_lock = Lock()
+        self._next_request = 0
+        self._cache_lock = Lock()
+        self.cache = None
+        if cache_path:
+            self.cache = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+            with self._cache_lock:
+                self.cache.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, time REAL, response TEXT)")
+                self.cache.commit()
+
+    def url(self, lang):
+        """
+        Returns the url of the API for a language.
+        """
+        return self.api_url.format(lang=lang)
+
+    def session_transport(self, url, params):
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def wait_rate_limit(self):
+        """
+        Waits until a new request can be started according to rate_limit.
+        """
+        if not self.rate_limit:
+            return
+        with self._rate_lock:
+            now = time()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + 1 / self.rate_limit
+        if wait > 0:
+            sleep(wait)
+
+    def get_cache(self, key):
+        if self.cache is None:
+            return None
+        with self._cache_lock:
+            row = self.cache.execute(
+                "SELECT time, response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row and time() - row[0] < self.cache_ttl:
+            return json.loads(row[1])
+        return None
+
+    def set_cache(self, key, data):
+        if self.cache is None:
+            return
+        with self._cache_lock:
+            self.cache.execute("INSERT OR REPLACE INTO responses (key, time, response) VALUES (?, ?, ?)",
+                               (key, time(), json.dumps(data)))
+            self.cache.commit()
+
+    def get(self, lang, params):
+        """
+        Does a request to the API (or returns the response in the cache).
+
+        Parameters:
+        -----------
+        lang : str
+            The iso-639 lang code of the wikipedia to query.
+        params : dict
+            Parameters of the request.
+
+        Returns:
+        --------
+        dict
+            The json response.
+        """
+        url = self.url(lang)
+        key = url + "?" + urlencode(sorted(params.items()))
+        data = self.get_cache(key)
+        if data is not None:
+            with self._counters_lock:
+                self.counters["cached"] += 1
+            return data
+        with self._semaphore:
+            self.wait_rate_limit()
+            data = self.transport(url, params)
+        with self._counters_lock:
+            self.counters["requests"] += 1
+        # the errors of the API are not cached, so they are requested again in the next run
+        if "error" not in data.keys():
+            self.set_cache(key, data)
+        if self.verbose > 5:
+            print("Requested", key)
+        return data
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            with self._cache_lock:
+                self.cache.close()
+            self.cache = None
+
+
+def get_client(options=None):
+    """
+    Returns the client of the process for the options, it is created the first time,
+    so the workers of a process share the pool of connections and the rate limit.
+
+    Parameters:
+    -----------
+    options : dict
+        Keyword arguments of WikipediaClient.
+    """
+    options = options if options else {}
+    key = json.dumps(options, sort_keys=True, default=str)
+    # the workers ask for the client at the same time, only one of them creates it
+    with clients_lock:
+        if key not in clients.keys():
+            clients[key] = WikipediaClient(**options)
+        return clients[key]
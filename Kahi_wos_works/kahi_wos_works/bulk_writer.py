@@ -0,0 +1,192 @@
+# This module is shared by the works plugins (Kahi_openalex_works, Kahi_scienti_works, Kahi_scopus_works and Kahi_wos_works).
+# Every plugin is released and installed by itself, so each one has its own copy of the module,
+# keep the copies identical (only the package name in the imports changes), the CI checks it.
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+class BulkWriter:
+    """
+    Buffered writer for the works collection.
+
+    The inserts and updates are accumulated and sent with an unordered bulk_write
+    when the buffer reaches bulk_size operations or it is older than max_age seconds.
+    The writer is thread safe, the operations can be registered with a key (ex: the doi)
+    and claim(key) guarantees that only one thread at a time processes a key and that
+    the pending operations of that key are in the database before it is read again,
+    so two threads do not insert the same doi before the batch lands.
+    The failed operations are always reported and counted, call check after the last flush
+    to stop the run if any of them failed.
+    """
+
+    def __init__(self, collection, bulk_size=1000, max_age=60, raise_on_error=False, verbose=0):
+        """
+        Parameters:
+        -----------
+        collection : pymongo.collection.Collection
+            Collection where the operations are written.
+        bulk_size : int
+            Number of operations per bulk_write.
+        max_age : int
+            Maximum number of seconds an operation waits in the buffer (checked when a new operation is added).
+        raise_on_error : bool
+            If True a failed bulk_write raises the BulkWriteError right away (ex: a writer with bulk_size 1
+            that replaces insert_one and update_one), otherwise the errors are counted.
+        verbose : int
+            Verbosity level.
+        """
+        self.collection = collection
+        self.bulk_size = bulk_size
+        self.max_age = max_age
+        self.raise_on_error = raise_on_error
+        self.verbose = verbose
+        self.counters = {"batches": 0, "inserted": 0,
+                         "matched": 0, "modified": 0, "errors": 0}
+        self._cond = Condition()
+        self._ops = []
+        self._pending = set()
+        self._claimed = set()
+        self._inflight = set()
+        self._last_flush = time()
+
+    @contextmanager
+    def claim(self, key):
+        """
+        Context manager to process a key (ex: doi) exclusively.
+        If the key has operations in the buffer they are written before entering the context.
+
+        Parameters:
+        -----------
+        key : str
+            The key to claim, if None nothing is done.
+        """
+        if not key:
+            yield
+            return
+        with self._cond:
+            while key in self._claimed or key in self._inflight:
+                self._cond.wait()
+            self._claimed.add(key)
+            pending = key in self._pending
+        try:
+            if pending:
+                self.flush()
+                with self._cond:
+                    while key in self._inflight:
+                        self._cond.wait()
+            yield
+        finally:
+            with self._cond:
+                self._claimed.discard(key)
+                self._cond.notify_all()
+
+    def insert_one(self, document, keys=None):
+        """
+        Add an insert to the buffer, the _id is created if the document does not have one.
+
+        Parameters:
+        -----------
+        document : dict
+            Document to insert.
+        keys : list
+            Keys of the operation (ex: doi), the _id of the document is always a key.
+
+        Returns:
+        --------
+        ObjectId
+            The _id of the document.
+        """
+        if "_id" not in document.keys():
+            document["_id"] = ObjectId()
+        self._add(InsertOne(document),
+                  [str(document["_id"])] + (keys if keys else []))
+        return document["_id"]
+
+    def update_one(self, filter, update, keys=None, upsert=False):
+        """
+        Add an update to the buffer.
+
+        Parameters:
+        -----------
+        filter : dict
+            Filter of the document to update.
+        update : dict
+            Update operation.
+        keys : list
+            Keys of the operation (ex: doi).
+        upsert : bool
+            If True the document is inserted if it is not found.
+        """
+        self._add(UpdateOne(filter, update, upsert=upsert), keys)
+
+    def _add(self, operation, keys):
+        with self._cond:
+            self._ops.append(operation)
+            if keys:
+                self._pending.update([key for key in keys if key])
+            full = len(self._ops) >= self.bulk_size or time() - \
+                self._last_flush > self.max_age
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the operations in the buffer with an unordered bulk_write.
+        """
+        with self._cond:
+            ops = self._ops
+            keys = self._pending
+            self._ops = []
+            self._pending = set()
+            self._inflight.update(keys)
+            self._last_flush = time()
+        try:
+            if ops:
+                self._write(ops)
+        finally:
+            with self._cond:
+                self._inflight.difference_update(keys)
+                self._cond.notify_all()
+
+    def _write(self, ops):
+        error = None
+        try:
+            result = self.collection.bulk_write(ops, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as bwe:
+            error = bwe
+            details = bwe.details
+            for write_error in details["writeErrors"]:
+                print(
+                    f"ERROR: bulk write on {self.collection.name} failed for operation {write_error['index']}: {write_error['errmsg']}")
+        with self._cond:
+            self.counters["batches"] += 1
+            self.counters["inserted"] += details["nInserted"]
+            self.counters["matched"] += details["nMatched"]
+            self.counters["modified"] += details["nModified"]
+            self.counters["errors"] += len(details["writeErrors"])
+        if error is not None and self.raise_on_error:
+            raise error
+        if self.verbose > 4:
+            print(
+                f"INFO: bulk write of {len(ops)} operations on {self.collection.name}, totals {self.counters}")
+
+    def info(self):
+        """
+        Returns the counters of the writer (batches, inserted, matched, modified and errors).
+        """
+        with self._cond:
+            return dict(self.counters)
+
+    def check(self):
+        """
+        Raise an exception if any operation of the writer failed, to be called after the last flush.
+        """
+        errors = self.info()["errors"]
+        if errors > 0:
+            raise Exception(
+                f"{errors} operations of the bulk writer on {self.collection.name} failed, see the errors above")